@@ -28,7 +28,8 @@ from itertools import izip
 
 sys.path.insert( 0, os.path.join( os.path.dirname( __file__ ), ".." ) )
 from grit.files.reads import clean_chr_name, fix_chrm_name_for_ucsc, \
-    CAGEReads, RAMPAGEReads, RNAseqReads, PolyAReads, ChIPSeqReads
+    CAGEReads, RAMPAGEReads, RNAseqReads, PolyAReads, ChIPSeqReads, \
+    get_reads_handle
 from grit.lib.multiprocessing_utils import ProcessSafeOPStream
 
 import multiprocessing
@@ -45,8 +46,8 @@ def populate_cvg_array_for_contig(
         merged_ofp, reads, chrm, chrm_length, strand ):
     if VERBOSE: print "Starting ", chrm, strand
     
-    # re-open the reads to make this multi-process safe
-    reads = reads.reload()
+    # get this process's handle, to make this multi-process safe
+    reads = get_reads_handle(reads, 'bam2wig')
     
     # open a tempory file to write this to
     with tempfile.NamedTemporaryFile(delete=True) as ofp:
@@ -22,6 +22,7 @@ import shutil
 
 import time
 import traceback
+import heapq
 
 import numpy
 
@@ -60,15 +61,104 @@ REP_ID = None
 class TooManyCandidateTranscriptsError(Exception):
     pass
 
-def iter_transcripts(graph, tss_exons, tes_exons):
-    paths = [[exon,] for exon in tss_exons]
+def count_transcripts(graph, tss_exons, tes_exons):
+    """Count the tss exon to tes exon paths in the splice graph.
+
+    Returns the number of paths that iter_transcripts would yield, and a
+    dict mapping each exon to the number of paths from it to a tes exon.
+    This is a single pass over the exons in reverse topological order, so
+    a locus with too many candidate transcripts can be rejected without 
+    enumerating any of them.
+    """
+    num_paths_to_tes = {}
+    for exon in reversed(list(nx.topological_sort(graph))):
+        num_paths_to_tes[exon] = sum(
+            1 if child in tes_exons else num_paths_to_tes[child]
+            for child in graph.successors(exon) )
+    num_transcripts = sum(num_paths_to_tes[exon] for exon in tss_exons)
+    return num_transcripts, num_paths_to_tes
+
+def path_exons(path):
+    """Return the list of exons in an (exon, parent path) linked path.
+
+    """
+    exons = []
+    while path is not None:
+        exon, path = path
+        exons.append(exon)
+    exons.reverse()
+    return exons
+
+def iter_transcripts(graph, tss_exons, tes_exons, num_paths_to_tes=None):
+    # paths are stored as (last exon, parent path), so that extending a 
+    # path shares its prefix rather than copying it. We don't extend paths
+    # into exons that can't reach a tes exon.
+    if num_paths_to_tes is None:
+        num_paths_to_tes = count_transcripts(graph, tss_exons, tes_exons)[1]
+    paths = [(exon, None) for exon in tss_exons]
     while len(paths) > 0:
         curr_path = paths.pop()
-        for child in graph.successors(curr_path[-1]):
+        for child in graph.successors(curr_path[0]):
             if child in tes_exons:
-                yield curr_path + [child,]
-            else:
-                paths.append(curr_path + [child,])
+                yield path_exons((child, curr_path))
+            elif num_paths_to_tes[child] > 0:
+                paths.append((child, curr_path))
+    return
+
+def iter_transcripts_by_support(graph, tss_exons, tes_exons):
+    """Iterate through the transcripts in order of their estimated support.
+
+    A transcript's support is estimated by its least supported junction, 
+    where a junction's support is the 'score' of its splice graph edge 
+    (1 if the edge has no score). Since we know the best support of any 
+    path from each exon to a tes exon, the paths can be extended best 
+    first, and every yielded transcript is at least as well supported as
+    all of the transcripts that follow it. Ties are broken depth first.
+    """
+    def edge_support(exon, child):
+        return graph[exon][child].get('score', 1)
+    
+    # find the best support of any path from each exon to a tes exon, or 
+    # None if the exon can't reach a tes exon
+    best_support_to_tes = {}
+    for exon in reversed(list(nx.topological_sort(graph))):
+        best_support = None
+        for child in graph.successors(exon):
+            support = edge_support(exon, child)
+            if child not in tes_exons:
+                if best_support_to_tes[child] is None: continue
+                support = min(support, best_support_to_tes[child])
+            if best_support is None or support > best_support:
+                best_support = support
+        best_support_to_tes[exon] = best_support
+    
+    # the heap stores (-best support of any completion, -insertion order, 
+    # support of the path so far, whether the path is complete, path)
+    paths = []
+    def add_path(best_support, support, is_complete, path):
+        heapq.heappush(paths, ( 
+            -best_support, -add_path.num_added, support, is_complete, path))
+        add_path.num_added += 1
+    add_path.num_added = 0
+    
+    for exon in tss_exons:
+        if best_support_to_tes[exon] is None: continue
+        add_path(best_support_to_tes[exon], float('inf'), False, (exon, None))
+    
+    while len(paths) > 0:
+        neg_best_support, order, support, is_complete, curr_path \
+            = heapq.heappop(paths)
+        if is_complete:
+            yield path_exons(curr_path)
+            continue
+        for child in graph.successors(curr_path[0]):
+            child_support = min(support, edge_support(curr_path[0], child))
+            if child in tes_exons:
+                add_path(child_support, child_support, True, 
+                         (child, curr_path))
+            elif best_support_to_tes[child] is not None:
+                add_path(min(child_support, best_support_to_tes[child]),
+                         child_support, False, (child, curr_path))
     return
 
 def path_len(path):
@@ -102,27 +192,55 @@ def iter_transcriptlets(graph, tss_exons, tes_exons, max_length):
 
 
 def build_splice_graph(
-        tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand ):
+        tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand,
+        jn_scores=None ):
     # build a directed graph, with edges leading from exon to exon via junctions
+    # if jn_scores is set, then it maps junctions to their support, and
+    # each edge stores the score of its junction
     all_exons = sorted(chain(tss_exons, internal_exons, tes_exons))
     graph = nx.DiGraph()
     graph.add_nodes_from( tss_exons )
     graph.add_nodes_from( internal_exons )
     graph.add_nodes_from( tes_exons )
     edges = find_jn_connected_exons(all_exons, jns, strand )
-    graph.add_edges_from( (start, stop) for jn, start, stop in edges )
+    if jn_scores is None:
+        graph.add_edges_from( (start, stop) for jn, start, stop in edges )
+    else:
+        graph.add_edges_from( (start, stop, {'score': jn_scores[jn]}) 
+                              for jn, start, stop in edges )
     assert nx.is_directed_acyclic_graph(graph)
     return graph
 
 def build_transcripts_from_elements( 
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand ):
+    """Build the candidate transcripts from the elements.
+
+    jns maps each junction to its read support. If there are more than 
+    MAX_NUM_CANDIDATE_TRANSCRIPTS candidates, then only the best supported
+    ones are kept.
+    """
     graph = build_splice_graph(
-        tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand)
+        tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand,
+        jn_scores=jns)
+    # count the transcripts before building them, so that we know whether
+    # we need to enumerate all of them or only the best supported ones
+    num_transcripts, num_paths_to_tes = count_transcripts(
+        graph, tss_exons, tes_exons)
     transcripts = [ [x,] for x in se_transcripts ]
-    for transcript in iter_transcripts(graph, tss_exons, tes_exons):
+    if ( len(se_transcripts) + num_transcripts 
+         <= config.MAX_NUM_CANDIDATE_TRANSCRIPTS ):
+        for transcript in iter_transcripts(
+                graph, tss_exons, tes_exons, num_paths_to_tes):
+            transcripts.append( sorted(transcript) )
+        return transcripts
+    
+    config.log_statement(
+        "Keeping the %i best supported of %i candidate transcripts" % (
+            config.MAX_NUM_CANDIDATE_TRANSCRIPTS,
+            len(se_transcripts) + num_transcripts), log=True)
+    for transcript in iter_transcripts_by_support(graph, tss_exons, tes_exons):
+        if len(transcripts) >= config.MAX_NUM_CANDIDATE_TRANSCRIPTS: break
         transcripts.append( sorted(transcript) )
-        if len(transcripts) > config.MAX_NUM_CANDIDATE_TRANSCRIPTS:
-            raise TooManyCandidateTranscriptsError, "Too many candidate transcripts"
     return transcripts
 
 def build_transcript_fragments_from_elements( 
@@ -130,7 +248,7 @@ def build_transcript_fragments_from_elements(
     graph = build_splice_graph(
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand)
     transcripts = [ [x,] for x in se_transcripts ]
-    for transcript in iter_transcriplets(graph, tss_exons, tes_exons, 600):
+    for transcript in iter_transcriptlets(graph, tss_exons, tes_exons, 600):
         transcripts.append( sorted(transcript) )
         if len(transcripts) > config.MAX_NUM_CANDIDATE_TRANSCRIPTS:
             raise TooManyCandidateTranscriptsError, "Too many candidate transcripts"
@@ -377,7 +495,15 @@ def group_elements_in_gene(grpd_exons):
         args = []
         for key in ('tss_exon', 'internal_exon', 'tes_exon', 
                     'single_exon_gene', 'promoter', 'polya', 'intron'):
-            if key not in grpd_exons: 
+            if key == 'intron':
+                # map the junctions to their best score
+                jns = {}
+                for start, stop, score in grpd_exons.get(key, []):
+                    if start < g_start or stop > g_stop: continue
+                    jns[(int(start), int(stop))] = max(
+                        score, jns.get((int(start), int(stop)), score))
+                args.append(jns)
+            elif key not in grpd_exons: 
                 args.append(set())
             else:
                 exons = [tuple(x) for x in grpd_exons[key].tolist()
@@ -17,7 +17,10 @@ You should have received a copy of the GNU General Public License
 along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from libc.math cimport log, exp, lgamma
+import numpy
+cimport numpy
+
+from libc.math cimport log, exp, lgamma, floor, fabs
 
 def calc_moments(double p, int n, double TOL=1e-6):
     cdef double mean = 0
@@ -54,3 +57,100 @@ def calc_moments(double p, int n, double TOL=1e-6):
             break
     
     return mean, var - mean**2
+
+
+cdef void _calc_moments_from_mode(
+        double p, int n, double TOL, double* mean, double* var):
+    """Calculate the moments in calc_moments, starting the sum at the mode.
+
+    The terms are summed outwards from the mode of the binomial, and each
+    direction stops when the remaining terms are below TOL (using the same
+    bound as calc_moments), so the cost grows with the standard deviation 
+    rather than the mean of the binomial. The variance is accumulated about
+    the value at the mode, which avoids the cancellation in E[v^2] - E[v]^2
+    when n*p is large.
+    """
+    cdef double log_p = log(p)
+    cdef double log_1m_p = log(1-p)
+    cdef double log_n_fac = lgamma(n+1)
+    
+    cdef int mode = <int>floor((n+1)*p)
+    if mode > n: mode = n
+    # the value of the statistic at the mode (it's 0 at x=0)
+    cdef double shift = mode*log_p - lgamma(mode+1)
+    # the x=0 term is handled below, so start the sums at x=1
+    if mode < 1: mode = 1
+    
+    cdef double log_x_fac_mode = lgamma(mode+1)
+    cdef double log_n_mx_fac_mode = lgamma(n-mode+1)
+    
+    # the x=0 term has value 0, and so only contributes to the shifted sums
+    cdef double prob = exp(n*log_1m_p)
+    cdef double m = 0
+    cdef double s1 = -prob*shift
+    cdef double s2 = prob*shift*shift
+    cdef double log_x_fac, log_n_mx_fac, value, mean_update, var_update
+    cdef int x
+
+    # sum from the mode up to n
+    log_x_fac = log_x_fac_mode
+    log_n_mx_fac = log_n_mx_fac_mode
+    for x in xrange(mode, n+1):
+        if x > mode:
+            log_x_fac += log(x)
+            log_n_mx_fac -= log(n-x+1)
+        prob = exp(log_n_fac - log_x_fac - log_n_mx_fac 
+                   + x*log_p + (n-x)*log_1m_p)
+        value = x*log_p - log_x_fac
+        mean_update = prob*value
+        m += mean_update
+        s1 += prob*(value-shift)
+        s2 += prob*(value-shift)*(value-shift)
+        var_update = mean_update*value
+        if ( x > p*n + 1 and fabs(mean_update)*(n-x) < TOL 
+             and fabs(var_update)*(n-x) < TOL ): 
+            break
+    
+    # sum from just below the mode down to 1
+    log_x_fac = log_x_fac_mode
+    log_n_mx_fac = log_n_mx_fac_mode
+    for x in xrange(mode-1, 0, -1):
+        log_x_fac -= log(x+1)
+        log_n_mx_fac += log(n-x)
+        prob = exp(log_n_fac - log_x_fac - log_n_mx_fac 
+                   + x*log_p + (n-x)*log_1m_p)
+        value = x*log_p - log_x_fac
+        mean_update = prob*value
+        m += mean_update
+        s1 += prob*(value-shift)
+        s2 += prob*(value-shift)*(value-shift)
+        var_update = mean_update*value
+        if ( x < p*n - 1 and fabs(mean_update)*x < TOL 
+             and fabs(var_update)*x < TOL ): 
+            break
+    
+    mean[0] = m
+    var[0] = s2 - s1*s1
+    return
+
+def calc_moments_array(ps, int n, double TOL=1e-6):
+    """Calculate calc_moments(p, n) for every p in ps.
+
+    The moments are calculated once for every distinct value of p, and
+    returned as two arrays (means and variances) with the shape of ps.
+    """
+    ps = numpy.asarray(ps, dtype=numpy.float64)
+    unique_ps, inverse = numpy.unique(ps, return_inverse=True)
+    cdef double[:] u_ps = unique_ps
+    cdef numpy.ndarray[numpy.float64_t, ndim=1] u_means = numpy.zeros(
+        len(unique_ps))
+    cdef numpy.ndarray[numpy.float64_t, ndim=1] u_vars = numpy.zeros(
+        len(unique_ps))
+    cdef Py_ssize_t i
+    cdef double mean, var
+    for i in xrange(len(unique_ps)):
+        _calc_moments_from_mode(u_ps[i], n, TOL, &mean, &var)
+        u_means[i] = mean
+        u_vars[i] = var
+    return ( u_means[inverse].reshape(ps.shape), 
+             u_vars[inverse].reshape(ps.shape) )
@@ -28,6 +28,22 @@ MAX_NUM_CANDIDATE_TRANSCRIPTS = 50000
 
 CB_SIG_LEVEL = 0.025
 
+# the solver to find the transcript frequency MLEs with ( one of 
+# frequency_estimation.MLE_SOLVERS )
+MLE_SOLVER = 'linesearch'
+
+# build the design matrix, and estimate the MLE and confidence bounds for 
+# every gene in one pass. The library sizes are counted up front, rather 
+# than summed over the genes' design matrices
+STREAM_QUANTIFICATION = False
+
+# quantify all of the samples together, sharing the genes and expected 
+# arrays between them and solving their MLEs in batches. This implies 
+# counting the library sizes up front, as in STREAM_QUANTIFICATION. Only
+# the em and squarem MLE_SOLVERs solve a batch jointly - linesearch 
+# solves the samples one at a time
+BATCH_QUANTIFICATION = False
+
 # log statement is set in the main init, and is a global
 # function which facilitates smart, ncurses based logging
 log_statement = None
@@ -80,6 +96,25 @@ MAX_DISTAL_SIZE_FOR_MATCH_OFFSET = 100
 
 tmp_dir = None
 
+# the directory to save paired read bin densities into, so that they can
+# be re-used by later runs. If this is None, they are only cached in memory
+BIN_DENSITY_CACHE_DIR = None
+# the size, in bytes, that the least recently used bin density cache shards
+# are deleted down to at the start of quantification. None for no limit
+BIN_DENSITY_CACHE_MAX_SIZE = 2**30
+
+# the directory to save the expected RNAseq arrays into, so that later runs
+# on the same genes and library only need to re-count the reads. If this is
+# None, they are not cached
+DESIGN_MATRIX_CACHE_DIR = None
+# the size, in bytes, that the least recently used design matrix cache shards
+# are deleted down to at the start of quantification. None for no limit
+DESIGN_MATRIX_CACHE_MAX_SIZE = 10*2**30
+
+# the directory to cache the parsed reference annotations in, so that later 
+# runs don't need to re-parse the gtf. If this is None, they are not cached
+ANNOTATION_CACHE_DIR = None
+
 def get_gene_tmp_fname(gene_id, sample_type=None, rep_id=None):
     rv = os.path.join(tmp_dir, "%s" % gene_id )
     if sample_type is not None: rv += ".%s" % sample_type
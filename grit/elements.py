@@ -46,8 +46,10 @@ def load_elements( fp ):
         chrm, start, stop, element_type, score, strand = line.split()[:6]
         # subtract 1 from stop becausee beds are closed open, and we 
         # wnat everything in 0-based closed-closed
-        all_elements[(chrm, strand)][element_type].add( 
-            (int(start), int(stop)-1) )
+        element = (int(start), int(stop)-1)
+        # keep the junction scores, which estimate their read support
+        if element_type == 'intron': element += (float(score),)
+        all_elements[(chrm, strand)][element_type].add(element)
     
     return convert_elements_to_arrays(all_elements)
 
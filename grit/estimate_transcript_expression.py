@@ -34,10 +34,13 @@ import Queue
 
 import multiprocessing
 from multiprocessing.sharedctypes import RawArray, RawValue
-from lib.multiprocessing_utils import Pool, ThreadSafeFile
+from lib.multiprocessing_utils import (
+    Pool, ThreadSafeFile, WorkStealingScheduler )
+from lib.array_store import ArrayStore
 
 from files.gtf import load_gtf, Transcript, Gene
-from files.reads import fix_chrm_name_for_ucsc
+from files.reads import (
+    fix_chrm_name_for_ucsc, get_reads_handle, log_reads_pool_stats )
 
 import f_matrix
 import frequency_estimation
@@ -46,6 +49,7 @@ from frag_len import load_fl_dists, FlDist, build_normal_density
 import config
 
 import cPickle as pickle
+import tempfile
 
 SAMPLE_ID = None
 REP_ID = None
@@ -56,6 +60,10 @@ class NoDesignMatrixError(Exception):
 class SharedData(object):
     """Share data across processes.
 
+    The genes and design matrices are stored in a single append only, memory
+    mapped store. The location of every gene's record is known before the
+    worker processes are forked, and the locations of the design matrices
+    (which are set by the workers) are kept in a shared array.
     """    
     def get_gene(self, gene_id):
         if self._cached_gene_id == gene_id and self._cached_gene is not None:
@@ -63,48 +71,61 @@ class SharedData(object):
         
         # we don't need to lock this because genes can only be
         # set one time
-        fname = self.gene_fname_mapping[gene_id]
-        with open(fname) as fp:
-            gene = pickle.load(fp)
+        offset, size = self.gene_locs[gene_id]
+        gene, arrays = self.store.load(offset, size)
 
         self._cached_gene_id = gene_id
         self._cached_gene = gene
         
         return gene
         
+    def _get_design_matrix_loc(self, gene_id):
+        i = 2*self.gene_indices[gene_id]
+        with self.design_mat_lock: 
+            return self.design_mat_locs[i], self.design_mat_locs[i+1]
+    
+    def get_design_matrix_shape(self, gene_id):
+        """Return the (number of bins, number of transcripts) in gene_id's 
+        design matrix, or (0, 0) if it hasn't been set.
+
+        """
+        i = 2*self.gene_indices[gene_id]
+        with self.design_mat_lock: 
+            return self.design_mat_shapes[i], self.design_mat_shapes[i+1]
+    
     def get_design_matrix(self, gene_id):
         if self._cached_fmat_gene_id == gene_id:
             return self._cached_fmat
 
-        with self.design_mat_lock: 
-            fname = self.design_mat_filenames[gene_id].value
-        if fname == '': 
+        offset, size = self._get_design_matrix_loc(gene_id)
+        if offset == -1: 
             raise NoDesignMatrixError, "No design matrix for '%s'" % gene_id
-        with open(fname) as fp:
-            f_mat = pickle.load(fp)
+        f_mat, arrays = self.store.load(offset, size)
+        f_mat.join_arrays(arrays)
         self._cached_fmat_gene_id = gene_id
         self._cached_fmat = f_mat
         return f_mat
     
     def set_design_matrix(self, gene_id, f_mat):
-        ofname = config.get_fmat_tmp_fname(gene_id, SAMPLE_ID, REP_ID)
-        
         # because there's no cache invalidation mechanism, we're only
         # allowed to set the f_mat object once. This also allows us to
         # move the load outside of the lock
-        try: assert self.design_mat_filenames[gene_id].value == ''
+        try: assert self._get_design_matrix_loc(gene_id)[0] == -1
         except:
             config.log_statement(
-                "%s has already had its design matrix set (%s)" % (
-                    gene_id, self.design_mat_filenames[gene_id].value ), 
+                "%s has already had its design matrix set" % gene_id, 
                 log=True)
             return
         
-        with open(ofname, "w") as ofp:
-            pickle.dump(f_mat, ofp)
-        
+        offset, size = self.store.append(*f_mat.split_arrays())
+        i = 2*self.gene_indices[gene_id]
         with self.design_mat_lock: 
-            self.design_mat_filenames[gene_id].value = ofname
+            self.design_mat_locs[i] = offset
+            self.design_mat_locs[i+1] = size
+            self.design_mat_shapes[i] = sum(
+                expected.shape[0] for expected in f_mat.expected_freq_arrays
+                if expected is not None )
+            self.design_mat_shapes[i+1] = len(f_mat.transcript_indices())
         
         if f_mat.num_rnaseq_reads is not None:
             with self.num_rnaseq_reads.get_lock():
@@ -118,6 +139,19 @@ class SharedData(object):
         
         return
     
+    def set_num_reads_in_bams(self, (num_cage_reads, num_rnaseq_reads, 
+                                     num_polya_reads)):
+        """Set the library sizes, rather than summing them over design matrices.
+
+        """
+        if num_cage_reads is not None: 
+            self.num_cage_reads.value = num_cage_reads
+        if num_rnaseq_reads is not None: 
+            self.num_rnaseq_reads.value = num_rnaseq_reads
+        if num_polya_reads is not None: 
+            self.num_polya_reads.value = num_polya_reads
+        return
+    
     def get_num_reads_in_bams(self):
         #config.log_statement("num_cage_reads=%s, num_rnaseq_reads=%s, num_polya_reads=%s" 
             #% (self.num_cage_reads.value, 
@@ -155,11 +189,13 @@ class SharedData(object):
         
         return
     
-    def __init__(self, pickled_gene_fnames):        
-        self._manager = multiprocessing.Manager()
-        
-        #self.cb_genes = self._manager.list()
-        #self.cb_genes_being_processed = self._manager.list()
+    def __init__(self, pickled_gene_fnames, genes_data=None):
+        """Load the pickled genes into the shared store. 
+
+        If genes_data is set, then re-use its store and genes rather than 
+        loading them again. This allows the expression estimates of 
+        several samples to be stored for the same genes.
+        """
         self.cb_genes_lock = multiprocessing.Lock()
         
         # store the expression estimates
@@ -167,27 +203,53 @@ class SharedData(object):
         self.lbs = {}
         self.ubs = {}
         
-        # store data that all children need to be able to access        
-        self.design_mat_filenames = {}
-        self.design_mat_lock = multiprocessing.Lock()    
-        
         self.mle_lock = multiprocessing.Lock()    
         self.cbs_lock = multiprocessing.Lock()    
         
-        # initialize the gene data
-        self.gene_ids = []
-        self.gene_fname_mapping = {}
-        self.gene_ntranscripts_mapping = {}
-
-        pickled_gene_fnames.sort(key=lambda x:x[1], reverse=True)
-        for gene_id, n_transcripts, fname in pickled_gene_fnames:
-            self.gene_fname_mapping[gene_id] = fname
-            self.gene_ntranscripts_mapping[gene_id] = n_transcripts
-            self.gene_ids.append(gene_id)
-            
-            self.design_mat_filenames[gene_id] = multiprocessing.Array(
-                'c', 1000)
-            self.design_mat_filenames[gene_id].value = ''
+        if genes_data is not None:
+            self._owns_store = False
+            self.store = genes_data.store
+            self.gene_ids = genes_data.gene_ids
+            self.gene_indices = genes_data.gene_indices
+            self.gene_locs = genes_data.gene_locs
+            self.gene_ntranscripts_mapping = \
+                genes_data.gene_ntranscripts_mapping
+        else:
+            # store data that all children need to be able to access
+            self._owns_store = True
+            fd, store_fname = tempfile.mkstemp(
+                prefix="shared_data.", suffix=".store", dir=config.tmp_dir)
+            os.close(fd)
+            self.store = ArrayStore(store_fname)
+
+            # initialize the gene data. The pickled genes are copied into 
+            # the store as is, so that the workers never need to re-open 
+            # the files
+            self.gene_ids = []
+            self.gene_indices = {}
+            self.gene_locs = {}
+            self.gene_ntranscripts_mapping = {}
+
+            pickled_gene_fnames.sort(key=lambda x:x[1], reverse=True)
+            try:
+                for gene_id, n_transcripts, fname in pickled_gene_fnames:
+                    with open(fname, "rb") as fp:
+                        self.gene_locs[gene_id] = self.store.append(
+                            fp.read(), is_pickled=True)
+                    self.gene_ntranscripts_mapping[gene_id] = n_transcripts
+                    self.gene_indices[gene_id] = len(self.gene_ids)
+                    self.gene_ids.append(gene_id)
+            except:
+                self.store.delete()
+                raise
+        
+        # the (offset, size) of every gene's design matrix in the store, 
+        # or -1 if it hasn't been set
+        self.design_mat_locs = RawArray('l', [-1]*(2*len(self.gene_ids)))
+        # the number of bins and transcripts in every design matrix, which 
+        # are used to estimate the cost of processing a gene
+        self.design_mat_shapes = RawArray('l', 2*len(self.gene_ids))
+        self.design_mat_lock = multiprocessing.Lock()    
         
         self.num_rnaseq_reads = multiprocessing.Value('i', 0)
         self.num_cage_reads = multiprocessing.Value('i', 0)
@@ -195,14 +257,14 @@ class SharedData(object):
 
                 
         # create objects to cache gene objects, so that we dont have to do a 
-        # fresh load from the shared manager
+        # fresh load from the shared store
         self._cached_gene_id = None
         self._cached_gene = None
         self._cached_fmat_gene_id = None
         self._cached_fmat = None
     
     def populate_expression_queue(self):
-        for gene_id in self.gene_fname_mapping:
+        for gene_id in self.gene_ids:
             n_trans = self.gene_ntranscripts_mapping[gene_id]
             self.mle_estimates[gene_id] = RawArray(
                 'd', [-1]*(n_trans+1))
@@ -210,6 +272,16 @@ class SharedData(object):
                 'd', [-1]*n_trans)
             self.lbs[gene_id] = RawArray(
                 'd', [-1]*n_trans)
+
+    def close(self):
+        """Delete the shared store. 
+
+        This must only be called by the parent, after the workers have finished.
+        If the store is shared with another SharedData object, then only 
+        the owner deletes it.
+        """
+        if self._owns_store:
+            self.store.delete()
     
 
 def calc_effective_transcript_length(t, fl_dists_and_weights):
@@ -255,61 +327,59 @@ def calc_fpkm( gene, fl_dists, freqs, num_reads_in_bam):
         fpkms.append( fpkm )
     return fpkms
 
-def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
-                                    f_mat, mle_estimate, 
-                                    trans_indices, cntr,
-                                    cb_alpha):
+def build_confidence_bounds_estimator( 
+        f_mat, num_reads_in_bams, mle_estimate, cb_alpha ):
     # update the mle_estimate array to only store observable transcripts
     # add 1 to skip the out of gene bin
     observable_trans_indices = (
         numpy.array([-1,] + f_mat.transcript_indices().tolist())+1 )
-    mle_estimate = mle_estimate[observable_trans_indices]
+    return frequency_estimation.ConfidenceBoundsEstimator(
+        f_mat, num_reads_in_bams, 
+        mle_estimate[observable_trans_indices], cb_alpha )
+
+def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
+                                    f_mat, mle_estimate, 
+                                    trans_indices,
+                                    cb_alpha, bnd_types=('lb', 'ub'),
+                                    bnds_estimator=None ):
+    """Estimate the bounds for the transcripts in trans_indices.
 
+    bnds_estimator is an optional ConfidenceBoundsEstimator for this gene.
+    If it's None, then it is built the first time that it's needed.
+    """
     if config.VERBOSE:
         config.log_statement( 
             "Estimating confidence bounds for gene %s" % gene.id )
     
-    #n_skipped = sum( 1 for x in sorted(f_mat.filtered_transcripts)
-    #                 if x < trans_indices[0])
-    # XXX Make sure that this is beign counted correctly
-    #n_skipped_tmp = len(set(xrange(trans_indices[0])) - \
-    #    set(x-1 for x in observable_trans_indices[1:] if x-1 < trans_indices[0]))
-    #config.log_statement( str([n_skipped_tmp, n_skipped, f_mat.filtered_transcripts, \
-    #    observable_trans_indices, trans_indices]), log=True)
-    #assert n_skipped == n_skipped_tmp
-    
+    # the set up that is shared by all of the transcripts in this gene is
+    # done once, and re-used for every transcript
     res = []
-    while True:
-        with cntr.get_lock():
-            index = cntr.value
-            if index == -1: 
-                break
-            cntr.value -= 1
-                
-        trans_index, exp_mat_row, bnd_type = trans_indices[index]
-        
+    for i, (trans_index, exp_mat_row) in enumerate(trans_indices):
         config.log_statement( 
-            "Estimating %s confidence bound for gene %s (%i/%i remain)" % ( 
-                bnd_type, gene.id, cntr.value+1, len(gene.transcripts)))
+            "Estimating %s confidence bounds for gene %s (%i/%i remain)" % ( 
+                "/".join(bnd_types), gene.id, 
+                len(trans_indices)-i, len(trans_indices)))
         try:
-            p_value, bnd = frequency_estimation.estimate_confidence_bound( 
-                f_mat, num_reads_in_bams,
-                exp_mat_row, mle_estimate, bnd_type, cb_alpha )
+            if bnds_estimator is None:
+                bnds_estimator = build_confidence_bounds_estimator(
+                    f_mat, num_reads_in_bams, mle_estimate, cb_alpha )
+            bnds = bnds_estimator.estimate_bounds(exp_mat_row, bnd_types)
         except Exception, inst:
-            p_value = 1.
-            bnd = 0.0 if bnd_type == 'lb' else 1.0
+            bnds = [ (bnd_type, 1., 0.0 if bnd_type == 'lb' else 1.0)
+                     for bnd_type in bnd_types ]
             error_msg = "%i: Skipping %s (%s:%s:%i-%i): %s" % (
                 os.getpid(), gene.id, 
                 gene.chrm, gene.strand, gene.start, gene.stop, inst)
             config.log_statement( error_msg, log=True )
             config.log_statement( traceback.format_exc(), log=True )
         
-        if config.DEBUG_VERBOSE: config.log_statement( 
-            "FINISHED %s BOUND %s\t%s\t%i/%i\t%.2e\t%.2e" % (
-            bnd_type, gene.id, None, 
-            trans_index, len(gene.transcripts), 
-            bnd, p_value ) )
-        res.append((bnd_type, trans_index, bnd))
+        for bnd_type, p_value, bnd in bnds:
+            if config.DEBUG_VERBOSE: config.log_statement( 
+                "FINISHED %s BOUND %s\t%s\t%i/%i\t%.2e\t%.2e" % (
+                bnd_type, gene.id, None, 
+                trans_index, len(gene.transcripts), 
+                bnd, p_value ) )
+            res.append((bnd_type, trans_index, bnd))
 
     if config.VERBOSE:
         config.log_statement( 
@@ -317,83 +387,52 @@ def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
     
     return res
 
-def find_confidence_bounds_worker( 
-        data, gene_ids, trans_index_cntrs, bnd_type ):
-    def get_new_gene():
-        
-        # get a gene to process
-        try: gene_id = gene_ids.get(timeout=0.1)
-        except Queue.Empty: 
-            assert gene_ids.qsize() == 0
-            raise IndexError, "No genes left"
-        
-        config.log_statement(
-            "Loading design matrix for gene '%s'" % gene_id)
-
-        gene = data.get_gene(gene_id)
-        try: 
-            f_mat = data.get_design_matrix(gene_id)
-        except NoDesignMatrixError:
-            if config.DEBUG_VERBOSE:
-                config.log_statement("No design matrix for '%s'" % gene_id, 
-                                     log=True)
-            raise
-
-        mle_estimate = data.get_mle(gene_id)
-        
-        trans_indices = []
-        for row_num, t_index in enumerate(f_mat.transcript_indices()):
-            trans_indices.append((t_index, row_num+1, bnd_type))
-
-        cntr = trans_index_cntrs[gene_id]
-        with cntr.get_lock():
-            if cntr.value == -1000: 
-                cntr.value = len(trans_indices)-1
-        
-        return gene, f_mat, mle_estimate, trans_indices, cntr
-    
-    def get_gene_being_processed():
-        longest_gene_id = None
-        gene_len = 0
-        for gene_id, cntr in trans_index_cntrs.iteritems():
-            value = cntr.value
-            if value > gene_len:
-                longest_gene_id = gene_id
-                gene_len = value
-        
-        if longest_gene_id is None: 
-            return None
-        
-        gene = data.get_gene(longest_gene_id)
-        f_mat = data.get_design_matrix(longest_gene_id)
-        mle_estimate = data.get_mle(longest_gene_id)
-
-        trans_indices = []
-        for row_num, t_index in enumerate(f_mat.transcript_indices()):
-            trans_indices.append((t_index, row_num+1, bnd_type))
-        
-        return ( gene, f_mat, mle_estimate, 
-                 trans_indices, trans_index_cntrs[longest_gene_id] )
-    
-    no_new_genes = False    
+def find_confidence_bounds_worker( scheduler, data, bnd_types ):
     num_reads_in_bams = data.get_num_reads_in_bams()
-    while True:
+    # large genes are split into sub-tasks, each of which estimates the bounds
+    # for the transcripts in rows [start, stop) of the design matrix. The 
+    # gene data and bounds estimator are cached for the last gene, so that 
+    # they are re-used when this worker processes consecutive sub-tasks 
+    # from the same gene.
+    cached_gene_id, cached_gene_data = None, None
+    for gene_id, start, stop in scheduler.iter_tasks():
         try:
-            try: 
-                gene, f_mat, mle_estimate, trans_indices, cntr = get_new_gene()
-            except NoDesignMatrixError:
-                continue
-            except IndexError: 
-                res = get_gene_being_processed()
-                if res is None: 
-                    break
-                gene, f_mat, mle_estimate, trans_indices, cntr = res
+            if gene_id != cached_gene_id:
+                cached_gene_id, cached_gene_data = None, None
+                config.log_statement(
+                    "Loading design matrix for gene '%s'" % gene_id)
+                gene = data.get_gene(gene_id)
+                try: 
+                    f_mat = data.get_design_matrix(gene_id)
+                except NoDesignMatrixError:
+                    if config.DEBUG_VERBOSE:
+                        config.log_statement(
+                            "No design matrix for '%s'" % gene_id, log=True)
+                    continue
+                mle_estimate = data.get_mle(gene_id)
+                
+                # if this fails, then find_confidence_bounds_in_gene 
+                # will log the error for every transcript
+                try: 
+                    bnds_estimator = build_confidence_bounds_estimator(
+                        f_mat, num_reads_in_bams, mle_estimate, 
+                        config.CB_SIG_LEVEL)
+                except Exception:
+                    bnds_estimator = None
+                cached_gene_id = gene_id
+                cached_gene_data = (gene, f_mat, mle_estimate, bnds_estimator)
+            gene, f_mat, mle_estimate, bnds_estimator = cached_gene_data
+            
+            trans_indices = []
+            for row_num, t_index in enumerate(f_mat.transcript_indices()):
+                trans_indices.append((t_index, row_num+1))
             
             cbs = find_confidence_bounds_in_gene( 
                 gene, num_reads_in_bams,
                 f_mat, mle_estimate, 
-                trans_indices, cntr,
-                cb_alpha=config.CB_SIG_LEVEL)
+                trans_indices[start:stop],
+                cb_alpha=config.CB_SIG_LEVEL, bnd_types=bnd_types,
+                bnds_estimator=bnds_estimator)
             data.set_cbs(gene.id, cbs)
             
             if config.VERBOSE:
@@ -403,55 +442,64 @@ def find_confidence_bounds_worker(
     
     return
 
-def estimate_confidence_bounds( data, bnd_type ):
+def estimate_confidence_bounds( data, bnd_types ):
+    """Estimate the bnd_types ('lb' and/or 'ub') bounds for every gene.
+
+    """
     config.log_statement(
         "Populating estimate confidence bounds queue.")
-
-    ## populate the queue
-    # sort so that the biggest genes are processed first
-    gene_ids = multiprocessing.Queue()
-    trans_index_cntrs = {}
-    sorted_gene_ids = sorted(data.gene_ids, 
-                             key=lambda x:data.gene_ntranscripts_mapping[x],
-                             reverse=True)
-    for i, gene_id in enumerate(sorted_gene_ids):
-        gene_ids.put(gene_id)
-        trans_index_cntrs[gene_id] = multiprocessing.Value( 'i', -1000)
+    
+    # every transcript's bounds cost about as much as an MLE, so split 
+    # the genes into per transcript items
+    scheduler = WorkStealingScheduler(
+        config.NTHREADS, name='Confidence bounds')
+    for gene_id in data.gene_ids:
+        num_bins, num_transcripts = data.get_design_matrix_shape(gene_id)
+        if num_bins == 0: continue
+        scheduler.add_task( 
+            (gene_id,), cost=num_transcripts*num_transcripts*num_bins, 
+            num_items=num_transcripts )
     
     config.log_statement("Waiting on gene bounds children")
-
-    if False and config.NTHREADS == 1:
-        find_confidence_bounds_worker( 
-            data, gene_ids, trans_indices_queues, bnd_type )
-    else:
-        pids = []
-        for i in xrange(config.NTHREADS):
-            pid = os.fork()
-            if pid == 0:
-                try: 
-                    find_confidence_bounds_worker(
-                        data, gene_ids, 
-                        trans_index_cntrs, bnd_type)
-                except Exception, inst:
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            pids.append(pid)
-        
-        for pid in pids:
-            #config.log_statement("Waiting on pid '%i'" % pid)
-            os.waitpid(pid, 0) 
+    scheduler.run(find_confidence_bounds_worker, (scheduler, data, bnd_types))
     
     return
 
 
-def estimate_mle_worker( gene_ids, data ):
-    while True:
-        #config.log_statement("Retrieving gene from queue")
-        gene_id = gene_ids.get()
-        if gene_id == 'FINISHED': 
-            return
-        
+def estimate_mle_in_gene( gene, f_mat, num_reads_in_bams ):
+    """Estimate the transcript frequencies in gene.
+
+    Returns the frequencies of every transcript in gene (preceded by the out
+    of gene frequency), with -1 for transcripts that weren't quantified, or
+    None if there are no observed reads.
+    """
+    expected_array, observed_array = f_mat.expected_and_observed(
+        num_reads_in_bams)
+    if (expected_array, observed_array) is (None, None): 
+        return None
+    if observed_array is not None and observed_array.sum() == 0:
+        return None
+    start_time = time.time()
+    mle, num_iterations = \
+        frequency_estimation.estimate_transcript_frequencies( 
+            observed_array, expected_array, 
+            return_num_iterations=True)
+    mle_time = time.time() - start_time
+
+    log_lhd = frequency_estimation.calc_lhd( 
+        mle, observed_array, expected_array)
+
+    # add back in the missing trasncripts
+    full_mle = -1*numpy.ones(len(gene.transcripts)+1, dtype=float)
+    full_mle[numpy.array([-1,]+f_mat.transcript_indices().tolist())+1] = mle
+
+    config.log_statement( 
+        "FINISHED MLE %s\t%.2f (%s: %i iterations, %.2f sec) - updating queues" % ( 
+            gene.id, log_lhd, config.MLE_SOLVER, num_iterations, mle_time ) )
+    return full_mle
+
+def estimate_mle_worker( scheduler, data ):
+    for gene_id, in scheduler.iter_tasks():
         try:
             config.log_statement(
                 "Loading gene %s" % gene_id )
@@ -469,15 +517,8 @@ def estimate_mle_worker( gene_ids, data ):
                     config.log_statement("No design matrix for '%s'" % gene_id, 
                                          log=True)
                 continue
-            num_reads_in_bams = data.get_num_reads_in_bams()
-            expected_array, observed_array = f_mat.expected_and_observed(
-                num_reads_in_bams)
-            if (expected_array, observed_array) is (None, None): 
-                continue
-            if observed_array is not None and observed_array.sum() == 0:
-                continue
-            mle = frequency_estimation.estimate_transcript_frequencies( 
-                observed_array, expected_array)
+            full_mle = estimate_mle_in_gene(
+                gene, f_mat, data.get_num_reads_in_bams())
         except Exception, inst:
             error_msg = "%i: Skipping %s (%s:%s:%i-%i): %s" % (
                 os.getpid(), gene.id, 
@@ -486,70 +527,78 @@ def estimate_mle_worker( gene_ids, data ):
             config.log_statement( traceback.format_exc(), log=True )
             continue
 
-        log_lhd = frequency_estimation.calc_lhd( 
-            mle, observed_array, expected_array)
+        if full_mle is not None:
+            data.set_mle(gene, full_mle)
 
-        # add back in the missing trasncripts
-        full_mle = -1*numpy.ones(len(gene.transcripts)+1, dtype=float)
-        full_mle[numpy.array([-1,]+f_mat.transcript_indices().tolist())+1] = mle
-        
-        data.set_mle(gene, full_mle)
-        config.log_statement( "FINISHED MLE %s\t%.2f - updating queues" % ( 
-                gene.id, log_lhd ) )
+    return
 
 def estimate_mles( data ):
     config.log_statement("Initializing MLE queue")
-
-    gene_ids = multiprocessing.Queue()
-    sorted_gene_ids = sorted(data.gene_ids, 
-                             key=lambda x:data.gene_ntranscripts_mapping[x],
-                             reverse=True)
-    # sort so that the biggest genes are processed first
-    
-    args = [ gene_ids, data ]
-    if False and config.NTHREADS == 1:
-        estimate_mle_worker(*args)
-    else:
-        ps = []
-        for i in xrange(config.NTHREADS):
-            pid = os.fork()
-            if pid == 0:
-                try:
-                    estimate_mle_worker(*args)
-                except Exception, inst:
-                    config.log_statement( str(error_msg), log=True )
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            ps.append(pid)
-        
-        # populate the queue
-        config.log_statement("Populating MLE queue")
-        for i, gene_id in enumerate(sorted_gene_ids):
-            gene_ids.put(gene_id)
-        for i in xrange(config.NTHREADS):
-            gene_ids.put("FINISHED")
-        config.log_statement("Waiting on MLE children")
-        
-        for pid in ps:
-            os.waitpid(pid, 0)
     
+    # the cost of an MLE scales with the size of the design matrix
+    scheduler = WorkStealingScheduler(config.NTHREADS, name='MLEs')
+    for gene_id in data.gene_ids:
+        num_bins, num_transcripts = data.get_design_matrix_shape(gene_id)
+        if num_bins == 0: continue
+        scheduler.add_task((gene_id,), cost=num_transcripts*num_bins)
+    
+    config.log_statement("Waiting on MLE children")
+    scheduler.run(estimate_mle_worker, (scheduler, data))
+    
+    return
+
+def load_design_matrix_caches(all_fl_dists):
+    """Load the saved bin densities for every fl_dists in all_fl_dists, and 
+       the index of the saved expected RNAseq arrays.
+
+    This should be called before forking, so that the workers share them.
+    Returns a shared array to sum the workers' cache hits and misses into.
+    """
+    f_matrix.BIN_DENSITY_CACHE.set_cache_dir(
+        config.BIN_DENSITY_CACHE_DIR, config.BIN_DENSITY_CACHE_MAX_SIZE)
+    for fl_dists in all_fl_dists:
+        for (rg, (r1_len, r2_len)), (fl_dist, marginal_frac) in \
+                fl_dists.items():
+            f_matrix.BIN_DENSITY_CACHE.load(
+                f_matrix.BIN_DENSITY_CACHE.signature(
+                    fl_dist, r1_len, f_matrix.MIN_NUM_MAPPABLE_BASES))
+    f_matrix.DESIGN_MATRIX_CACHE.set_cache_dir(
+        config.DESIGN_MATRIX_CACHE_DIR, config.DESIGN_MATRIX_CACHE_MAX_SIZE)
+    return multiprocessing.Array('l', 4)
+
+def save_design_matrix_caches(cache_stats=None):
+    # save the new cache entries, and add in this worker's hit counts
+    f_matrix.BIN_DENSITY_CACHE.save()
+    f_matrix.DESIGN_MATRIX_CACHE.save()
+    if cache_stats is not None:
+        with cache_stats.get_lock():
+            cache_stats[0] += f_matrix.BIN_DENSITY_CACHE.num_hits
+            cache_stats[1] += f_matrix.BIN_DENSITY_CACHE.num_misses
+            cache_stats[2] += f_matrix.DESIGN_MATRIX_CACHE.num_hits
+            cache_stats[3] += f_matrix.DESIGN_MATRIX_CACHE.num_misses
+    return
+
+def log_design_matrix_cache_stats(cache_stats):
+    for name, (num_hits, num_misses) in (
+            ("Bin density", cache_stats[0:2]),
+            ("Design matrix", cache_stats[2:4])):
+        config.log_statement(
+            "%s cache: %i hits, %i misses (%.1f%% hit rate)" % (
+                name, num_hits, num_misses, 
+                100.*num_hits/max(1, num_hits+num_misses)), log=True)
     return
 
-def build_design_matrices_worker( gene_ids, 
+def build_design_matrices_worker( scheduler, 
                                   data, fl_dists,
-                                  (rnaseq_reads, promoter_reads, polya_reads)):
+                                  (rnaseq_reads, promoter_reads, polya_reads),
+                                  cache_stats=None):
     assert fl_dists is not None
     #config.log_statement("Reloading read data in subprocess")
-    if rnaseq_reads is not None: rnaseq_reads = rnaseq_reads.reload()
-    if promoter_reads is not None: promoter_reads = promoter_reads.reload()
-    if polya_reads is not None: polya_reads = polya_reads.reload()
-    
-    while True:
-        #config.log_statement("Acquiring gene to process")        
-        gene_id = gene_ids.get()
-        if gene_id == 'FINISHED': 
-            return
+    rnaseq_reads = get_reads_handle(rnaseq_reads, 'design_matrices')
+    promoter_reads = get_reads_handle(promoter_reads, 'design_matrices')
+    polya_reads = get_reads_handle(polya_reads, 'design_matrices')
+    
+    for gene_id, in scheduler.iter_tasks():
         try:
             config.log_statement("Loading gene '%s'" % gene_id)
             gene = data.get_gene(gene_id)
@@ -558,11 +607,6 @@ def build_design_matrices_worker( gene_ids,
                     gene.id, gene.chrm, gene.strand, 
                     gene.start, gene.stop, len(gene.transcripts) ) )
             
-            #config.log_statement("rnaseq_reads=%s, promoter_reads=%s, polya_reads=%s, MAX_NUM_TRANSCRIPTS_TO_QUANTIFY=%s" %
-                #(rnaseq_reads.num_reads if rnaseq_reads else rnaseq_reads, 
-                 #promoter_reads.num_reads if promoter_reads else promoter_reads, 
-                 #polya_reads.num_reads if polya_reads else polya_reads, 
-                 #config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY))
             f_mat = f_matrix.DesignMatrix(
                 gene, fl_dists, 
                 rnaseq_reads, promoter_reads, polya_reads,
@@ -588,62 +632,244 @@ def build_design_matrices_worker( gene_ids,
             config.log_statement( 
                 error_msg + "\n" + traceback.format_exc(), log=True )
 
+    save_design_matrix_caches(cache_stats)
+    log_reads_pool_stats()
+    return
+
 def build_design_matrices( data, fl_dists,
                            (rnaseq_reads, promoter_reads, polya_reads)):    
     assert fl_dists is not None
-    gene_ids = multiprocessing.Queue()
     config.log_statement( "Populating build design matrices queue" )
-    sorted_gene_ids = sorted(data.gene_ids, 
-                             key=lambda x:data.gene_ntranscripts_mapping[x],
-                             reverse=True)
-    # sort so that the biggest genes are processed first
+    # we don't know the number of bins until the design matrix is built, so
+    # use the number of transcripts as the cost
+    scheduler = WorkStealingScheduler(
+        config.NTHREADS, name='Design matrices')
+    for gene_id in data.gene_ids:
+        scheduler.add_task(
+            (gene_id,), cost=data.gene_ntranscripts_mapping[gene_id])
     config.log_statement("FINISHED Populating build design matrices queue")
     
-    args = [ gene_ids, data, fl_dists, 
-             (rnaseq_reads, promoter_reads, polya_reads)]
-    if False and config.NTHREADS == 1:
-        build_design_matrices_worker(*args)
-    else:
-        ps = []
-        for i in xrange(config.NTHREADS):
-            #p = multiprocessing.Process(
-            #    target=build_design_matrices_worker, args=args)
-            #p.start()
-            #ps.append(p)
-            pid = os.fork()
-            if pid == 0:
-                try:
-                    build_design_matrices_worker(*args)
-                except Exception, inst:
-                    config.log_statement( str(error_msg), log=True )
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            ps.append(pid)
-        
-        # populate the queue
-        config.log_statement("Populating design matrix queue")
-        for i, gene_id in enumerate(sorted_gene_ids):
-            gene_ids.put(gene_id)
-        for i in xrange(config.NTHREADS):
-            gene_ids.put('FINISHED')
-        config.log_statement("Waiting on design matrix children")
-        
-        #while any( p is not None and p.is_alive() for p in ps ):
-        #while len(ps) > 0:
-        #    config.log_statement(
-        #   "Waiting for design matrix children processes to finish (%i/%i genes remain)"%(
-        #            gene_ids.qsize(), len(data.gene_ids)))
-        #    time.sleep(1.)
-        for pid in ps:
-            #config.log_statement("Waiting on pid '%i'" % pid)
-            os.waitpid(pid, 0)
+    cache_stats = load_design_matrix_caches([fl_dists,])
+    
+    args = [ scheduler, data, fl_dists, 
+             (rnaseq_reads, promoter_reads, polya_reads),
+             cache_stats ]
+    config.log_statement("Waiting on design matrix children")
+    scheduler.run(build_design_matrices_worker, args)
 
     config.log_statement("Read counts: %s" % str(data.get_num_reads_in_bams()), 
                          log=True)
+    log_design_matrix_cache_stats(cache_stats)
+    
+    return
+
+def quantify_genes_worker( scheduler, data, fl_dists,
+                           (rnaseq_reads, promoter_reads, polya_reads),
+                           bnd_types, cache_stats=None ):
+    rnaseq_reads = get_reads_handle(rnaseq_reads, 'quantification')
+    promoter_reads = get_reads_handle(promoter_reads, 'quantification')
+    polya_reads = get_reads_handle(polya_reads, 'quantification')
+    
+    num_reads_in_bams = data.get_num_reads_in_bams()
+    for gene_id, in scheduler.iter_tasks():
+        try:
+            gene = data.get_gene(gene_id)
+            config.log_statement( 
+                "Quantifying Gene %s(%s:%s:%i-%i) - %i transcripts"%(
+                    gene.id, gene.chrm, gene.strand, 
+                    gene.start, gene.stop, len(gene.transcripts) ) )
+            try:
+                f_mat = f_matrix.DesignMatrix(
+                    gene, fl_dists, 
+                    rnaseq_reads, promoter_reads, polya_reads,
+                    config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY)
+            except f_matrix.NoObservableTranscriptsError:
+                if config.DEBUG_VERBOSE:
+                    config.log_statement(
+                        "No observable transcripts for '%s'" % gene_id, 
+                        log=True)
+                continue
+            
+            mle = estimate_mle_in_gene(gene, f_mat, num_reads_in_bams)
+            if mle is None: continue
+            data.set_mle(gene, mle)
+            
+            if len(bnd_types) > 0:
+                trans_indices = []
+                for row_num, t_index in enumerate(f_mat.transcript_indices()):
+                    trans_indices.append((t_index, row_num+1))
+                cbs = find_confidence_bounds_in_gene( 
+                    gene, num_reads_in_bams, f_mat, mle, trans_indices,
+                    cb_alpha=config.CB_SIG_LEVEL, bnd_types=bnd_types)
+                data.set_cbs(gene.id, cbs)
+        except Exception, inst:
+            error_msg = "%i: Skipping %s: %s" % (
+                os.getpid(), gene_id, inst )
+            config.log_statement( 
+                error_msg + "\n" + traceback.format_exc(), log=True )
+    
+    save_design_matrix_caches(cache_stats)
+    log_reads_pool_stats()
+    return
+
+def quantify_genes( data, fl_dists, 
+                    (rnaseq_reads, promoter_reads, polya_reads), bnd_types ):
+    """Build the design matrix, and estimate the MLE and confidence bounds,
+    for every gene in a single pass.
+
+    The library sizes must already be set in data. Each gene is processed 
+    from start to finish by one worker, so its design matrix never leaves 
+    memory, and there are no barriers between the stages.
+    """
+    # the confidence bounds dominate the cost, and scale with the square
+    # of the number of transcripts
+    scheduler = WorkStealingScheduler(config.NTHREADS, name='Quantification')
+    for gene_id in data.gene_ids:
+        scheduler.add_task(
+            (gene_id,), cost=data.gene_ntranscripts_mapping[gene_id]**2)
+    
+    cache_stats = load_design_matrix_caches([fl_dists,])
+    scheduler.run(quantify_genes_worker, 
+                  (scheduler, data, fl_dists, 
+                   (rnaseq_reads, promoter_reads, polya_reads),
+                   bnd_types, cache_stats))
+    log_design_matrix_cache_stats(cache_stats)
+    
+    return
+
+def estimate_mles_in_samples( gene, f_mats, all_num_reads_in_bams ):
+    """Estimate the transcript frequencies in gene for every sample.
+
+    The samples whose design matrices share their expected arrays are 
+    solved as a batch. Returns a list with the full mle (see 
+    estimate_mle_in_gene) of each sample, or None if it has no design 
+    matrix or no observed reads.
+    """
+    # group the samples that can be solved together
+    groups = []
+    for i, f_mat in enumerate(f_mats):
+        if f_mat is None: continue
+        for group in groups:
+            if f_mats[group[0]].shares_expected_arrays(f_mat):
+                group.append(i)
+                break
+        else:
+            groups.append([i,])
+    
+    full_mles = [None]*len(f_mats)
+    for group in groups:
+        expected_array, observed_arrays = f_matrix.batch_expected_and_observed(
+            [f_mats[i] for i in group], 
+            [all_num_reads_in_bams[i] for i in group])
+        has_reads = (observed_arrays.sum(0) > 0)
+        if not has_reads.any(): continue
+        group = [i for i, x in izip(group, has_reads) if x]
+        
+        start_time = time.time()
+        mles, num_iterations = \
+            frequency_estimation.estimate_transcript_frequencies_batch( 
+                observed_arrays[:,has_reads], expected_array, 
+                return_num_iterations=True)
+        mle_time = time.time() - start_time
+        
+        indices = numpy.array(
+            [-1,] + f_mats[group[0]].transcript_indices().tolist()) + 1
+        for i, mle in izip(group, mles.T):
+            # add back in the missing trasncripts
+            full_mle = -1*numpy.ones(len(gene.transcripts)+1, dtype=float)
+            full_mle[indices] = mle
+            full_mles[i] = full_mle
+        
+        config.log_statement( 
+            "FINISHED MLE %s\t%i samples (%s: %i iterations, %.2f sec)" % ( 
+                gene.id, len(group), config.MLE_SOLVER, 
+                max(num_iterations), mle_time ) )
     
+    return full_mles
+
+def quantify_samples_genes_worker( scheduler, all_data, all_reads, bnd_types, 
+                                   cache_stats=None ):
+    all_reads = [ tuple( get_reads_handle(reads, 'quantification')
+                         for reads in sample_reads )
+                  for sample_reads in all_reads ]
+    samples_reads = [ (rnaseq_reads.fl_dists, rnaseq_reads, 
+                       promoter_reads, polya_reads)
+                      for promoter_reads, rnaseq_reads, polya_reads 
+                      in all_reads ]
+    all_num_reads_in_bams = [ data.get_num_reads_in_bams() 
+                              for data in all_data ]
+    for gene_id, in scheduler.iter_tasks():
+        try:
+            gene = all_data[0].get_gene(gene_id)
+            config.log_statement( 
+                "Quantifying Gene %s(%s:%s:%i-%i) - %i transcripts, %i samples"%(
+                    gene.id, gene.chrm, gene.strand, 
+                    gene.start, gene.stop, len(gene.transcripts), 
+                    len(all_data) ) )
+            f_mats = f_matrix.build_design_matrices_for_samples(
+                gene, samples_reads, config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY)
+            mles = estimate_mles_in_samples(
+                gene, f_mats, all_num_reads_in_bams)
+            
+            # an error in one sample shouldn't skip the gene in the others
+            for sample_i, (data, f_mat, mle, num_reads_in_bams) in enumerate(
+                    izip(all_data, f_mats, mles, all_num_reads_in_bams)):
+                if mle is None: continue
+                try:
+                    data.set_mle(gene, mle)
+                    if len(bnd_types) == 0: continue
+                    trans_indices = []
+                    for row_num, t_index in enumerate(
+                            f_mat.transcript_indices()):
+                        trans_indices.append((t_index, row_num+1))
+                    cbs = find_confidence_bounds_in_gene( 
+                        gene, num_reads_in_bams, f_mat, mle, trans_indices,
+                        cb_alpha=config.CB_SIG_LEVEL, bnd_types=bnd_types)
+                    data.set_cbs(gene.id, cbs)
+                except Exception, inst:
+                    error_msg = "%i: Skipping sample %i in %s: %s" % (
+                        os.getpid(), sample_i, gene_id, inst )
+                    config.log_statement( 
+                        error_msg + "\n" + traceback.format_exc(), log=True )
+        except Exception, inst:
+            error_msg = "%i: Skipping %s: %s" % (
+                os.getpid(), gene_id, inst )
+            config.log_statement( 
+                error_msg + "\n" + traceback.format_exc(), log=True )
+    
+    save_design_matrix_caches(cache_stats)
+    log_reads_pool_stats()
     return
 
+def quantify_samples_genes( all_data, all_reads, bnd_types ):
+    """Quantify every gene in all of the samples in a single pass.
+
+    all_data and all_reads contain the SharedData object, and the 
+    (promoter_reads, rnaseq_reads, polya_reads), of each sample.
+    """
+    scheduler = WorkStealingScheduler(
+        config.NTHREADS, name='Sample quantification')
+    for gene_id in all_data[0].gene_ids:
+        scheduler.add_task(
+            (gene_id,), 
+            cost=len(all_data)*all_data[0].gene_ntranscripts_mapping[gene_id]**2)
+
+    cache_stats = load_design_matrix_caches(
+        [rnaseq_reads.fl_dists for promoter_reads, rnaseq_reads, polya_reads
+         in all_reads])
+    scheduler.run(quantify_samples_genes_worker, 
+                  (scheduler, all_data, all_reads, bnd_types, cache_stats))
+    log_design_matrix_cache_stats(cache_stats)
+    
+    return
+
+def count_fragments_in_bams(promoter_reads, rnaseq_reads, polya_reads):
+    """Count the fragments in each library, in the get_num_reads_in_bams order.
+
+    """
+    return tuple( None if reads is None else reads.count_fragments()
+                  for reads in (promoter_reads, rnaseq_reads, polya_reads) )
+
 def build_gene_lines_for_tracking_file(
         gene_id, data, num_reads_in_bams, fl_dists):
     gene = data.get_gene(gene_id)
@@ -716,43 +942,114 @@ def quantify_transcript_expression(
     
     write_design_matrices=False
 
+    # estimate the lower and upper bounds in one pass, so that the work 
+    # that they share is only done once
+    bnd_types = []
+    if config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS: bnd_types.append('lb')
+    if config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS: bnd_types.append('ub')
+
     if config.VERBOSE: config.log_statement( 
         "Initializing processing data" )        
     data = SharedData(pickled_gene_fnames)
-    if config.VERBOSE: config.log_statement( 
-        "Building design matrices" )
-    build_design_matrices( data, rnaseq_reads.fl_dists,
-                           (rnaseq_reads, promoter_reads, polya_reads))
     
-    if config.VERBOSE: config.log_statement( 
-        "Populating input queue from expression queue" )
-    data.populate_expression_queue()
-    if config.VERBOSE: config.log_statement( 
-        "Estimating MLEs" )
-    estimate_mles( data )
+    # delete the shared store even if quantification fails
+    try:
+        if config.STREAM_QUANTIFICATION:
+            # we know the library sizes up front, so every gene can be 
+            # quantified as soon as its design matrix is built
+            num_reads_in_bams = count_fragments_in_bams(
+                promoter_reads, rnaseq_reads, polya_reads)
+            config.log_statement(
+                "Library sizes: %s" % str(num_reads_in_bams), log=True)
+            data.set_num_reads_in_bams(num_reads_in_bams)
+            data.populate_expression_queue()
+            if config.VERBOSE: config.log_statement( 
+                "Quantifying genes" )
+            quantify_genes( data, rnaseq_reads.fl_dists,
+                            (rnaseq_reads, promoter_reads, polya_reads), 
+                            bnd_types )
+        else:
+            if config.VERBOSE: config.log_statement( 
+                "Building design matrices" )
+            build_design_matrices( data, rnaseq_reads.fl_dists,
+                                   (rnaseq_reads, promoter_reads, polya_reads))
 
-    if config.VERBOSE: config.log_statement( 
-        "Calculating FPKMS and Writing mle's to output mle" )
+            if config.VERBOSE: config.log_statement( 
+                "Populating input queue from expression queue" )
+            data.populate_expression_queue()
+            if config.VERBOSE: config.log_statement( 
+                "Estimating MLEs" )
+            estimate_mles( data )
+
+            if config.VERBOSE: config.log_statement( 
+                "Calculating FPKMS and Writing mle's to output mle" )
+
+            if len(bnd_types) > 0:
+                if config.VERBOSE: config.log_statement( 
+                    "Estimating confidence bounds (%s)" % "/".join(bnd_types) )
+                estimate_confidence_bounds(data, bnd_types)
+                if config.VERBOSE: config.log_statement( 
+                    "FINISHED Estimating confidence bounds (%s)" % "/".join(
+                        bnd_types))
     
-    if config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS:
         if config.VERBOSE: config.log_statement( 
-            "Estimating lower confidence bounds" )
-        estimate_confidence_bounds(data, 'lb')
-        if config.VERBOSE: config.log_statement( 
-            "FINISHED Estimating lower confidence bounds" )
+            "Writing output data to tracking file" )
+
+        expression_ofp = ThreadSafeFile(ofname, "w")
+        write_data_to_tracking_file(data, rnaseq_reads.fl_dists, expression_ofp)    
+        expression_ofp.close()
+    finally:
+        data.close()
     
-    if config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS:
-        if config.VERBOSE: config.log_statement( 
-            "Estimating upper confidence bounds" )
-        estimate_confidence_bounds(data, 'ub')
-        if config.VERBOSE: config.log_statement( 
-            "FINISHED Estimating upper confidence bounds" )
+    return
+
+def quantify_samples_transcript_expression(samples, pickled_gene_fnames):
+    """Quantify the transcripts in pickled_gene_fnames in many samples at once.
+
+    samples is a list of (promoter_reads, rnaseq_reads, polya_reads, ofname). 
+    Each gene is loaded once, the expected RNAseq arrays are built once for 
+    every fragment length distribution, and the samples' MLEs are solved 
+    together. The library sizes are counted up front (as with 
+    config.STREAM_QUANTIFICATION).
+    """
+    bnd_types = []
+    if config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS: bnd_types.append('lb')
+    if config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS: bnd_types.append('ub')
     
     if config.VERBOSE: config.log_statement( 
-        "Writing output data to tracking file" )
+        "Initializing processing data for %i samples" % len(samples) )
+    all_data, all_reads = [], []
+    # delete the shared store even if quantification fails
+    try:
+        for promoter_reads, rnaseq_reads, polya_reads, ofname in samples:
+            assert rnaseq_reads.fl_dists is not None
+            data = SharedData(pickled_gene_fnames, 
+                              all_data[0] if len(all_data) > 0 else None)
+            all_data.append(data)
+            num_reads_in_bams = count_fragments_in_bams(
+                promoter_reads, rnaseq_reads, polya_reads)
+            config.log_statement(
+                "Library sizes (%s): %s" % (ofname, str(num_reads_in_bams)), 
+                log=True)
+            data.set_num_reads_in_bams(num_reads_in_bams)
+            data.populate_expression_queue()
+            all_reads.append((promoter_reads, rnaseq_reads, polya_reads))
 
-    expression_ofp = ThreadSafeFile(ofname, "w")
-    write_data_to_tracking_file(data, rnaseq_reads.fl_dists, expression_ofp)    
-    expression_ofp.close()
+        if config.VERBOSE: config.log_statement( 
+            "Quantifying genes in %i samples" % len(samples) )
+        quantify_samples_genes( all_data, all_reads, bnd_types )
+    
+        if config.VERBOSE: config.log_statement( 
+            "Writing output data to tracking files" )
+        for data, (promoter_reads, rnaseq_reads, polya_reads, ofname) in izip(
+                all_data, samples):
+            expression_ofp = ThreadSafeFile(ofname, "w")
+            write_data_to_tracking_file(
+                data, rnaseq_reads.fl_dists, expression_ofp)    
+            expression_ofp.close()
+    finally:
+        # the first sample's data owns the shared store
+        for data in reversed(all_data):
+            data.close()
     
     return
@@ -17,15 +17,41 @@ You should have received a copy of the GNU General Public License
 along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys
+import sys, os
+import time
+import copy
+import traceback
 sys.setrecursionlimit(10000)
 
+import tempfile
+import hashlib
+import cPickle as pickle
+
 import numpy
+import scipy.sparse
 from scipy.spatial import KDTree
 
+from array import array
+
 MIN_NUM_MAPPABLE_BASES = 1
 LET_READS_OVERLAP = True
 
+# the number of bytes that a single non-zero design matrix entry uses (the
+# value and its column index)
+BYTES_PER_DESIGN_MATRIX_ENTRY = 12
+
+# the maximum number of paired read bin densities to keep in memory
+MAX_NUM_CACHED_BIN_DENSITIES = 1000000
+
+# bump this whenever the format or the contents of the cached expected 
+# RNAseq arrays change, so that stale design matrix cache entries are ignored
+DESIGN_MATRIX_CACHE_VERSION = 1
+
+# cache shards (and temporary files) that are missing a file, and that haven't 
+# been modified for this many seconds, were left by processes that died 
+# before saving them
+MIN_ORPHANED_CACHE_SHARD_AGE = 24*60*60
+
 DEBUG=False
 
 from scipy.stats import beta
@@ -35,9 +61,11 @@ import config
 import networkx as nx
 
 import frag_len
+import sparsify_support_fns
+from lib.array_store import ArrayStore
 
 from itertools import product, izip, chain
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from grit.files.reads import ( iter_coverage_intervals_for_read, get_read_group,
                                CAGEReads, RAMPAGEReads, PolyAReads )
@@ -339,18 +367,15 @@ def iter_possible_fragment_bins_for_splice_graph(
     
     return
 
-def estimate_num_paired_reads_from_bin( 
-        bin, transcript, exon_lens,
-        fl_dist, read_len, min_num_mappable_bases=1 ):
-    """
+def calc_paired_read_bin_start_and_stop_bnds( 
+        bin, transcript, exon_lens, read_len, fl_max, min_num_mappable_bases=1 ):
+    """Find the range of fragment starts and stops that produce a read in bin.
 
+    Positions are relative to the start of the first exon in bin[0]. Returns
+    min_start, max_start, min_stop, max_stop.
     """
     assert min_num_mappable_bases > 0, \
         "It doesn't make sense to map a read into a segment with 0 bases"
-    #global DEBUG
-    #if transcript == (20, 21):
-    #    print transcript, bin, fl_dist
-    #    DEBUG = True
     
     # calculate the exon lens for the first and second reads
     fr_exon_lens = [ exon_lens[i] for i in bin[0]  ]
@@ -374,7 +399,7 @@ def estimate_num_paired_reads_from_bin(
                          + min_num_mappable_bases - read_len[1] )
     # make sure that there is enough room for the second read to start in 
     # sr_exon[0] given the fragment length constraints
-    min_start = max( min_start, pre_sr_exon_lens + read_len[1] - fl_dist.fl_max )
+    min_start = max( min_start, pre_sr_exon_lens + read_len[1] - fl_max )
 
     max_start = fr_exon_lens[0] - min_num_mappable_bases
     # make sure that there are enough bases in the last exon for the read to fit
@@ -412,25 +437,384 @@ def estimate_num_paired_reads_from_bin(
 
     if DEBUG:
         print "Stop Bnds", min_stop, max_stop
-    def do():
-        density = 0.0
-        for start_pos in xrange( min_start, max_start+1 ):
-            min_fl = max( min_stop - start_pos, fl_dist.fl_min )
-            max_fl = min( max_stop - start_pos, fl_dist.fl_max )
-            if min_fl > max_fl: continue
-            density += fl_dist.fl_density_cumsum[ max_fl - fl_dist.fl_min ]
-            if min_fl > fl_dist.fl_min:
-                density -= fl_dist.fl_density_cumsum[min_fl - fl_dist.fl_min-1]
-        return density
+
+    return min_start, max_start, min_stop, max_stop
+
+def sum_fl_density_cumsum( fl_dist, fl ):
+    """Return sum_{l <= fl} P(fragment length <= l) for every entry in fl.
+
+    """
+    offsets = numpy.asarray(fl) - fl_dist.fl_min
+    max_offset = fl_dist.fl_max - fl_dist.fl_min
+    rv = fl_dist.fl_density_cumsum_cumsum[numpy.clip(offsets, 0, max_offset)]
+    # past fl_max, every term is the total density
+    rv = rv + numpy.clip(offsets - max_offset, 0, None)*(
+        fl_dist.fl_density_cumsum[-1])
+    rv[offsets < 0] = 0
+    return rv
+
+def estimate_num_paired_reads_from_bnds( 
+        min_starts, max_starts, min_stops, max_stops, fl_dist ):
+    """Vectorized estimate of the paired read density for arrays of bounds.
+
+    The density for a single entry is
     
-    density = do()
+       sum_{start=min_start}^{max_start} 
+           P(min_stop-start <= fl <= max_stop-start)
+
+    and each term is a difference of fl_density_cumsum entries, so the sum 
+    is a difference of cumsum of cumsum entries, which takes constant time.
+    """
+    min_starts = numpy.asarray(min_starts, dtype=int)
+    max_starts = numpy.asarray(max_starts, dtype=int)
+    min_stops = numpy.asarray(min_stops, dtype=int)
+    max_stops = numpy.asarray(max_stops, dtype=int)
+    # restrict the starts to those that allow a fragment length in 
+    # [fl_min, fl_max], so that every term is non-negative
+    min_starts = numpy.maximum(min_starts, min_stops - fl_dist.fl_max)
+    max_starts = numpy.minimum(max_starts, max_stops - fl_dist.fl_min)
+    
+    def sum_over_starts(stops):
+        return ( sum_fl_density_cumsum(fl_dist, stops - min_starts) 
+                 - sum_fl_density_cumsum(fl_dist, stops - max_starts - 1) )
+    density = sum_over_starts(max_stops) - sum_over_starts(min_stops - 1)
+    
+    # if there are no valid starts, or no valid stops, then the density is 0
+    density[(min_starts > max_starts)|(min_stops > max_stops)] = 0
+    # the differences of prefix sums can leave small negative rounding noise
+    return numpy.clip(density, 0, None)
+
+def estimate_num_paired_reads_from_bin( 
+        bin, transcript, exon_lens,
+        fl_dist, read_len, min_num_mappable_bases=1 ):
+    """Estimate the paired read density for a single bin.
+
+    """
+    bnds = calc_paired_read_bin_start_and_stop_bnds( 
+        bin, transcript, exon_lens, read_len, fl_dist.fl_max, 
+        min_num_mappable_bases )
+    density = estimate_num_paired_reads_from_bnds( 
+        *([x,] for x in bnds), fl_dist=fl_dist )[0]
     if DEBUG:
         print "Density", density
         print
     
-    #DEBUG = False
     return float( density )
 
+def _remove_cache_files(fnames):
+    for fname in fnames:
+        # another process may have already removed it
+        try: os.remove(fname)
+        except OSError: pass
+    return
+
+def prune_cache_dir(cache_dir, shard_suffixes, max_size):
+    """Delete the orphaned and the least recently used shards in cache_dir.
+
+    A shard is the set of files whose names only differ by their suffix, and
+    it is complete if it has a file for every suffix in shard_suffixes. 
+    Incomplete shards and temporary files that are older than 
+    MIN_ORPHANED_CACHE_SHARD_AGE are deleted. Then, if max_size is not None,
+    complete shards are deleted in order of their last modification time (the
+    caches touch the shards that they use) until they use at most max_size 
+    bytes.
+    """
+    shards = defaultdict(list)
+    for fname in os.listdir(cache_dir):
+        base, suffix = os.path.splitext(fname)
+        if suffix != '.tmp' and suffix not in shard_suffixes: continue
+        fname = os.path.join(cache_dir, fname)
+        try: stat = os.stat(fname)
+        except OSError: continue
+        # every temporary file is its own shard, so that it's never complete
+        if suffix == '.tmp': base = fname
+        shards[base].append((fname, suffix, stat.st_size, stat.st_mtime))
+    
+    complete_shards = []
+    for files in shards.itervalues():
+        fnames, suffixes, sizes, mtimes = zip(*files)
+        if set(suffixes) == set(shard_suffixes):
+            complete_shards.append((max(mtimes), sum(sizes), fnames))
+        elif time.time() - max(mtimes) > MIN_ORPHANED_CACHE_SHARD_AGE:
+            _remove_cache_files(fnames)
+    
+    if max_size is None: return
+    complete_shards.sort()
+    total_size = sum(size for mtime, size, fnames in complete_shards)
+    for mtime, size, fnames in complete_shards:
+        if total_size <= max_size: break
+        _remove_cache_files(fnames)
+        total_size -= size
+    return
+
+def touch_cache_file(fname):
+    """Mark fname as recently used.
+
+    """
+    try: os.utime(fname, None)
+    except OSError: pass
+    return
+
+class BinDensityCache(object):
+    """A process wide memo of paired read bin densities.
+
+    The density of a paired read bin only depends on the lengths of the 
+    exons that the reads (and the fragment) cover, the fragment length 
+    distribution and the read length, so densities are shared between genes.
+    Densities are kept in a LRU dict. If a cache directory is set, then the 
+    densities are also loaded from, and saved to, shard files in that 
+    directory, which shares them between the design matrix workers and 
+    across runs on the same library. Setting the cache directory prunes it 
+    in the same way as the design matrix cache.
+    """
+    def __init__(self, max_num_entries=MAX_NUM_CACHED_BIN_DENSITIES):
+        self.max_num_entries = max_num_entries
+        self.cache_dir = None
+        self.num_hits = 0
+        self.num_misses = 0
+        self._densities = OrderedDict()
+        self._loaded_signatures = set()
+        self._unsaved_densities = defaultdict(dict)
+        self._num_unsaved_densities = 0
+        return
+    
+    def set_cache_dir(self, cache_dir, max_size=None):
+        if cache_dir is not None:
+            if not os.path.exists(cache_dir):
+                try: os.makedirs(cache_dir)
+                except OSError:
+                    # another process may have created it
+                    if not os.path.exists(cache_dir): raise
+            prune_cache_dir(cache_dir, (".densities",), max_size)
+        self.cache_dir = cache_dir
+        self._loaded_signatures = set()
+        return
+    
+    @staticmethod
+    def signature(fl_dist, read_len, min_num_mappable_bases):
+        """Return a hash of everything, except the exon lengths, that a 
+           paired read bin density depends on.
+        """
+        md5 = hashlib.md5()
+        md5.update(repr((fl_dist.fl_min, fl_dist.fl_max, 
+                         read_len, min_num_mappable_bases)))
+        md5.update(numpy.asarray(fl_dist.fl_density, dtype=float).tostring())
+        return md5.hexdigest()
+    
+    def _insert(self, key, density):
+        self._densities[key] = density
+        if len(self._densities) > self.max_num_entries:
+            self._densities.popitem(last=False)
+        return
+    
+    def load(self, signature):
+        """Load the saved densities for signature from the cache directory.
+
+        """
+        self._loaded_signatures.add(signature)
+        if self.cache_dir is None: return
+        for fname in os.listdir(self.cache_dir):
+            if not fname.startswith(signature + ".") \
+                    or not fname.endswith(".densities"):
+                continue
+            fname = os.path.join(self.cache_dir, fname)
+            try:
+                with open(fname) as fp:
+                    densities = pickle.load(fp)
+                touch_cache_file(fname)
+            except Exception, inst:
+                config.log_statement( 
+                    "Skipping bin density cache file '%s': %s" % (
+                        fname, inst), log=True )
+                continue
+            for key, density in densities.iteritems():
+                self._insert((signature, key), density)
+        return
+    
+    def get(self, signature, key):
+        """Return the cached density, or None if it isn't in the cache.
+
+        """
+        if signature not in self._loaded_signatures:
+            self.load(signature)
+        try: 
+            density = self._densities.pop((signature, key))
+        except KeyError:
+            self.num_misses += 1
+            return None
+        # re-insert the density to mark it as recently used
+        self._densities[(signature, key)] = density
+        self.num_hits += 1
+        return density
+    
+    def set(self, signature, key, density):
+        self._insert((signature, key), density)
+        self._unsaved_densities[signature][key] = density
+        self._num_unsaved_densities += 1
+        if self._num_unsaved_densities > self.max_num_entries:
+            self.save()
+        return
+    
+    def save(self):
+        """Write the densities added since the last save into new shards.
+
+        """
+        if self.cache_dir is not None:
+            for signature, densities in self._unsaved_densities.iteritems():
+                # write to a temporary file and then move it, so that other 
+                # processes never load a partially written shard
+                fd, tmp_fname = tempfile.mkstemp(
+                    prefix=signature+".", suffix=".tmp", dir=self.cache_dir)
+                with os.fdopen(fd, "w") as fp:
+                    pickle.dump(densities, fp, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_fname, tmp_fname[:-len(".tmp")] + ".densities")
+        self._unsaved_densities = defaultdict(dict)
+        self._num_unsaved_densities = 0
+        return
+
+BIN_DENSITY_CACHE = BinDensityCache()
+
+class DesignMatrixCache(object):
+    """A persistent cache of the clustered expected RNAseq arrays.
+
+    The entries are keyed by a hash of the gene structure, the fragment 
+    length distributions and the read lengths. Each process appends its new 
+    entries to its own ArrayStore shard in the cache directory, and writes 
+    the shard's index (the location of every entry) when save is called. 
+    The indices of the saved shards are loaded when the cache directory is 
+    set, which should be done before forking so that the workers share them,
+    and entries are loaded from the memory mapped shards. If the cache 
+    directory is None then nothing is cached.
+
+    Setting the cache directory also deletes the stores of processes that 
+    died before writing their index, and (if max_size is set) the least 
+    recently used shards, so that the directory doesn't grow without bound. 
+    Shards written during a run can exceed max_size until the next run.
+    """
+    def __init__(self):
+        self.cache_dir = None
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entry_locs = {}
+        self._stores = {}
+        self._store = None
+        self._store_pid = None
+        self._unsaved_entry_locs = {}
+        return
+    
+    def set_cache_dir(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self._entry_locs = {}
+        self._stores = {}
+        if cache_dir is None: return
+        if not os.path.exists(cache_dir):
+            try: os.makedirs(cache_dir)
+            except OSError:
+                # another process may have created it
+                if not os.path.exists(cache_dir): raise
+        
+        prune_cache_dir(cache_dir, (".store", ".index"), max_size)
+        for fname in os.listdir(cache_dir):
+            if not fname.endswith(".index"): continue
+            store_fname = os.path.join(
+                cache_dir, fname[:-len(".index")] + ".store")
+            if not os.path.exists(store_fname): continue
+            try:
+                with open(os.path.join(cache_dir, fname)) as fp:
+                    entry_locs = pickle.load(fp)
+            except Exception, inst:
+                config.log_statement( 
+                    "Skipping design matrix cache index '%s': %s" % (
+                        fname, inst), log=True )
+                continue
+            for key, (offset, size) in entry_locs.iteritems():
+                self._entry_locs[key] = (store_fname, offset, size)
+        return
+    
+    @staticmethod
+    def key(exon_boundaries, transcripts, fl_dists):
+        """Return a hash of everything that the expected RNAseq array
+           depends on.
+        """
+        md5 = hashlib.md5()
+        md5.update(repr((DESIGN_MATRIX_CACHE_VERSION, MIN_NUM_MAPPABLE_BASES)))
+        md5.update(repr(numpy.diff(exon_boundaries).tolist()))
+        md5.update(repr([tuple(t) for t in transcripts]))
+        for (rg, (r1_len, r2_len)), (fl_dist, marginal_frac) in sorted(
+                fl_dists.iteritems()):
+            md5.update(repr((rg, r1_len, r2_len, marginal_frac)))
+            md5.update(BinDensityCache.signature(
+                fl_dist, r1_len, MIN_NUM_MAPPABLE_BASES))
+        return md5.hexdigest()
+    
+    def get(self, key):
+        """Return the cached (bins, expected array, bin clusters, 
+           unobservable transcripts), or None if key isn't in the cache.
+        """
+        if self.cache_dir is None: return None
+        try: 
+            store_fname, offset, size = self._entry_locs[key]
+        except KeyError:
+            self.num_misses += 1
+            return None
+        
+        if store_fname not in self._stores:
+            touch_cache_file(store_fname)
+            self._stores[store_fname] = ArrayStore(store_fname, truncate=False)
+        ( bins, shape, unobservable_transcripts ), arrays = \
+            self._stores[store_fname].load(offset, size)
+        if shape is None:
+            expected_array = None
+        else:
+            data, indices, indptr = arrays[:3]
+            expected_array = scipy.sparse.csr_matrix(
+                (data, indices, indptr), shape=shape, copy=False)
+        self.num_hits += 1
+        return bins, expected_array, arrays[-1], unobservable_transcripts
+    
+    def set(self, key, bins, expected_array, bin_clusters, 
+            unobservable_transcripts):
+        if self.cache_dir is None: return
+        # every process writes into its own shard
+        if self._store is None or self._store_pid != os.getpid():
+            fd, store_fname = tempfile.mkstemp(
+                prefix="%i." % os.getpid(), suffix=".store", 
+                dir=self.cache_dir)
+            os.close(fd)
+            self._store = ArrayStore(store_fname)
+            self._store_pid = os.getpid()
+            self._unsaved_entry_locs = {}
+        
+        if expected_array is None:
+            shape, arrays = None, []
+        else:
+            shape = expected_array.shape
+            arrays = [ expected_array.data, expected_array.indices, 
+                       expected_array.indptr ]
+        arrays.append(bin_clusters)
+        offset, size = self._store.append(
+            (bins, shape, unobservable_transcripts), arrays)
+        self._entry_locs[key] = (self._store.fname, offset, size)
+        self._unsaved_entry_locs[key] = (offset, size)
+        return
+    
+    def save(self):
+        """Write the index of this process's shard.
+
+        """
+        if self.cache_dir is None or self._store is None \
+                or self._store_pid != os.getpid():
+            return
+        index_fname = self._store.fname[:-len(".store")] + ".index"
+        # write to a temporary file and then move it, so that a partially
+        # written index is never loaded
+        with open(index_fname + ".tmp", "wb") as fp:
+            pickle.dump(self._unsaved_entry_locs, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(index_fname + ".tmp", index_fname)
+        return
+
+DESIGN_MATRIX_CACHE = DesignMatrixCache()
+
 def calc_expected_cnts( exon_boundaries, transcripts, fl_dist, 
                         r1_len, r2_len,
                         max_num_unmappable_bases=MIN_NUM_MAPPABLE_BASES,
@@ -438,8 +822,7 @@ def calc_expected_cnts( exon_boundaries, transcripts, fl_dist,
     assert r1_len == r2_len, "Paired reads must have the same lengths"
     read_len = r1_len
     
-    # store all counts, and count vectors. Indexed by ( 
-    # read_group, read_len, bin )
+    # the index of every distinct full_bin/bin combo into the bounds array
     cached_f_mat_entries = {}
     f_mat_entries = {}
     
@@ -447,13 +830,18 @@ def calc_expected_cnts( exon_boundaries, transcripts, fl_dist,
         numpy.array([ stop - start for start, stop in 
                       izip(exon_boundaries[:-1], exon_boundaries[1:])])
     
+    # the design matrix is stored sparsely, so we bound the memory usage
+    # by the number of (possibly) non-zero entries
+    num_entries = 0
+    # the full_bin/bin combos that each transcript can produce
+    transcripts_keys = []
     # for each candidate trasncript
     for transcript_index, nonoverlapping_indices in enumerate(transcripts):
-        if (len(exon_boundaries)*len(transcripts)*8.)/(1024**3) > max_memory_usage:
+        if (num_entries*BYTES_PER_DESIGN_MATRIX_ENTRY)/(1024.**3) \
+                > max_memory_usage:
             raise MemoryError, \
                 "Building the design matrix has exceeded the maximum allowed memory "
         nonoverlapping_indices = tuple(nonoverlapping_indices)
-        f_mat_entries[nonoverlapping_indices] = {}
         # find all of the possible read bins for transcript given this 
         # fl_dist and read length
         ( full, pair, single 
@@ -461,25 +849,59 @@ def calc_expected_cnts( exon_boundaries, transcripts, fl_dist,
             nonoverlapping_indices, nonoverlapping_exon_lens, fl_dist, 
             read_len, min_num_mappable_bases=1 )
         
-        # add the expected counts for paired reads
-        for full_bin, paired_bins in pair.iteritems():
-            for bin in paired_bins:
-                # we can only re-use cached full_bin/bin combos
-                # because it's possible for the middle of a fragment
-                # to skip a region in one transcript, and be spliced
-                # out in another transcript
-                key = (full_bin, bin)
-                if key in cached_f_mat_entries:
-                    pseudo_cnt = cached_f_mat_entries[ key ]
-                else:
-                    pseudo_cnt = estimate_num_paired_reads_from_bin(
-                        bin, full_bin, 
-                        nonoverlapping_exon_lens, fl_dist,
-                        read_len, max_num_unmappable_bases )
-
-                    cached_f_mat_entries[ key ] = pseudo_cnt
-                if pseudo_cnt > 0:
-                    f_mat_entries[nonoverlapping_indices][bin] = pseudo_cnt
+        # we can only re-use full_bin/bin combos because it's possible for 
+        # the middle of a fragment to skip a region in one transcript, and 
+        # be spliced out in another transcript
+        keys = [ (full_bin, bin) for full_bin, paired_bins in pair.iteritems()
+                 for bin in paired_bins ]
+        for key in keys:
+            if key not in cached_f_mat_entries:
+                cached_f_mat_entries[key] = len(cached_f_mat_entries)
+        transcripts_keys.append( (nonoverlapping_indices, keys) )
+        num_entries += len(keys)
+    
+    # look up the distinct full_bin/bin combos in the bin density cache, 
+    # keyed by the lengths of the first read, second read and pre second 
+    # read exons
+    signature = BIN_DENSITY_CACHE.signature(
+        fl_dist, read_len, max_num_unmappable_bases)
+    pseudo_cnts = numpy.zeros(len(cached_f_mat_entries))
+    uncached_entries = []
+    exon_lens = nonoverlapping_exon_lens.tolist()
+    for (full_bin, bin), i in cached_f_mat_entries.iteritems():
+        exon_lens_key = (
+            tuple([exon_lens[j] for j in bin[0]]),
+            tuple([exon_lens[j] for j in bin[1]]),
+            sum([ exon_lens[j] for j in full_bin 
+                  if j < bin[1][0] and j >= bin[0][0] ]) )
+        pseudo_cnt = BIN_DENSITY_CACHE.get(signature, exon_lens_key)
+        if pseudo_cnt is None:
+            uncached_entries.append( ((full_bin, bin), i, exon_lens_key) )
+        else:
+            pseudo_cnts[i] = pseudo_cnt
+    
+    # find the start and stop bounds for every uncached full_bin/bin combo, 
+    # and then estimate all of their densities in one call
+    bnds = numpy.zeros((len(uncached_entries), 4), dtype=int)
+    for entry_i, ((full_bin, bin), i, exon_lens_key) in enumerate(
+            uncached_entries):
+        bnds[entry_i,:] = calc_paired_read_bin_start_and_stop_bnds( 
+            bin, full_bin, nonoverlapping_exon_lens, read_len, 
+            fl_dist.fl_max, max_num_unmappable_bases )
+    uncached_pseudo_cnts = estimate_num_paired_reads_from_bnds( 
+        bnds[:,0], bnds[:,1], bnds[:,2], bnds[:,3], fl_dist )
+    for (key, i, exon_lens_key), pseudo_cnt in izip(
+            uncached_entries, uncached_pseudo_cnts):
+        pseudo_cnts[i] = pseudo_cnt
+        BIN_DENSITY_CACHE.set(signature, exon_lens_key, float(pseudo_cnt))
+    
+    # add the expected counts for paired reads
+    for nonoverlapping_indices, keys in transcripts_keys:
+        f_mat_entries[nonoverlapping_indices] = {}
+        for key in keys:
+            pseudo_cnt = float(pseudo_cnts[cached_f_mat_entries[key]])
+            if pseudo_cnt > 0:
+                f_mat_entries[nonoverlapping_indices][key[1]] = pseudo_cnt
     
     return f_mat_entries
 
@@ -519,59 +941,76 @@ def build_observed_cnts( binned_reads, fl_dists ):
     
     return rv
 
+def iter_transcript_cnts( transcript_cnts ):
+    """Iterate over the (transcript, cnt) pairs of a single bin.
+
+    The counts are either a dict keyed by transcript, or a list indexed by
+    transcript index.
+    """
+    if isinstance( transcript_cnts, dict ):
+        return transcript_cnts.iteritems()
+    return enumerate( transcript_cnts )
+
 def build_expected_and_observed_arrays( 
         expected_cnts, observed_cnts, normalize=True ):
-    expected_mat = []
-    observed_mat = []
+    """Build the expected and observed arrays from the bin counts. 
+
+    The expected array is a sparse (csr) matrix with a row for every bin, 
+    and a column for every transcript (both in sorted order). The observed
+    array is a dense array of counts.
+    """
     unobservable_transcripts = set()
     
+    bins = sorted(expected_cnts.iterkeys())
+    if len( bins ) == 0:
+        raise ValueError, "No expected reads."
+    
     # find and sort all transcripts
     transcripts = set()
-    for bin, transcript_cnts in sorted(expected_cnts.iteritems()):
-        for transcript in transcript_cnts:
+    for transcript_cnts in expected_cnts.itervalues():
+        for transcript, cnt in iter_transcript_cnts(transcript_cnts):
             transcripts.add(transcript)
-    transcripts = sorted(transcripts)
-
-    # turn the cnts into a more structured format
-    for bin, transcript_cnts in sorted(expected_cnts.iteritems()):
-        expected_cnts = [transcript_cnts[t] for t in transcripts]
-        expected_mat.append( expected_cnts )
-        try:
-            observed_mat.append( observed_cnts[bin] )
-        except KeyError:
-            observed_mat.append( 0 )
-    
-    if len( expected_mat ) == 0:
-        raise ValueError, "No expected reads."
-    
-    expected_mat = numpy.array( expected_mat, dtype=numpy.double )
+    transcript_indices = dict( 
+        (transcript, i) for i, transcript in enumerate(sorted(transcripts)))
+    
+    # turn the cnts into coordinate format, skipping the zero entries
+    rows, cols, vals = array('l'), array('l'), array('d')
+    observed_mat = numpy.zeros( len(bins), dtype=numpy.int )
+    for bin_i, bin in enumerate(bins):
+        for transcript, cnt in iter_transcript_cnts(expected_cnts[bin]):
+            if cnt == 0: continue
+            rows.append( bin_i )
+            cols.append( transcript_indices[transcript] )
+            vals.append( cnt )
+        observed_mat[bin_i] = observed_cnts.get(bin, 0)
+    
+    expected_mat = scipy.sparse.csr_matrix( 
+        ( numpy.frombuffer(vals, dtype=numpy.double), 
+          ( numpy.frombuffer(rows, dtype=numpy.int), 
+            numpy.frombuffer(cols, dtype=numpy.int) ) ), 
+        shape=(len(bins), len(transcript_indices)), dtype=numpy.double )
     if normalize:
-        nonzero_entries = expected_mat.sum(0).nonzero()[0]
-        unobservable_transcripts = set(range(expected_mat.shape[1])) \
-            - set(nonzero_entries.tolist())
-        expected_mat = expected_mat/(expected_mat.sum(0)+1e-12)
+        col_sums = numpy.asarray(expected_mat.sum(0)).ravel()
+        unobservable_transcripts = set((col_sums == 0).nonzero()[0].tolist())
+        expected_mat = expected_mat*scipy.sparse.diags(1./(col_sums+1e-12))
+        expected_mat = expected_mat.tocsr()
     
-    observed_mat = numpy.array( observed_mat, dtype=numpy.int )
     return expected_mat, observed_mat, unobservable_transcripts
 
-def build_expected_and_observed_rnaseq_counts(gene, reads, fl_dists):
-    # find the set of non-overlapping exons, and convert the transcripts to 
-    # lists of these non-overlapping indices. All of the f_matrix code uses
-    # this representation.     
+def find_nonoverlapping_exons(gene):
+    """Find the set of non-overlapping exons, and convert the transcripts to
+       lists of these non-overlapping indices. 
+
+    All of the f_matrix code uses this representation. Returns the exon 
+    boundaries, and the list of transcripts' non-overlapping exon indices.
+    """
     exon_boundaries = numpy.array(gene.find_nonoverlapping_boundaries())
     transcripts_non_overlapping_exon_indices =list(build_nonoverlapping_indices(
             gene.transcripts, exon_boundaries ))
-    
-    binned_reads = bin_rnaseq_reads( 
-        reads, gene.chrm, gene.strand, exon_boundaries)
-    observed_cnts = build_observed_cnts( binned_reads, fl_dists )    
-    read_groups_and_read_lens =  set( (RG, read_len) for RG, read_len, bin 
-                                        in binned_reads.iterkeys() )
-    """
-    # TODO XXX
-    print exon_boundaries
-    print observed_cnts.values()
-    """
+    return exon_boundaries, transcripts_non_overlapping_exon_indices
+
+def build_expected_rnaseq_counts(
+        exon_boundaries, transcripts_non_overlapping_exon_indices, fl_dists):
     expected_cnts = defaultdict(lambda: defaultdict(float))
     for (rg, (r1_len,r2_len)), (fl_dist, marginal_frac) in fl_dists.iteritems():
         for transcript, read_bins_and_vals in calc_expected_cnts( 
@@ -582,7 +1021,48 @@ def build_expected_and_observed_rnaseq_counts(gene, reads, fl_dists):
                 expected_cnts[(r1_len, rg, read_bin)][transcript] += (
                     marginal_frac*expected_bin_cnt )
 
-    return dict(expected_cnts), observed_cnts
+    return dict(expected_cnts)
+
+def build_expected_and_observed_rnaseq_counts(gene, reads, fl_dists):
+    exon_boundaries, transcripts_non_overlapping_exon_indices = \
+        find_nonoverlapping_exons(gene)
+    
+    binned_reads = bin_rnaseq_reads( 
+        reads, gene.chrm, gene.strand, exon_boundaries)
+    observed_cnts = build_observed_cnts( binned_reads, fl_dists )    
+    expected_cnts = build_expected_rnaseq_counts(
+        exon_boundaries, transcripts_non_overlapping_exon_indices, fl_dists)
+    
+    return expected_cnts, observed_cnts
+
+def build_clustered_expected_rnaseq_array(
+        exon_boundaries, transcripts_non_overlapping_exon_indices, fl_dists):
+    """Build the (normalized and clustered) expected RNAseq array.
+
+    This only depends on the gene structure and the fragment length 
+    distributions, so it can be cached between runs. Returns the sorted 
+    bins, the expected array, the index of every bin's cluster (ie row in the
+    expected array), and the set of unobservable transcripts. If no bins are
+    observable then the expected array is None.
+    """
+    expected_cnts = build_expected_rnaseq_counts(
+        exon_boundaries, transcripts_non_overlapping_exon_indices, fl_dists)
+    if len(expected_cnts) == 0:
+        return [], None, numpy.zeros(0, dtype=int), set()
+    
+    bins = sorted(expected_cnts.iterkeys())
+    expected_array, observed_array, unobservable_transcripts = \
+        build_expected_and_observed_arrays( 
+            expected_cnts, {}, normalize=True ) 
+    del expected_cnts
+    
+    if config.DEBUG_VERBOSE:
+        config.log_statement( "Clustering bins in RNAseq array" )
+    bin_clusters, clusters = find_row_clusters(expected_array)
+    expected_array = sum_clustered_rows(
+        expected_array, bin_clusters, len(clusters))
+    
+    return bins, expected_array, bin_clusters, unobservable_transcripts
 
 def build_expected_and_observed_transcript_bndry_counts( 
         gene, reads, bndry_type=None ):
@@ -640,103 +1120,117 @@ def build_expected_and_observed_transcript_bndry_counts(
     
     return expected_cnts, observed_cnts
 
-def cluster_bins(expected_rnaseq_cnts):
-    if config.DEBUG_VERBOSE:
-        config.log_statement( "Normalizing bin frequencies" )
-    
-    clustered_bins = defaultdict(list)
-    for bin, transcripts_and_cnts in expected_rnaseq_cnts.items():
-        row = numpy.array([x[1] 
-                           for x in sorted(transcripts_and_cnts.iteritems())])
-        key = tuple((100000*row/row.sum()).round().tolist())
-        clustered_bins[key].append(bin)
-    return clustered_bins.values()
+# the normalized frequencies are multiplied by this, and then rounded to the
+# nearest integer, before rows are compared. So rows cluster together when 
+# their frequencies agree to within about 1/CLUSTER_FREQ_SCALE
+CLUSTER_FREQ_SCALE = 100000
 
+def find_clusters_of_identical_rows(rows):
+    """Group identical rows of the 2D integer array rows.
 
-def cluster_rows(expected_rnaseq_array, observed_rnaseq_array):
+    Returns the cluster index of every row, and the rows in each cluster.
+    """
+    if rows.shape[0] == 0:
+        return numpy.zeros(0, dtype=int), []
+    unique_rows, cluster_ids = numpy.unique(
+        rows, axis=0, return_inverse=True)
+    cluster_ids = cluster_ids.ravel()
+    # split the (stably) sorted row indices at the cluster boundaries
+    order = cluster_ids.argsort(kind='mergesort')
+    boundaries = numpy.bincount(cluster_ids).cumsum()[:-1]
+    return cluster_ids, numpy.split(order, boundaries)
+
+def cluster_bins(expected_rnaseq_cnts):
     if config.DEBUG_VERBOSE:
         config.log_statement( "Normalizing bin frequencies" )
     
-    clustered_rows = defaultdict(list)
-    for i, row in enumerate(expected_rnaseq_array):
-        key = tuple((100000*row/row.sum()).round().tolist())
-        clustered_rows[key].append(i)
-    clusters = clustered_rows.values()
-    
-    """ This worked quickly, but could use way too much memory
-    norm_rows = []
-    for i, row in enumerate(expected_rnaseq_array):
-        norm_rows.append(row/row.sum())
-        
-    if config.DEBUG_VERBOSE:
-        config.log_statement( "Building KDTree to cluster bins" )
-    tree = KDTree(numpy.vstack(norm_rows), leafsize=30)
-    
-    edges = set()
-    points = set(xrange(len(norm_rows)))
-    while len(points) > 0:
-        i = points.pop()
-        neighbors = tree.query_ball_point(norm_rows[i], 1e-6, 1)
-        for j in neighbors:
-            edges.add((i, j))
-            points.discard(j)
-        if config.DEBUG_VERBOSE and len(points)%10 == 0:
-            config.log_statement("%i rows remain to be clustered" % len(points))
-
-    graph = nx.Graph()
-    graph.add_nodes_from(xrange(expected_rnaseq_array.shape[0]))
-    graph.add_edges_from(edges)
-    clusters = nx.connected_components(graph)
-    print len(clusters)
-    print sorted(clusters)
+    bins = expected_rnaseq_cnts.keys()
+    if len(bins) == 0: return []
+    rows = [ [x[1] for x in sorted(expected_rnaseq_cnts[bin].iteritems())]
+             for bin in bins ]
+    # pad the rows into an array, after their lengths
+    lens = numpy.array([len(row) for row in rows])
+    values = numpy.zeros((len(rows), lens.max()+2), dtype=float)
+    values[:,0] = lens
+    mask = numpy.arange(lens.max()) < lens[:,None]
+    values[:,2:][mask] = list(chain(*rows))
+    row_sums = values[:,2:].sum(1)
+    # normalize and round all of the rows at once. Non-empty rows that sum 
+    # to zero can't be normalized, so each is put into its own cluster. Empty
+    # rows are all identical, and so they share a cluster
+    values[:,2:] = (CLUSTER_FREQ_SCALE*values[:,2:]/numpy.where(
+            row_sums == 0, 1, row_sums)[:,None]).round()
+    values[:,1] = numpy.where(
+        (row_sums == 0) & (lens > 0), numpy.arange(len(rows))+1, 0)
+    
+    cluster_ids, clusters = find_clusters_of_identical_rows(
+        values.astype(numpy.int64))
+    return [ [bins[i] for i in cluster] for cluster in clusters ]
+
+def find_row_clusters(expected_array):
+    """Cluster the rows of expected_array that have the same normalized 
+       frequencies. 
+
+    expected_array can be dense or sparse. The rows are normalized and 
+    rounded, and entries that round to zero are dropped, so that two rows 
+    cluster together exactly when their normalized rows would. Returns the 
+    cluster index of every row, and the rows in each cluster.
     """
-    
+    expected_array = scipy.sparse.csr_matrix(expected_array)
+    expected_array.sum_duplicates()
+    expected_array.sort_indices()
+    num_rows = expected_array.shape[0]
+    row_lens = numpy.diff(expected_array.indptr)
+    row_indices = numpy.repeat(numpy.arange(num_rows), row_lens)
+    row_sums = numpy.asarray(expected_array.sum(1)).ravel()
+    
+    # normalize and round every entry, and drop the entries that round to 0
+    values = ( CLUSTER_FREQ_SCALE*expected_array.data/numpy.where(
+            row_sums == 0, 1, row_sums)[row_indices] ).round()
+    nonzero = (values != 0)
+    values = values[nonzero].astype(numpy.int64)
+    indices = expected_array.indices[nonzero]
+    row_indices = row_indices[nonzero]
+    
+    # build the canonical signature of each row: the column indices of its 
+    # non-zero entries, and then their rounded values (padded with -1)
+    row_lens = numpy.bincount(row_indices, minlength=num_rows)
+    width = row_lens.max() if num_rows > 0 else 0
+    row_starts = row_lens.cumsum() - row_lens
+    positions = numpy.arange(len(values)) - row_starts[row_indices]
+    signatures = -numpy.ones((num_rows, 2*width), dtype=numpy.int64)
+    signatures[row_indices, positions] = indices
+    signatures[row_indices, width+positions] = values
+    
+    return find_clusters_of_identical_rows(signatures)
+
+def sum_clustered_rows(array, cluster_ids, num_clusters):
+    """Sum the rows of array (dense or sparse) in each cluster.
+
     """
-    Use the tree to find pairs. We dont use this because we only care about distance.
-    #for i, row in enumerate(norm_rows):
-    #    config.log_statement("%i/%i-%s" % (i, len(norm_rows), tree.query_ball_point(row, 1e-6, 1)))
-    pairs = tree.query_pairs(1e-6, 1)
+    if scipy.sparse.issparse(array):
+        array = array.tocoo()
+        return scipy.sparse.csr_matrix( 
+            ( array.data, (cluster_ids[array.row], array.col) ),
+            shape=(num_clusters, array.shape[1]) )
+    array = numpy.asarray(array)
+    rv = numpy.zeros((num_clusters,) + array.shape[1:], dtype=array.dtype)
+    numpy.add.at(rv, cluster_ids, array)
+    return rv
 
+def cluster_rows(expected_rnaseq_array, observed_rnaseq_array):
     if config.DEBUG_VERBOSE:
-        config.log_statement( "Finding clusters")    
-    graph = nx.Graph()
-    graph.add_nodes_from(xrange(expected_rnaseq_array.shape[0]))
-    graph.add_edges_from(pairs)
-    clusters = nx.connected_components(graph)
-    """
+        config.log_statement( "Normalizing bin frequencies" )
     
-    """
-    Brute force code for finding the matching points. This works, but is slow.
-    norm_rows = []
-    edges = []
-    for i, row in enumerate(expected_rnaseq_array):
-        if config.DEBUG_VERBOSE and i%10 == 0:
-            config.log_statement( "Clustering bin %i/%s in RNAseq array" % (
-                    i, expected_rnaseq_array.shape) )
-        norm_row = row/row.sum()
-        matching_indices = [ j for j, x in enumerate(norm_rows)
-                             if float(numpy.abs(x-norm_row).sum()) < 1e-6  ]
-        for j in matching_indices:
-            edges.append(( i, j))
-        norm_rows.append( norm_row  )
-    
-    graph = nx.Graph()
-    graph.add_nodes_from(xrange(expected_rnaseq_array.shape[0]))
-    graph.add_edges_from(edges)
-    clusters = nx.connected_components(graph)
-    print clusters
-    assert False
-    """
+    cluster_ids, clusters = find_row_clusters(expected_rnaseq_array)
+    new_expected_array = sum_clustered_rows(
+        scipy.sparse.csr_matrix(expected_rnaseq_array), 
+        cluster_ids, len(clusters))
+    new_observed_array = sum_clustered_rows(
+        numpy.asarray(observed_rnaseq_array, dtype=int), 
+        cluster_ids, len(clusters))
+    cluster_mapping = dict(enumerate(clusters))
     
-    new_expected_array = numpy.zeros( 
-        (len(clusters), expected_rnaseq_array.shape[1]) )
-    new_observed_array = numpy.zeros( len(clusters), dtype=int )
-    cluster_mapping = {}
-    for i, node in enumerate(clusters):
-        cluster_mapping[i] = node
-        new_expected_array[i,:] = expected_rnaseq_array[node,].sum(0)
-        new_observed_array[i] = observed_rnaseq_array[node].sum()
-
     return new_expected_array, new_observed_array, cluster_mapping
 
 def find_nonoverlapping_exons_covered_by_segment(exon_bndrys, start, stop):
@@ -758,6 +1252,56 @@ def find_nonoverlapping_exons_covered_by_segment(exon_bndrys, start, stop):
     return tuple(xrange( bin_1, bin_2+1 ))
  
 
+def bin_read_pair_blocks( exon_boundaries, blk_starts, blk_stops, blk_offsets,
+                          read_lens, read_grp_ids, read_grp_names,
+                          include_read_type=True ):
+    """Bin read pairs, given their aligned blocks, into non-overlapping exons.
+
+    See Reads.iter_paired_read_blocks for the format of the arguments. 
+    Returns a dict of bin counts, keyed in the same way as bin_rnaseq_reads.
+    """
+    if len(read_lens) == 0: return {}
+    
+    # find the first and last non-overlapping exon that every block 
+    # overlaps, skipping blocks that extend past the gene (see 
+    # find_nonoverlapping_exons_covered_by_segment)
+    blk_bins = exon_boundaries.searchsorted(
+        numpy.concatenate((blk_starts, blk_stops)), side='right') - 1
+    blk_first_bins = blk_bins[:len(blk_starts)]
+    blk_last_bins = blk_bins[len(blk_starts):]
+    blk_first_bins[blk_last_bins == len(exon_boundaries)-1] = -1
+    
+    rows, covered = sparsify_support_fns.bin_read_pairs(
+        numpy.ascontiguousarray(blk_first_bins, dtype=numpy.int64), 
+        numpy.ascontiguousarray(blk_last_bins, dtype=numpy.int64), 
+        numpy.ascontiguousarray(blk_offsets, dtype=numpy.int64), 
+        len(exon_boundaries))
+    # skip pairs with a read that doesn't overlap the gene, or whose mates'
+    # read lengths differ
+    keep = covered & (read_lens != -1)
+    if include_read_type:
+        rows = numpy.column_stack((read_lens, read_grp_ids, rows))
+    rows = rows[keep]
+    if len(rows) == 0: return {}
+    
+    # count the pairs in each bin, and then decode the bins
+    rows, cnts = numpy.unique(rows, axis=0, return_counts=True)
+    width = (rows.shape[1] - (2 if include_read_type else 0))//2
+    binned_reads = {}
+    for row, cnt in izip(rows.tolist(), cnts.tolist()):
+        if include_read_type:
+            rlen, rg_id, row = row[0], row[1], row[2:]
+        bin1 = tuple(row[1:1+row[0]])
+        bin2 = tuple(row[width+1:width+1+row[width]])
+        if include_read_type: 
+            rg = None if rg_id == -1 else read_grp_names[rg_id]
+            key = ( rlen, rg, tuple(sorted((bin1,bin2))) )
+        else: 
+            key = tuple(sorted((bin1,bin2)))
+        binned_reads[key] = binned_reads.get(key, 0) + cnt
+    
+    return binned_reads
+
 def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=True ):
     """Bin reads into non-overlapping exons.
 
@@ -766,63 +1310,17 @@ def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=Tr
     """
     if not reads.reads_are_stranded: strand = '.'
     
-    # first get the paired reads
     gene_start = int(exon_boundaries[0])
     gene_stop = int(exon_boundaries[-1])
-    paired_reads = list( reads.iter_paired_reads(
-            chrm, strand, gene_start, gene_stop+1) )
-    #config.log_statement("querying for RNAseq reads from %s: %s:%s-%s:%s, found %s reads" % 
-        #(','.join([read.filename for read in reads._reads]), chrm,  gene_start, gene_stop+1, strand, len(paired_reads)))
-    
-    # find the unique subset of contiguous read sub-locations
-    read_locs = set()
-    for r in chain(*paired_reads):
-        for start, stop in iter_coverage_intervals_for_read( r ):
-            read_locs.add( (start, stop) )
-    
-    # build a mapping from contiguous regions into the non-overlapping exons (
-    # ie, exon segments ) that they overlap
-    read_locs_into_bins = {}
-    for start, stop in read_locs:
-        read_locs_into_bins[(start, stop)] = \
-            find_nonoverlapping_exons_covered_by_segment( 
-                exon_boundaries, start, stop )
-
-    def build_bin_for_read( read ):
-        bin = set()
-        for start, stop in iter_coverage_intervals_for_read( read ):
-            bin.update( read_locs_into_bins[(start, stop)] )
-        return tuple(sorted(bin))
-    
-    # finally, aggregate the bins
     binned_reads = defaultdict( int )
-    for r1, r2 in paired_reads:
-        if r1.rlen == 0: 
-            rlen = sum( x[1] for x in r1.cigar if x[0] == 0 )
-        else: 
-            rlen = r1.rlen
-            if rlen != r2.rlen:
-                if config.DEBUG_VERBOSE:
-                    config.log_statement(
-                        "WARNING: read lengths are not the same for %s and %s" % (
-                            r1.qname, r2.qname),
-                        log=True, display=False)
-                    config.log_statement(
-                        str(r1), log=True, display=False)
-                    config.log_statement(
-                        str(r2), log=True, display=False)                    
-                continue
-        
-        rg = get_read_group( r1, r2 )
-        bin1 = build_bin_for_read( r1 )
-        bin2 = build_bin_for_read( r2 )
-        # skip any reads that don't completely overlap the gene
-        if bin1 == () or bin2== () or any(x==() for x in chain(bin1, bin2)): continue
-        assert len(bin1) > 0
-        assert len(bin2) > 0
-        if include_read_type: key = ( rlen, rg, tuple(sorted((bin1,bin2))))
-        else: key = tuple(sorted((bin1,bin2)))
-        binned_reads[key] += 1
+    # the pairs' aligned blocks are found for every bam (from its read index,
+    # if it has one), and are binned in a single pass
+    for read_pair_blocks in reads.iter_paired_read_blocks(
+            chrm, strand, gene_start, gene_stop+1):
+        for key, cnt in bin_read_pair_blocks( 
+                exon_boundaries, *read_pair_blocks, 
+                include_read_type=include_read_type ).iteritems():
+            binned_reads[key] += cnt
     
     #config.log_statement("binned_reads=%s" % dict(binned_reads))
     return dict(binned_reads)
@@ -892,38 +1390,56 @@ def find_expected_single_bin_freqs(exon_boundaries, read_lens_and_bins):
         bin_counts[(read_len, bin_indices)] = num_frags
     return bin_counts
 
+def load_clustered_expected_rnaseq_array(
+        exon_boundaries, transcripts_non_overlapping_exon_indices, fl_dists):
+    """Load the clustered expected RNAseq array from the design matrix 
+       cache, or build (and cache) it if it isn't there.
+
+    """
+    cache_key = DESIGN_MATRIX_CACHE.key(
+        exon_boundaries, transcripts_non_overlapping_exon_indices, fl_dists)
+    cached = DESIGN_MATRIX_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    rv = build_clustered_expected_rnaseq_array(
+        exon_boundaries, transcripts_non_overlapping_exon_indices, fl_dists)
+    DESIGN_MATRIX_CACHE.set(cache_key, *rv)
+    return rv
+
 class DesignMatrix(object):
     def filter_design_matrix(self):        
         return
     
-    def _build_rnaseq_arrays(self, gene, rnaseq_reads, fl_dists):
-        # bin the rnaseq reads
-        expected_rnaseq_cnts, observed_rnaseq_cnts = \
-            build_expected_and_observed_rnaseq_counts( 
-                gene, rnaseq_reads, fl_dists )
-        clustered_bins = cluster_bins(expected_rnaseq_cnts)
-        #for cluster in clustered_bins:
-        #    print cluster
-        #print
+    def _build_rnaseq_arrays(self, gene, rnaseq_reads, fl_dists, 
+                             expected_rnaseq_arrays=None):
+        exon_boundaries, transcripts_non_overlapping_exon_indices = \
+            find_nonoverlapping_exons(gene)
+        
+        # the expected array only depends on the gene structure and the 
+        # fl dists, so it may have already been built (or cached) 
+        if expected_rnaseq_arrays is None:
+            expected_rnaseq_arrays = load_clustered_expected_rnaseq_array(
+                exon_boundaries, transcripts_non_overlapping_exon_indices,
+                fl_dists)
+        ( bins, expected_rnaseq_array, bin_clusters, 
+          unobservable_rnaseq_trans ) = expected_rnaseq_arrays
         
         # if no transcripts are observable given the fl dist, then return nothing
-        if len( expected_rnaseq_cnts ) == 0:
+        if expected_rnaseq_array is None:
             self.array_types.append('RNASeq')
             self.obs_cnt_arrays.append(None)
             self.expected_freq_arrays.append(None)
             return 
         
-        # build the expected and observed counts, and convert them to frequencies
-        ( expected_rnaseq_array, observed_rnaseq_array, unobservable_rnaseq_trans ) = \
-              build_expected_and_observed_arrays( 
-                expected_rnaseq_cnts, observed_rnaseq_cnts, normalize=True ) 
-
-        del expected_rnaseq_cnts, observed_rnaseq_cnts
-        
-        if config.DEBUG_VERBOSE:
-            config.log_statement( "Clustering bins in RNAseq array" )
-        expected_rnaseq_array, observed_rnaseq_array, clusters = cluster_rows(
-            expected_rnaseq_array, observed_rnaseq_array)
+        # bin the rnaseq reads, and sum the observed counts in each cluster
+        binned_reads = bin_rnaseq_reads( 
+            rnaseq_reads, gene.chrm, gene.strand, exon_boundaries)
+        observed_rnaseq_cnts = build_observed_cnts( binned_reads, fl_dists )
+        observed_rnaseq_array = numpy.zeros(
+            expected_rnaseq_array.shape[0], dtype=int)
+        numpy.add.at(observed_rnaseq_array, bin_clusters, 
+                     [observed_rnaseq_cnts.get(bin, 0) for bin in bins])
         
         self.array_types.append('RNASeq')
         self.obs_cnt_arrays.append(observed_rnaseq_array)
@@ -946,6 +1462,53 @@ class DesignMatrix(object):
         self.unobservable_transcripts.update(unobservable_trans)
         return
     
+    def split_arrays(self):
+        """Split the expected and observed arrays out of the design matrix.
+
+        Returns a copy of the design matrix with the arrays removed, and 
+        the list of removed arrays (the csr data, indices and indptr of every
+        expected array, followed by its observed counts). This allows the
+        arrays to be stored without being pickled, see join_arrays.
+        """
+        f_mat = copy.copy(self)
+        f_mat.expected_freq_arrays = []
+        f_mat.obs_cnt_arrays = None
+        # the stacked arrays are re-built on demand
+        f_mat._expected_and_observed = None
+        f_mat._cached_bam_cnts = None
+        f_mat._cached_indices = None
+        
+        arrays = []
+        for expected, observed in izip(
+                self.expected_freq_arrays, self.obs_cnt_arrays):
+            if expected is None:
+                f_mat.expected_freq_arrays.append(None)
+                continue
+            expected = scipy.sparse.csr_matrix(expected)
+            f_mat.expected_freq_arrays.append(expected.shape)
+            arrays.extend((expected.data, expected.indices, expected.indptr, 
+                           numpy.asarray(observed)))
+        return f_mat, arrays
+
+    def join_arrays(self, arrays):
+        """Restore the arrays removed by split_arrays (in place).
+
+        """
+        arrays = iter(arrays)
+        expected_arrays, obs_cnt_arrays = [], []
+        for shape in self.expected_freq_arrays:
+            if shape is None:
+                expected_arrays.append(None)
+                obs_cnt_arrays.append(None)
+                continue
+            data, indices, indptr, observed = [next(arrays) for i in xrange(4)]
+            expected_arrays.append(scipy.sparse.csr_matrix(
+                (data, indices, indptr), shape=shape, copy=False))
+            obs_cnt_arrays.append(observed)
+        self.expected_freq_arrays = expected_arrays
+        self.obs_cnt_arrays = obs_cnt_arrays
+        return self
+    
     def transcript_indices(self):
         """Sorted list transcript indices that the expected array was built for.
         """
@@ -978,38 +1541,56 @@ class DesignMatrix(object):
         
         # stack all of the arrays, and filter out transcripts to skip
         exp_arrays_to_stack = []
-        obs_arrays_to_stack = []
         for i, (expected, observed) in enumerate(izip(
                 self.expected_freq_arrays, self.obs_cnt_arrays)):
             if expected is None:
                 assert observed is None
                 continue
             if bam_cnts is not None: 
-                #obs_arrays_to_stack.append( bam_cnts[i]-sum(observed) )
-                observed = numpy.hstack((bam_cnts[i]-sum(observed), observed))
-                expected = numpy.vstack(
-                    (numpy.zeros(expected.shape[1]), expected))
-                #print "zeros", numpy.zeros((expected.shape[0], 1)).shape, expected.shape,
-                expected = numpy.hstack(
-                    (numpy.zeros((expected.shape[0], 1)), expected))
-                #print expected.shape,
-                expected[0,0] = 1
+                # add an out of gene bin, that only the out of gene 
+                # transcript can produce reads in
+                expected = scipy.sparse.bmat(
+                    [[scipy.sparse.csr_matrix(numpy.ones((1,1))), None],
+                     [None, expected]], format='csr')
             
             exp_arrays_to_stack.append(expected)
-            obs_arrays_to_stack.append(observed)
 
         # stack all of the data type arrays
-        expected = numpy.vstack(exp_arrays_to_stack)[:,indices]
-        observed = numpy.hstack(obs_arrays_to_stack)
+        expected = scipy.sparse.vstack(
+            exp_arrays_to_stack, format='csr')[:,indices]
+        observed = self._stack_observed(bam_cnts)
         
         # find which bins have 0 expected reads
-        bins_to_keep = (expected.sum(1) > 1e-6)
+        bins_to_keep = (
+            numpy.asarray(expected.sum(1)).ravel() > 1e-6).nonzero()[0]
         self._expected_and_observed = (
-            expected[bins_to_keep,], observed[bins_to_keep])
+            expected[bins_to_keep,].tocsr(), observed[bins_to_keep])
         self._cached_bam_cnts = bam_cnts
         self._cached_indices = indices
+        self._cached_bins_to_keep = bins_to_keep
         return self._expected_and_observed
 
+    def _stack_observed(self, bam_cnts=None):
+        obs_arrays_to_stack = []
+        for i, (expected, observed) in enumerate(izip(
+                self.expected_freq_arrays, self.obs_cnt_arrays)):
+            if expected is None: continue
+            if bam_cnts is not None: 
+                observed = numpy.hstack((bam_cnts[i]-sum(observed), observed))
+            obs_arrays_to_stack.append(observed)
+        return numpy.hstack(obs_arrays_to_stack)
+    
+    def shares_expected_arrays(self, other):
+        """Return True if other was built with the same expected arrays, and
+           has the same filtered transcripts, as this design matrix.
+
+        """
+        return ( len(self.expected_freq_arrays) == len(
+                    other.expected_freq_arrays)
+                 and all( x is y for x, y in izip(
+                    self.expected_freq_arrays, other.expected_freq_arrays) )
+                 and self.filtered_transcripts == other.filtered_transcripts )
+
     def find_transcripts_to_filter(self,expected,observed,max_num_transcripts):
         # cluster bins
         expected, observed, clusters = cluster_rows(expected, observed)
@@ -1021,11 +1602,11 @@ class DesignMatrix(object):
         
 
         # transcripts to remove
-        test = (observed+1)/expected.max(1)
+        test = (observed+1)/expected.max(1).toarray().ravel()
         for index in numpy.arange(observed.shape[0])[test.argsort()]:
             if num_transcripts - len(low_expression_ts) <= max_num_transcripts:
                 break
-            new_low_expression = set(expected[index,].nonzero()[0])
+            new_low_expression = set(expected.getrow(index).nonzero()[1])
             # if this would remove every transcript, skip it
             if len( low_expression_ts.union(new_low_expression) ) == num_transcripts:
                 continue
@@ -1035,7 +1616,7 @@ class DesignMatrix(object):
     
     def __init__(self, gene, fl_dists,
                  rnaseq_reads, five_p_reads, three_p_reads,
-                 max_num_transcripts=None):
+                 max_num_transcripts=None, expected_rnaseq_arrays=None):
         assert fl_dists is not None
         self.array_types = []
 
@@ -1045,6 +1626,7 @@ class DesignMatrix(object):
 
         self._cached_bam_cnts = None
         self._cached_indices = None
+        self._cached_bins_to_keep = None
         
         self.filtered_transcripts = None
         self.max_num_transcripts = max_num_transcripts
@@ -1069,7 +1651,8 @@ class DesignMatrix(object):
         
         if config.DEBUG_VERBOSE:
             config.log_statement( "Building RNAseq arrays for %s" % gene.id )
-        self._build_rnaseq_arrays(gene, rnaseq_reads, fl_dists)
+        self._build_rnaseq_arrays(
+            gene, rnaseq_reads, fl_dists, expected_rnaseq_arrays)
         if self.obs_cnt_arrays[-1] is not None:
             self.num_rnaseq_reads = sum(self.obs_cnt_arrays[-1])
         
@@ -1102,6 +1685,62 @@ class DesignMatrix(object):
         return
 
 
+def build_design_matrices_for_samples(
+        gene, samples_reads, max_num_transcripts=None):
+    """Build gene's design matrix for every sample in samples_reads.
+
+    samples_reads is a list of (fl_dists, rnaseq_reads, five_p_reads, 
+    three_p_reads). The expected RNAseq array is only built once for every
+    distinct fl_dists, and is shared between the samples' design matrices,
+    so only the observed counts are built for each sample. Returns a list 
+    with the design matrix of each sample, or None if the sample has no 
+    observable transcripts, or its design matrix couldn't be built (in 
+    which case the error is logged, and the other samples are unaffected).
+    """
+    exon_boundaries, transcripts_non_overlapping_exon_indices = \
+        find_nonoverlapping_exons(gene)
+    all_expected_rnaseq_arrays = {}
+    f_mats = []
+    for sample_i, (fl_dists, rnaseq_reads, five_p_reads, three_p_reads) \
+            in enumerate(samples_reads):
+        try:
+            key = DESIGN_MATRIX_CACHE.key(
+                exon_boundaries, transcripts_non_overlapping_exon_indices, 
+                fl_dists)
+            if key not in all_expected_rnaseq_arrays:
+                all_expected_rnaseq_arrays[key] = \
+                    load_clustered_expected_rnaseq_array(
+                        exon_boundaries, 
+                        transcripts_non_overlapping_exon_indices,
+                        fl_dists)
+            f_mats.append( DesignMatrix(
+                gene, fl_dists, rnaseq_reads, five_p_reads, three_p_reads,
+                max_num_transcripts, all_expected_rnaseq_arrays[key]) )
+        except NoObservableTranscriptsError:
+            f_mats.append(None)
+        except Exception, inst:
+            config.log_statement( 
+                "%i: Skipping sample %i in %s: %s\n%s" % (
+                    os.getpid(), sample_i, gene.id, inst, 
+                    traceback.format_exc()), 
+                log=True )
+            f_mats.append(None)
+    return f_mats
+
+def batch_expected_and_observed(f_mats, all_bam_cnts):
+    """Build the expected array, and the observed arrays, of design matrices
+       that share their expected arrays (see shares_expected_arrays). 
+
+    Returns the expected array and a (bins x samples) observed array.
+    """
+    expected, observed = f_mats[0].expected_and_observed(all_bam_cnts[0])
+    bins_to_keep = f_mats[0]._cached_bins_to_keep
+    observed_arrays = [observed,]
+    for f_mat, bam_cnts in izip(f_mats[1:], all_bam_cnts[1:]):
+        assert f_mat.shares_expected_arrays(f_mats[0])
+        observed_arrays.append(f_mat._stack_observed(bam_cnts)[bins_to_keep])
+    return expected, numpy.column_stack(observed_arrays)
+
 def tests( ):
     exon_lens = [100,1,100]
     transcript = range( len(exon_lens) )
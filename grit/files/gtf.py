@@ -18,17 +18,26 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os, sys
+import gc
+from contextlib import contextmanager
 from collections import namedtuple, defaultdict
 import itertools
 
 import tempfile
 import gzip
+import hashlib
+
+import cPickle as pickle
+
+import numpy
 
 from ..transcript import Gene, Transcript, GenomicInterval
+from ..gtf_support_fns import parse_gtf_meta_data
     
 from reads import clean_chr_name
 from tracking import load_expression_tracking_data
 from ..config import log_statement, VERBOSE
+from .. import config
 
 import traceback
 
@@ -39,6 +48,9 @@ GtfLine = namedtuple( "GtfLine", ["region", "gene_id", "trans_id", "feature",
 
 VERBOSE = True
 DEBUG = False
+
+GTF_CACHE_VERSION = 1
+GTF_CACHE_SUFFIX = ".grit_cache"
     
 def flatten( regions ):
     try: regions.sort()
@@ -122,26 +134,23 @@ def parse_gff_line( line, fix_chrm=True ):
     return GffLine( GenomicInterval(data[0], data[6], data[3], data[4]), \
                         data[2], data[5], data[1], data[7], data[8] )
 
+def get_name_from_field( name ):
+    if name.startswith('"'):
+        name = name[1:]
+    if name.endswith(';'):
+        name = name[:-1]
+    if name.endswith('"'):
+        name = name[:-1]
+    return name
+
 def parse_gtf_line( line, fix_chrm=True ):
     gffl = parse_gff_line( line, fix_chrm=fix_chrm )
     if gffl is None: return None
     
     # get gene and transcript name if parsing a gtf line 
     # else it is a gff line and does not have gene or trans names
-    def get_name_from_field( name ):
-        if name.startswith('"'):
-            name = name[1:]
-        if name.endswith(';'):
-            name = name[:-1]
-        if name.endswith('"'):
-            name = name[:-1]
-        return name
-    
-    meta_data_items = (gffl.group).split()
     # parse the meta data, and grab the gene name
-    meta_data = dict( zip( meta_data_items[::2], 
-                           ( get_name_from_field(x) 
-                             for x in meta_data_items[1::2] ) ) )
+    meta_data = parse_gtf_meta_data(gffl.group)
     
     if "gene_id" not in meta_data:
         raise ValueError, "GTF lines require a gene_id field."
@@ -261,6 +270,69 @@ def _load_gene_from_gtf_lines( gene_id, gene_lines, transcripts_data ):
                  gene_chrm, gene_strand, gene_start, gene_stop,
                  transcripts, gene_meta_data )
 
+ELEMENT_TYPES = ( 'gene', 'internal_exon', 'intron', 'polya', 'promoter', 
+                  'single_exon_gene', 'tes_exon', 'tss_exon', 'exon' )
+
+class IntervalIndex(object):
+    """Nested containment list of closed intervals.
+
+    Every interval is stored in the sublist of the closest interval that 
+    contains it (or in the top level list). The intervals in a sublist 
+    don't contain each other, so both their starts and their stops are 
+    sorted, and the members that overlap a query are a contiguous block that 
+    starts at a binary search. A long interval only adds its own sublist to 
+    the search, rather than every interval that it covers.
+    """
+    def __init__(self, starts, stops):
+        starts = numpy.array(starts, dtype=int)
+        stops = numpy.array(stops, dtype=int)
+        # sort by start, and then by decreasing stop so that every interval 
+        # comes after the intervals that contain it
+        order = numpy.lexsort((-stops, starts))
+        
+        # find the closest containing interval of every interval
+        parents = numpy.zeros(len(order), dtype=int)
+        containing = []
+        for i in order:
+            while len(containing) > 0 and stops[containing[-1]] < stops[i]:
+                containing.pop()
+            parents[i] = containing[-1] if len(containing) > 0 else -1
+            containing.append(i)
+        
+        # group the intervals by parent, keeping the sorted order within 
+        # every sublist, and store each interval's sublist bounds
+        order = order[numpy.argsort(parents[order], kind='mergesort')]
+        sorted_parents = parents[order]
+        self.ids = order
+        self.starts = starts[order]
+        self.stops = stops[order]
+        index = numpy.arange(len(order))
+        self.sublist_starts = sorted_parents.searchsorted(index, side='left')
+        self.sublist_stops = sorted_parents.searchsorted(index, side='right')
+        self.top_level = ( sorted_parents.searchsorted(-1, side='left'),
+                           sorted_parents.searchsorted(-1, side='right') )
+    
+    def find_overlapping(self, start, stop):
+        """Return the sorted indices of the intervals that overlap start-stop.
+
+        """
+        overlapping = []
+        sublists = [self.top_level,]
+        while len(sublists) > 0:
+            lo, hi = sublists.pop()
+            # skip the members that end before start
+            lo += self.stops[lo:hi].searchsorted(start, side='left')
+            while lo < hi and self.starts[lo] <= stop:
+                i = self.ids[lo]
+                overlapping.append(i)
+                # intervals contained in one that doesn't overlap the query 
+                # can't overlap it either, so we only search these sublists
+                if self.sublist_starts[i] < self.sublist_stops[i]:
+                    sublists.append(
+                        (self.sublist_starts[i], self.sublist_stops[i]))
+                lo += 1
+        return numpy.sort(numpy.array(overlapping, dtype=int))
+
 class Annotation(object):
     """Store a collection of genes.
 
@@ -270,6 +342,10 @@ class Annotation(object):
         self._genes = []
         self._gene_map = {}
         self._gene_locs = defaultdict(list)
+        # the overlap indices are built for each contig and strand on its 
+        # first query, and reset every time a gene is added
+        self._gene_index = {}
+        self._element_index = {}
     
     def __len__(self):
         return len(self._genes)
@@ -289,40 +365,173 @@ class Annotation(object):
         
         # add the gene to the location index
         self._gene_locs[(gene.chrm, gene.strand)].append(gene)
-
-    def iter_overlapping_genes(self, chrm, strand, start, stop):
+        self._gene_index = {}
+        self._element_index = {}
+
+    def _get_gene_index(self, key):
+        if key not in self._gene_index:
+            genes = self._gene_locs[key]
+            self._gene_index[key] = IntervalIndex(
+                [gene.start for gene in genes], [gene.stop for gene in genes])
+        return self._gene_index[key]
+    
+    def _get_element_index(self, key):
+        if key not in self._element_index:
+            # flatten the elements of every gene, keeping the gene boundaries
+            # so that we only return elements of genes that overlap the query
+            element_data = []
+            for gene in self._gene_locs[key]:
+                for element_type, elements in gene.extract_elements().iteritems():
+                    type_code = ELEMENT_TYPES.index(element_type)
+                    for start, stop in elements:
+                        element_data.append( 
+                            (start, stop, type_code, gene.start, gene.stop) )
+            element_data = numpy.array(element_data, dtype=int).reshape(-1, 5)
+            self._element_index[key] = (
+                IntervalIndex(element_data[:,0], element_data[:,1]), 
+                element_data )
+        return self._element_index[key]
+    
+    def _iter_strand_keys(self, chrm, strand):
         if strand in '+-': strands = [strand,]
         elif strand == '.': strands = ['+','-']
         else: raise ValueError( "Unrecognized strand: '%s'" % strand )
-        
         for strand in strands:
-            for gene in self._gene_locs[(clean_chr_name(chrm), strand)]:
-                if stop < gene.start: continue
-                if start > gene.stop: continue
-                yield gene
+            key = (clean_chr_name(chrm), strand)
+            if key in self._gene_locs: yield key
+        return
+    
+    def iter_overlapping_genes(self, chrm, strand, start, stop):
+        for key in self._iter_strand_keys(chrm, strand):
+            genes = self._gene_locs[key]
+            # genes are returned in the order that they were added
+            for i in self._get_gene_index(key).find_overlapping(start, stop):
+                yield genes[i]
 
         return
 
     def iter_elements(self, chrm, strand, r_start, r_stop):
-        if strand in '+-': strands = [strand,]
-        elif strand == '.': strands = ['+','-']
-        else: assert "Unrecognized strand: '%s' % strand"
-        
-        for strand in strands:
-            for gene in self._gene_locs[(clean_chr_name(chrm), strand)]:
-                if gene.stop < r_start: continue
-                if gene.start > r_stop: continue
-                for element_type, elements in gene.extract_elements().iteritems():
-                    for start, stop in elements:
-                        if stop < r_start or start > r_stop: continue
-                        yield element_type, (start, stop)
+        for key in self._iter_strand_keys(chrm, strand):
+            index, element_data = self._get_element_index(key)
+            # elements are returned in gene order
+            elements = element_data[index.find_overlapping(r_start, r_stop)]
+            elements = elements[ (elements[:,4] >= r_start) 
+                                 & (elements[:,3] <= r_stop) ]
+            for start, stop, type_code, gene_start, gene_stop in elements:
+                yield ELEMENT_TYPES[type_code], (int(start), int(stop))
         
         return
 
     def __iter__(self):
         return iter(self._genes)
     
-def load_gtf(fname_or_fp, contig=None, strand=None):
+def gtf_cache_fname( gtf_fname, cache_dir ):
+    # include a hash of the full path, so that gtfs with the same name in 
+    # different directories don't share a cache file
+    gtf_fname = os.path.abspath(gtf_fname)
+    return os.path.join(cache_dir, "%s.%s%s" % (
+        os.path.basename(gtf_fname), hashlib.md5(gtf_fname).hexdigest(), 
+        GTF_CACHE_SUFFIX))
+
+def _gtf_signature( gtf_fname ):
+    stat = os.stat(gtf_fname)
+    return (stat.st_size, stat.st_mtime)
+
+def _load_genes_from_cache( gtf_fname, cache_dir ):
+    """Return the cached genes for gtf_fname, or None if they aren't cached.
+
+    """
+    cache_fname = gtf_cache_fname(gtf_fname, cache_dir)
+    if not os.path.exists(cache_fname): return None
+    try:
+        with open(cache_fname, "rb") as fp:
+            meta = pickle.load(fp)
+            if ( meta['version'] != GTF_CACHE_VERSION 
+                 or meta['gtf_signature'] != _gtf_signature(gtf_fname) ):
+                return None
+            return pickle.load(fp)
+    except Exception, inst:
+        log_statement( "Could not load the gtf cache '%s': %s" % (
+            cache_fname, inst), log=True)
+        if DEBUG: raise
+        return None
+
+def _write_genes_to_cache( gtf_fname, genes, cache_dir ):
+    cache_fname = gtf_cache_fname(gtf_fname, cache_dir)
+    meta = { 'version': GTF_CACHE_VERSION, 
+             'gtf_signature': _gtf_signature(gtf_fname) }
+    # write to a temporary file and then move it, so that concurrent loads
+    # never see a partially written cache
+    try:
+        if not os.path.exists(cache_dir):
+            try: os.makedirs(cache_dir)
+            except OSError:
+                # another process may have created it
+                if not os.path.exists(cache_dir): raise
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(cache_fname), delete=False,
+                prefix=os.path.basename(cache_fname)+".") as ofp:
+            pickle.dump(meta, ofp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(list(genes), ofp, pickle.HIGHEST_PROTOCOL)
+        os.chmod(ofp.name, 0644)
+        os.rename(ofp.name, cache_fname)
+    except (IOError, OSError), inst:
+        log_statement( "Could not write the gtf cache '%s': %s" % (
+            cache_fname, inst), log=True)
+    return
+
+@contextmanager
+def gc_disabled():
+    """Disable the cyclic garbage collector while building many objects.
+
+    Otherwise the collector is repeatedly triggered by the allocations, and
+    each pass re-scans all of the objects that have been loaded so far.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled: gc.enable()
+
+def load_gtf(fname_or_fp, contig=None, strand=None, cache_dir=None):
+    """Load the genes in a gtf file.
+
+    If cache_dir (which defaults to config.ANNOTATION_CACHE_DIR) is set, 
+    fname_or_fp is a filename (or an unread file) and we are loading every
+    contig and strand, then the parsed genes are cached in a binary file in
+    cache_dir (see gtf_cache_fname). Later calls load the genes from the 
+    cache as long as the gtf's size and modification time have not changed.
+    """
+    if cache_dir is None: cache_dir = config.ANNOTATION_CACHE_DIR
+    with gc_disabled():
+        return _load_gtf(fname_or_fp, contig, strand, cache_dir)
+
+def _find_cacheable_gtf_fname( fname_or_fp ):
+    """Return the filename of an unread, uncompressed gtf, or None.
+
+    """
+    if isinstance( fname_or_fp, str ): 
+        return fname_or_fp
+    # argparse file arguments are unread file objects
+    if ( isinstance( fname_or_fp, file ) and os.path.isfile(fname_or_fp.name)
+         and fname_or_fp.tell() == 0 ):
+        return fname_or_fp.name
+    return None
+
+def _load_gtf(fname_or_fp, contig, strand, cache_dir):
+    gtf_fname = None
+    if cache_dir is not None and contig is None and strand is None:
+        gtf_fname = _find_cacheable_gtf_fname(fname_or_fp)
+    if gtf_fname is not None:
+        cached_genes = _load_genes_from_cache(gtf_fname, cache_dir)
+        if cached_genes is not None:
+            genes = Annotation()
+            for gene in cached_genes: genes.append(gene)
+            log_statement("Found %s genes in reference annotation %s (cached)"
+                          % (len(genes), fname_or_fp))
+            return genes
+    
     if isinstance( fname_or_fp, str ):
         fp = open( fname_or_fp )
     else:
@@ -360,6 +569,8 @@ def load_gtf(fname_or_fp, contig=None, strand=None):
     
     if isinstance( fname_or_fp, str ):
         fp.close()
+    if gtf_fname is not None: 
+        _write_genes_to_cache(gtf_fname, genes, cache_dir)
     log_statement("Found %s genes in reference annotation %s" % (len(genes), fname_or_fp))
     return genes
 
@@ -33,6 +33,10 @@ from scipy.stats import beta, binom
 # skip circular import problems
 try: from reads import get_strand, get_contigs_and_lens
 except ImportError: pass
+# reads imports this module, so import the module itself (which is already 
+# in sys.modules, even if it's only partially initialized) rather than names
+# from it
+import reads as reads_module
 
 from grit import config
 
@@ -219,7 +223,7 @@ def extract_junctions_in_region( reads, chrm, strand, start=None, end=None,
                                  allow_introns_to_span_start=False,
                                  allow_introns_to_span_end=False,
                                  only_unique=False ):
-    reads = reads.reload()
+    reads = reads_module.get_reads_handle(reads, 'junctions')
     all_junctions = defaultdict(lambda: defaultdict(int))
     for i, read in enumerate(reads.iter_reads(chrm, strand, start, end)):
         # check for uniqueness, if possible
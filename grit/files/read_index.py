@@ -0,0 +1,406 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Columnar read index.
+
+The index is built with a single pass over a bam file, and stores the
+information that the pipeline needs from every alignment (positions,
+aligned blocks, junction, flag, read group, mate and posterior mapping
+probability) as per contig numpy arrays. The arrays are written as .npy
+files into a sidecar directory next to the bam, and are memory mapped when
+they are loaded, so that every process shares the same pages. While the 
+index is built, the arrays are flushed to disk in fixed size chunks, so 
+the memory usage doesn't grow with the size of the contig.
+
+Reads are stored in bam (ie position) order, so region queries are a
+binary search into the start array.
+"""
+
+import os
+import time
+import shutil
+from array import array
+
+import numpy
+import numpy.lib.format
+
+import cPickle as pickle
+
+import grit.config as config
+
+import junctions
+
+READ_INDEX_VERSION = 3
+READ_INDEX_SUFFIX = ".grit_index"
+
+# bam flag bits
+BAM_FPAIRED = 0x1
+BAM_FREVERSE = 0x10
+BAM_FREAD1 = 0x40
+BAM_FREAD2 = 0x80
+
+# the per read arrays, and their types
+READ_FIELDS = [ ('start', 'l', numpy.int64),
+                ('stop', 'l', numpy.int64),
+                ('flag', 'H', numpy.uint16),
+                ('read_len', 'i', numpy.int32),
+                ('read_grp', 'h', numpy.int16),
+                ('map_prb', 'd', numpy.float64),
+                ('mate', 'l', numpy.int64),
+                ('jn_start', 'l', numpy.int64),
+                ('jn_stop', 'l', numpy.int64),
+                ('blk_offsets', 'l', numpy.int64) ]
+
+# the per aligned block arrays
+BLOCK_FIELDS = [ ('blk_start', 'l', numpy.int64),
+                 ('blk_stop', 'l', numpy.int64) ]
+
+# the read names are stored as a byte array of the concatenated names, and
+# the offset of every name into it, so that mates are matched on the full 
+# name rather than a hash of it
+QNAME_FIELDS = [ ('qname_offsets', 'l', numpy.int64),
+                 ('qname_data', 'B', numpy.uint8) ]
+
+# the number of values that are buffered for each array before they are 
+# written to disk
+READ_INDEX_CHUNK_SIZE = 2**20
+
+def read_index_dirname( bam_fname ):
+    return os.path.abspath(bam_fname) + READ_INDEX_SUFFIX
+
+def _array_fname( dirname, contig_id, field ):
+    return os.path.join(dirname, "%i.%s.npy" % (contig_id, field))
+
+def _bam_signature( bam_fname ):
+    stat = os.stat(bam_fname)
+    return (stat.st_size, stat.st_mtime)
+
+def calc_read_strands( flags, reverse_read_strand, pairs_are_opp_strand ):
+    """Vectorized version of reads.get_strand.
+
+    Returns a boolean array that is true for reads on the '+' strand.
+    """
+    flags = numpy.asarray(flags)
+    is_rev = (flags & BAM_FREVERSE) > 0
+    on_plus = ~is_rev
+    if pairs_are_opp_strand:
+        is_paired = (flags & BAM_FPAIRED) > 0
+        paired_on_plus = ( ((flags & BAM_FREAD1) > 0) & ~is_rev ) | (
+            ((flags & BAM_FREAD2) > 0) & is_rev )
+        on_plus = numpy.where(is_paired, paired_on_plus, on_plus)
+    if reverse_read_strand:
+        on_plus = ~on_plus
+    return on_plus
+
+class IndexedContig( object ):
+    """The index arrays for a single contig.
+
+    """
+    def __init__(self, dirname, contig_id, contig, max_span, read_groups,
+                 mmap_mode='r'):
+        self.contig = contig
+        self.max_span = max_span
+        self.read_groups = read_groups
+        for field, typecode, dtype in READ_FIELDS+BLOCK_FIELDS+QNAME_FIELDS:
+            setattr(self, field, numpy.load(
+                _array_fname(dirname, contig_id, field), mmap_mode=mmap_mode))
+        return
+
+    def __len__(self):
+        return len(self.start)
+
+    def qname( self, index ):
+        return self.qname_data[
+            self.qname_offsets[index]:self.qname_offsets[index+1]].tostring()
+
+    def find_overlapping_reads( self, start=None, stop=None ):
+        """Return the indices of reads that overlap [start, stop).
+
+        This mirrors the semantics of pysam's fetch.
+        """
+        if start is None: start = 0
+        if stop is None:
+            stop_i = len(self.start)
+        else:
+            stop_i = self.start.searchsorted(stop, side='left')
+        # no read can start before start - max_span and still overlap start
+        start_i = self.start.searchsorted(start - self.max_span, side='left')
+        indices = numpy.arange(start_i, stop_i)
+        return indices[self.stop[start_i:stop_i] >= start]
+
+    def block_indices( self, indices ):
+        """Return the indices of all of the blocks of the reads in indices.
+
+        """
+        indices = numpy.asarray(indices, dtype=int)
+        blk_starts = self.blk_offsets[indices]
+        n_blks = self.blk_offsets[indices+1] - blk_starts
+        if len(n_blks) == 0: return numpy.zeros(0, dtype=int)
+        # the offset of each read's first block into the output array
+        out_offsets = n_blks.cumsum() - n_blks
+        return numpy.arange(n_blks.sum()) + numpy.repeat(
+            blk_starts - out_offsets, n_blks)
+
+    def iter_blocks( self, index ):
+        for blk_i in xrange(self.blk_offsets[index],
+                            self.blk_offsets[index+1]):
+            yield int(self.blk_start[blk_i]), int(self.blk_stop[blk_i])
+        return
+
+class ReadIndex( object ):
+    """A memory mapped, columnar index of the reads in a bam file.
+
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, "index.obj")) as fp:
+            meta = pickle.load(fp)
+        if meta['version'] != READ_INDEX_VERSION:
+            raise ValueError, "Read index '%s' has version %s (expected %s)" % (
+                dirname, meta['version'], READ_INDEX_VERSION)
+        self.bam_signature = meta['bam_signature']
+        self.read_groups = meta['read_groups']
+        self.num_reads = meta['num_reads']
+        self._contig_ids = dict(
+            (contig, i) for i, contig in enumerate(meta['contigs']))
+        self._max_spans = meta['max_spans']
+        self._contigs = {}
+        return
+
+    def is_current( self, bam_fname ):
+        return self.bam_signature == _bam_signature(bam_fname)
+
+    def __contains__( self, contig ):
+        return contig in self._contig_ids
+
+    def contig( self, contig ):
+        """Return the IndexedContig for contig, or None if it has no reads.
+
+        """
+        try:
+            return self._contigs[contig]
+        except KeyError:
+            pass
+        try:
+            contig_id = self._contig_ids[contig]
+        except KeyError:
+            return None
+        data = IndexedContig(
+            self.dirname, contig_id, contig, self._max_spans[contig_id],
+            self.read_groups)
+        self._contigs[contig] = data
+        return data
+
+class _ArrayWriter( object ):
+    """Write an array into a .npy file in chunks.
+
+    The values are buffered, and written to a temporary file every 
+    READ_INDEX_CHUNK_SIZE values. close writes the .npy file, which can't 
+    be written until the length of the array is known.
+    """
+    def __init__(self, fname, typecode, dtype):
+        self.fname = fname
+        self.dtype = numpy.dtype(dtype)
+        self.values = array(typecode)
+        # the number of values that have already been written
+        self.size = 0
+        self._fp = open(fname + ".tmp", "wb")
+    
+    def __len__(self):
+        return self.size + len(self.values)
+    
+    def append(self, value):
+        self.values.append(value)
+        if len(self.values) >= READ_INDEX_CHUNK_SIZE: self.flush()
+    
+    def extend(self, values):
+        self.values.extend(values)
+        if len(self.values) >= READ_INDEX_CHUNK_SIZE: self.flush()
+    
+    def flush(self):
+        self.values.tofile(self._fp)
+        self.size += len(self.values)
+        del self.values[:]
+    
+    def close(self):
+        self.flush()
+        self._fp.close()
+        with open(self.fname, "wb") as ofp:
+            numpy.lib.format.write_array_header_1_0(ofp, {
+                'descr': numpy.lib.format.dtype_to_descr(self.dtype), 
+                'fortran_order': False, 
+                'shape': (self.size,)})
+            with open(self.fname + ".tmp", "rb") as fp:
+                shutil.copyfileobj(fp, ofp)
+        os.remove(self.fname + ".tmp")
+    
+    def remove(self):
+        self._fp.close()
+        for fname in (self.fname, self.fname + ".tmp"):
+            if os.path.exists(fname): os.remove(fname)
+
+def _index_contig( reads, contig, read_grp_ids, dirname, contig_id ):
+    """Write the index arrays for the reads in contig.
+
+    Returns the number of indexed reads, and the maximum span of a read.
+    """
+    from reads import get_rd_posterior_prb, iter_coverage_intervals_for_read
+
+    data = dict(
+        (field, _ArrayWriter(
+            _array_fname(dirname, contig_id, field), typecode, dtype))
+        for field, typecode, dtype in READ_FIELDS+BLOCK_FIELDS+QNAME_FIELDS)
+    data['blk_offsets'].append(0)
+    data['qname_offsets'].append(0)
+    # reads waiting for their mate, keyed by (qname, pos, mate pos). Because
+    # the reads are sorted, this only grows with the fragment length
+    pending_mates = {}
+    # (read, mate) pairs whose read was written before its mate was found
+    mate_updates = []
+    max_span = 0
+    try:
+        for read in reads.fetch(contig):
+            # unmapped reads (eg. the unmapped mate of a mapped read, which
+            # is placed at its mate's position) have no alignment to index
+            if read.is_unmapped or read.aend is None: continue
+            i = len(data['start'])
+            data['start'].append(read.pos)
+            data['stop'].append(read.aend-1)
+            max_span = max(max_span, read.aend - read.pos)
+            data['flag'].append(read.flag)
+            data['read_len'].append(read.inferred_length)
+            try: read_grp = read.opt('RG')
+            except KeyError: read_grp = 'mean'
+            if read_grp not in read_grp_ids:
+                read_grp_ids[read_grp] = len(read_grp_ids)
+            data['read_grp'].append(read_grp_ids[read_grp])
+            data['map_prb'].append(get_rd_posterior_prb(read))
+            data['qname_data'].extend(array('B', read.qname))
+            data['qname_offsets'].append(len(data['qname_data']))
+
+            # find the mate, if it's on the same contig
+            mate_i = -1
+            if read.is_paired and read.rnext == read.tid:
+                mate_i = pending_mates.pop(
+                    (read.qname, read.mpos, read.pos), -1)
+                if mate_i == -1:
+                    pending_mates[(read.qname, read.pos, read.mpos)] = i
+                elif mate_i >= data['mate'].size:
+                    data['mate'].values[mate_i - data['mate'].size] = i
+                else:
+                    mate_updates.append((mate_i, i))
+            data['mate'].append(mate_i)
+
+            jn = next(junctions.iter_jns_in_read(read), None)
+            data['jn_start'].append(-1 if jn is None else jn[0])
+            data['jn_stop'].append(-1 if jn is None else jn[1])
+
+            for start, stop in iter_coverage_intervals_for_read(read):
+                data['blk_start'].append(start)
+                data['blk_stop'].append(stop)
+            data['blk_offsets'].append(len(data['blk_start']))
+        
+        num_reads = len(data['start'])
+        for writer in data.itervalues(): writer.close()
+    except:
+        for writer in data.itervalues(): writer.remove()
+        raise
+    
+    if num_reads == 0:
+        for writer in data.itervalues(): writer.remove()
+    elif len(mate_updates) > 0:
+        mates = numpy.load(
+            _array_fname(dirname, contig_id, 'mate'), mmap_mode='r+')
+        for read_i, mate_i in mate_updates:
+            mates[read_i] = mate_i
+        mates.flush()
+        del mates
+    
+    return num_reads, max_span
+
+def build_read_index( reads, dirname=None ):
+    """Build the read index for reads, and write it into dirname.
+
+    The reads are fetched through reads.fetch, so duplicate reads are
+    skipped in the same way that they are when reading from the bam.
+    """
+    if dirname is None:
+        dirname = read_index_dirname(reads.filename)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    if config.VERBOSE:
+        config.log_statement("Building read index for '%s'" % reads.filename)
+    start_time = time.time()
+
+    contigs = []
+    max_spans = []
+    num_reads = 0
+    read_grp_ids = {}
+    for contig in reads.references:
+        contig_num_reads, max_span = _index_contig(
+            reads, contig, read_grp_ids, dirname, len(contigs))
+        if contig_num_reads == 0: continue
+        contigs.append(contig)
+        max_spans.append(max_span)
+        num_reads += contig_num_reads
+
+    read_groups = [None]*len(read_grp_ids)
+    for read_grp, i in read_grp_ids.iteritems():
+        read_groups[i] = read_grp
+
+    # write the meta data last, so that a partially written index is
+    # never loaded
+    with open(os.path.join(dirname, "index.obj"), "w") as fp:
+        pickle.dump( {'version': READ_INDEX_VERSION,
+                      'bam_signature': _bam_signature(reads.filename),
+                      'contigs': contigs,
+                      'max_spans': max_spans,
+                      'read_groups': read_groups,
+                      'num_reads': num_reads}, fp )
+
+    if config.VERBOSE:
+        config.log_statement(
+            "Built read index for '%s' (%i reads, %.1f sec)" % (
+                reads.filename, num_reads, time.time()-start_time))
+
+    return ReadIndex(dirname)
+
+def load_read_index( reads, build_if_missing=True ):
+    """Load the read index for reads, building it if it is missing or stale.
+
+    """
+    dirname = read_index_dirname(reads.filename)
+    try:
+        read_index = ReadIndex(dirname)
+    except (IOError, OSError, ValueError):
+        read_index = None
+    if read_index is not None and read_index.is_current(reads.filename):
+        return read_index
+    if not build_if_missing:
+        return None
+    # if the index can't be written (eg. the bam is in a read only 
+    # directory) then the reads are read from the bam
+    try:
+        return build_read_index(reads, dirname)
+    except (IOError, OSError), inst:
+        config.log_statement( 
+            "Could not build the read index for '%s', reading from the bam: %s"
+            % (reads.filename, inst), log=True )
+        return None
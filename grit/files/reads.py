@@ -18,7 +18,10 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys, os
-from itertools import chain
+import heapq
+import struct
+from array import array
+from itertools import chain, izip, count
 from collections import defaultdict, namedtuple
 from copy import copy
 
@@ -29,6 +32,8 @@ import grit.config as config
 from grit.frag_len import build_normal_density
 
 import junctions
+from read_index import (
+    load_read_index, calc_read_strands, BAM_FPAIRED, BAM_FREAD1 )
 
 ReadData = namedtuple('ReadData', [
         'strand', 'read_len', 'read_grp', 'map_prb', 'cov_regions'])
@@ -291,17 +296,46 @@ def iter_coverage_regions_for_read(
     
     return
 
+def build_coverage_from_intervals(
+        starts, stops, region_start, region_len, weights=None):
+    """Build the coverage of a set of half open intervals in one pass. 
+
+    This is equivalent to, for every interval, 
+    cvg[max(0, start-region_start):max(0, stop-region_start)] += weight
+    but the intervals are added with a diff/cumsum.
+    """
+    starts = numpy.clip(
+        numpy.asarray(starts, dtype=int) - region_start, 0, region_len)
+    stops = numpy.clip(
+        numpy.asarray(stops, dtype=int) - region_start, 0, region_len)
+    if weights is None: 
+        weights = numpy.ones(len(starts), dtype=float)
+    else:
+        weights = numpy.asarray(weights, dtype=float)
+    # skip empty intervals
+    non_empty = stops > starts
+    starts, stops, weights = (
+        starts[non_empty], stops[non_empty], weights[non_empty])
+    if len(starts) == 0:
+        return numpy.zeros(region_len, dtype=float)
+    diffs = numpy.bincount(starts, weights, minlength=region_len+1)
+    diffs -= numpy.bincount(stops, weights, minlength=region_len+1)
+    return diffs[:region_len].cumsum()
+
 def extract_jns_and_reads_in_region(
         (chrm, strand, r_start, r_stop), reads, max_n_reads_to_store=1e6):
     assert strand in '+-.', "Strand must be -, +, or . for either"
+    if reads.has_read_index:
+        return extract_jns_and_reads_in_region_from_index(
+            (chrm, strand, r_start, r_stop), reads, max_n_reads_to_store)
 
     reg_len = r_stop-r_start+1
     
     jn_reads = {'+': defaultdict(int), '-': defaultdict(int), '.': defaultdict(int)}
 
-    cov = { '+': numpy.zeros(reg_len, dtype=float), 
-            '-': numpy.zeros(reg_len, dtype=float),
-            '.': numpy.zeros(reg_len, dtype=float) }
+    # the covered blocks of each read, by strand
+    cov_starts = {'+': [], '-': [], '.': []}
+    cov_stops = {'+': [], '-': [], '.': []}
 
     pair1_reads = defaultdict(list)
     pair2_reads = defaultdict(list)
@@ -345,12 +379,8 @@ def extract_jns_and_reads_in_region(
             map_prb/2. if read.is_paired else map_prb )
         
         for start, stop in cov_regions:
-            # if start - r_start > reg_len, then it doesn't do 
-            # anything, so the next line is not necessary
-            # if start - r_start > reg_len: continue
-            cov[rd_strand][
-                max(0, start-r_start):max(0, stop-r_start+1)] += 1
-
+            cov_starts[rd_strand].append(start)
+            cov_stops[rd_strand].append(stop+1)
         
         # store the read data - we will join them later
         if max(len(pair1_reads), len(pair2_reads)) < max_n_reads_to_store:
@@ -367,6 +397,72 @@ def extract_jns_and_reads_in_region(
         #if r_stop - r_start > 1000 and n_obs_reads > 1e5: 
         #    raise TooManyReadsError, "Too many reads"
 
+    cov = {}
+    for rd_strand in cov_starts.keys():
+        cov[rd_strand] = build_coverage_from_intervals(
+            cov_starts[rd_strand], cov_stops[rd_strand], r_start, reg_len)
+    
+    return ( pair1_reads, pair2_reads, 
+             jn_reads['+'], jn_reads['-'], 
+             cov, num_unique_reads )
+
+def extract_jns_and_reads_in_region_from_index(
+        (chrm, strand, r_start, r_stop), reads, max_n_reads_to_store=1e6):
+    """Same as extract_jns_and_reads_in_region, but use the read index.
+
+    """
+    reg_len = r_stop-r_start+1
+    
+    jn_reads = {'+': defaultdict(int), '-': defaultdict(int), '.': defaultdict(int)}
+
+    cov = { '+': numpy.zeros(reg_len, dtype=float), 
+            '-': numpy.zeros(reg_len, dtype=float),
+            '.': numpy.zeros(reg_len, dtype=float) }
+
+    pair1_reads = defaultdict(list)
+    pair2_reads = defaultdict(list)
+
+    num_unique_reads = 0.0
+    for data, indices, rd_strands in reads.iter_read_index_queries(
+            chrm, r_start, r_stop+1):
+        if data is None: continue
+        flags = data.flag[indices]
+        map_prbs = data.map_prb[indices]
+        
+        # junctions are counted on both strands
+        jn_starts = data.jn_start[indices]
+        has_jn = (jn_starts-1 >= r_start)&(jn_starts-1 <= r_stop)
+        for i, rd_strand in izip(indices[has_jn], rd_strands[has_jn]):
+            jn_reads[rd_strand][
+                (int(data.jn_start[i]), int(data.jn_stop[i]))] += 1
+
+        if strand != '.':
+            on_strand = (rd_strands == strand)
+            indices, rd_strands = indices[on_strand], rd_strands[on_strand]
+            flags, map_prbs = flags[on_strand], map_prbs[on_strand]
+        
+        is_paired = (flags & 0x1) > 0
+        num_unique_reads += (
+            map_prbs[is_paired].sum()/2. + map_prbs[~is_paired].sum())
+
+        for rd_strand in numpy.unique(rd_strands):
+            blk_indices = data.block_indices(indices[rd_strands == rd_strand])
+            cov[rd_strand] += build_coverage_from_intervals(
+                data.blk_start[blk_indices], data.blk_stop[blk_indices]+1, 
+                r_start, reg_len)
+        
+        for i, rd_strand, flag, map_prb in izip(
+                indices, rd_strands, flags, map_prbs):
+            if max(len(pair1_reads), len(pair2_reads)) < max_n_reads_to_store:
+                read_data = ReadData(
+                    rd_strand, int(data.read_len[i]), 
+                    data.read_groups[data.read_grp[i]], float(map_prb), 
+                    tuple(data.iter_blocks(i)))
+                if flag & 0x40:
+                    pair1_reads[data.qname(i)].append(read_data) 
+                else:
+                    pair2_reads[data.qname(i)].append(read_data) 
+    
     return ( pair1_reads, pair2_reads, 
              jn_reads['+'], jn_reads['-'], 
              cov, num_unique_reads )
@@ -402,6 +498,51 @@ def iter_paired_reads(p1_reads, p2_reads, fl_dist=None):
 
     return
 
+# the window size of the bam index's linear index
+BAI_LINEAR_INDEX_WINDOW_SIZE = 16384
+# the bin that stores the per contig meta data in a bam index
+BAI_PSEUDO_BIN = 37450
+
+def load_bai_linear_index( bai_fname ):
+    """Load the linear index, and the number of mapped reads, for each contig.
+
+    Returns a list, in reference order, of (n_mapped_reads, offsets) where 
+    offsets[i] is the compressed file offset of the first read that overlaps 
+    window i, and offsets[-1] is the offset of the end of the contig's reads.
+    """
+    with open(bai_fname, "rb") as fp:
+        data = fp.read()
+    if data[:4] != "BAI\1":
+        raise ValueError, "'%s' is not a bam index" % bai_fname
+    pos = 4
+    n_refs, = struct.unpack_from("<i", data, pos)
+    pos += 4
+    rv = []
+    for ref_i in xrange(n_refs):
+        n_mapped, contig_end = 0, 0
+        n_bins, = struct.unpack_from("<i", data, pos)
+        pos += 4
+        for bin_i in xrange(n_bins):
+            bin_id, n_chunks = struct.unpack_from("<Ii", data, pos)
+            pos += 8
+            chunks = numpy.frombuffer(
+                data, dtype='<u8', count=2*n_chunks, offset=pos)
+            pos += 16*n_chunks
+            if bin_id == BAI_PSEUDO_BIN:
+                contig_end, n_mapped = chunks[1], chunks[2]
+            elif n_chunks > 0:
+                contig_end = max(contig_end, chunks[1::2].max())
+        n_intervals, = struct.unpack_from("<i", data, pos)
+        pos += 4
+        offsets = numpy.frombuffer(
+            data, dtype='<u8', count=n_intervals, offset=pos)
+        pos += 8*n_intervals
+        # use the compressed offsets, and fill in empty windows
+        offsets = numpy.append(offsets, contig_end) >> 16
+        offsets = numpy.maximum.accumulate(offsets.astype(float))
+        rv.append((int(n_mapped), offsets))
+    return rv
+
 def get_contigs_and_lens( reads_files ):
     """Get contigs and their lengths from a set of bam files.
     
@@ -504,6 +645,32 @@ class MergedReads( object ):
     @property
     def mapped(self):
         return sum( reads.mapped for reads in self._reads )
+
+    @property
+    def has_read_index(self):
+        return all(reads.has_read_index for reads in self._reads)
+
+    def count_fragments( self ):
+        return sum( reads.count_fragments() for reads in self._reads )
+    
+    def iter_read_index_queries( self, chrm, start=None, stop=None ):
+        for reads in self._reads:
+            yield reads.query_read_index( chrm, start, stop )
+        return
+
+    def estimate_read_density( self, window_size ):
+        rv = {}
+        for reads in self._reads:
+            for contig, density in reads.estimate_read_density(
+                    window_size).iteritems():
+                if contig not in rv: 
+                    rv[contig] = density
+                else:
+                    n = max(len(rv[contig]), len(density))
+                    rv[contig] = numpy.append(
+                        rv[contig], numpy.zeros(n-len(rv[contig])))
+                    rv[contig][:len(density)] += density
+        return rv
     
     def fetch(*args, **kwargs):
         # this should be true because self is implicitly the first argument
@@ -524,12 +691,19 @@ class MergedReads( object ):
                 yield res    
         return
     
-    def iter_paired_reads( self, chrm, strand, start, stop ):
+    def iter_paired_reads( self, chrm, strand, start, stop, streaming=False ):
         for reads in self._reads:
-            for rd1, rd2 in reads.iter_paired_reads(chrm, strand, start, stop):
+            for rd1, rd2 in reads.iter_paired_reads(
+                    chrm, strand, start, stop, streaming):
                 yield rd1, rd2
         return
     
+    def iter_paired_read_blocks( self, chrm, strand, start, stop ):
+        for reads in self._reads:
+            for res in reads.iter_paired_read_blocks(chrm, strand, start, stop):
+                yield res
+        return
+    
     def build_read_coverage_array( self, chrm, strand, 
                                    start, stop, read_pair=None ):
         assert stop >= start
@@ -551,12 +725,32 @@ class TranscriptMappedReads( pysam.Samfile ):
     pass
 
 
+# the source of Reads.reads_version - see ReadsPool
+READS_VERSIONS = count()
+
 class Reads( pysam.Samfile ):
     """Subclass the samfile object to include a method that returns reads 
        and their pairs.
 
 
     """ 
+    # every time that the fl dists or read counts are set, the reads get a 
+    # new (never re-used) version, so that ReadsPool never returns a handle
+    # with stale values
+    def _get_fl_dists(self):
+        return self._fl_dists
+    def _set_fl_dists(self, fl_dists):
+        self._fl_dists = fl_dists
+        self.reads_version = next(READS_VERSIONS)
+    fl_dists = property(_get_fl_dists, _set_fl_dists)
+
+    def _get_num_reads(self):
+        return self._num_reads
+    def _set_num_reads(self, num_reads):
+        self._num_reads = num_reads
+        self.reads_version = next(READS_VERSIONS)
+    num_reads = property(_get_num_reads, _set_num_reads)
+
     def _build_chrm_mapping(self):
         self._canonical_to_chrm_name_mapping = {}
         for ref_name in self.references:
@@ -596,6 +790,7 @@ class Reads( pysam.Samfile ):
         
         self.fl_dists = None
         self.num_reads = None
+        self.read_index = None
         
         try:
             self.fetch( self.references[0], 10000 )
@@ -637,6 +832,97 @@ class Reads( pysam.Samfile ):
         else:
             return '.'
     
+    def load_read_index( self, build_if_missing=True ):
+        """Attach the columnar read index, building it if necessary.
+
+        """
+        self.read_index = load_read_index(self, build_if_missing)
+        return self
+
+    @property
+    def has_read_index( self ):
+        return self.read_index is not None
+
+    def query_read_index( self, chrm, start=None, stop=None ):
+        """Find the reads overlapping [start, stop) using the read index.
+        
+        Returns the IndexedContig, the indices of the overlapping reads, and
+        an array of their strands. 
+        """
+        assert self.read_index is not None
+        try: contig = self.fix_chrm_name(chrm)
+        except KeyError: return None, numpy.zeros(0, dtype=int), None
+        data = self.read_index.contig(contig)
+        if data is None: return None, numpy.zeros(0, dtype=int), None
+        indices = data.find_overlapping_reads(start, stop)
+        if self.reads_are_stranded:
+            rd_strands = numpy.where(calc_read_strands(
+                data.flag[indices], self.reverse_read_strand, 
+                self.pairs_are_opp_strand), '+', '-')
+        else:
+            rd_strands = numpy.repeat('.', len(indices))
+        return data, indices, rd_strands
+
+    def iter_read_index_queries( self, chrm, start=None, stop=None ):
+        yield self.query_read_index(chrm, start, stop)
+        return
+
+    def count_fragments( self ):
+        """Count the fragments (single reads or read pairs) in the bam.
+
+        If the read index is loaded then the count is exact (and skips 
+        duplicates), otherwise it is estimated from the number of mapped 
+        reads in the bam index.
+        """
+        if self.read_index is None:
+            if self.reads_are_paired: return self.mapped//2
+            return self.mapped
+        
+        num_frags = 0
+        for contig in self.references:
+            data = self.read_index.contig(contig)
+            if data is None: continue
+            # count every pair once, through its first read
+            flag = numpy.asarray(data.flag)
+            num_frags += int( ( ((flag & BAM_FPAIRED) == 0) 
+                                | ((flag & BAM_FREAD1) > 0) ).sum() )
+        return num_frags
+
+    def estimate_read_density( self, window_size ):
+        """Estimate the number of reads in each window of every contig.
+
+        If the read index is loaded then the counts are exact, otherwise
+        they are estimated from the bam index: the reads are distributed 
+        across windows in proportion to the (compressed) bytes that the 
+        linear index assigns to each window. Returns a dict keyed by the
+        cleaned contig names.
+        """
+        rv = {}
+        if self.read_index is not None:
+            for contig in self.references:
+                data = self.read_index.contig(contig)
+                if data is None: continue
+                rv[clean_chr_name(contig)] = numpy.bincount(
+                    numpy.asarray(data.start)//window_size).astype(float)
+            return rv
+        
+        assert window_size % BAI_LINEAR_INDEX_WINDOW_SIZE == 0, \
+            "The window size must be a multiple of the bam index window size"
+        linear_index = load_bai_linear_index(self.filename + ".bai")
+        for contig, (n_mapped, offsets) in izip(
+                self.references, linear_index):
+            if n_mapped == 0 or len(offsets) < 2: continue
+            n_bytes = numpy.diff(offsets)
+            if n_bytes.sum() == 0: n_bytes += 1
+            density = n_mapped*n_bytes/n_bytes.sum()
+            # aggregate the linear index windows
+            n_merge = window_size/BAI_LINEAR_INDEX_WINDOW_SIZE
+            density = numpy.append(
+                density, numpy.zeros((-len(density))%n_merge))
+            rv[clean_chr_name(contig)] = density.reshape(
+                (-1, n_merge)).sum(1)
+        return rv
+    
     def iter_reads_and_strand( self, chrm, start=None, stop=None ):
         for read in self.fetch( chrm, start, stop  ):
             rd_strand = self.get_strand(read)
@@ -649,7 +935,58 @@ class Reads( pysam.Samfile ):
                 yield read        
         return
 
-    def iter_paired_reads( self, chrm, strand, start, stop ):
+    def iter_paired_reads_streaming( self, chrm, strand, start, stop,
+                                     max_num_pending_mates=1e6 ):
+        """Iterate through read pairs in a single pass over the region.
+        
+        Mates are matched on qname and their positions (pos and mpos), and a
+        read is held in the pending buffer only until the reads have moved
+        past its mate's position. So, memory is bounded by the fragment 
+        length rather than by the number of reads in the region. Pairs are 
+        yielded as soon as the second mate is observed.
+        """
+        chrm = clean_chr_name( chrm )
+        # reads waiting for their mate, keyed by (qname, pos, mate pos)
+        pending_mates = {}
+        # a heap of (mate pos, read id, key) used to evict reads whose mate
+        # was not observed
+        pending_mate_poss = []
+        for read_id, read in enumerate(
+                self.iter_reads(chrm, strand, start, stop)):
+            # drop the reads whose mate should have already been observed
+            while len(pending_mate_poss) > 0 and (
+                    pending_mate_poss[0][0] < read.pos
+                    or len(pending_mates) > max_num_pending_mates ):
+                mpos, pending_id, key = heapq.heappop(pending_mate_poss)
+                if key in pending_mates and pending_mates[key][0]==pending_id:
+                    del pending_mates[key]
+                    if DEBUG:
+                        config.log_statement("No mate: ", key)
+            
+            if not read.is_paired or read.rnext != read.tid: continue
+            
+            mate_key = (read.qname, read.mpos, read.pos)
+            if ( mate_key in pending_mates 
+                 and pending_mates[mate_key][1].is_read1 != read.is_read1 ):
+                mate = pending_mates.pop(mate_key)[1]
+                if read.is_read1: yield read, mate
+                else: yield mate, read
+            # if the mate is upstream of this read and it's not pending, 
+            # then it isn't in this region
+            elif read.mpos >= read.pos:
+                key = (read.qname, read.pos, read.mpos)
+                pending_mates[key] = (read_id, read)
+                heapq.heappush(pending_mate_poss, (read.mpos, read_id, key))
+        
+        return
+
+    def iter_paired_reads( self, chrm, strand, start, stop, streaming=False ):
+        if streaming:
+            for rd1, rd2 in self.iter_paired_reads_streaming(
+                    chrm, strand, start, stop):
+                yield rd1, rd2
+            return
+        
         # whether or not the gene is on the positive strand
         gene_strnd_is_rev = ( strand == '-' )
         chrm = clean_chr_name( chrm )
@@ -692,50 +1029,159 @@ class Reads( pysam.Samfile ):
 
         return
 
+    def _find_paired_read_blocks_in_index( self, chrm, strand, start, stop ):
+        data, indices, rd_strands = self.query_read_index(chrm, start, stop)
+        if data is None: return None
+        if strand is not None:
+            indices = indices[(rd_strands == '.')|(rd_strands == strand)]
+        if len(indices) == 0: return None
+        
+        # pair every first read with its mate, if the mate was also selected
+        flag = data.flag[indices]
+        mates = data.mate[indices]
+        mate_is = indices.searchsorted(mates).clip(0, len(indices)-1)
+        has_mate = (mates >= 0) & (indices[mate_is] == mates)
+        r1s = has_mate & ((flag & BAM_FREAD1) > 0)
+        r1s[r1s] = (flag[mate_is[r1s]] & BAM_FREAD1) == 0
+        r1_indices = indices[r1s]
+        r2_indices = mates[r1s]
+
+        # the blocks of the reads, in (read 1, read 2) order
+        read_indices = numpy.column_stack((r1_indices, r2_indices)).ravel()
+        blk_indices = data.block_indices(read_indices)
+        blk_offsets = numpy.zeros(len(read_indices)+1, dtype=numpy.int64)
+        blk_offsets[1:] = ( data.blk_offsets[read_indices+1] 
+                            - data.blk_offsets[read_indices] ).cumsum()
+
+        read_lens = numpy.asarray(data.read_len[r1_indices], dtype=numpy.int64)
+        read_lens[read_lens != data.read_len[r2_indices]] = -1
+        read_grp_ids = numpy.asarray(
+            data.read_grp[r1_indices], dtype=numpy.int64)
+        read_grp_ids[read_grp_ids != data.read_grp[r2_indices]] = -1
+        
+        return ( numpy.asarray(data.blk_start[blk_indices], dtype=numpy.int64),
+                 numpy.asarray(data.blk_stop[blk_indices], dtype=numpy.int64),
+                 blk_offsets, read_lens, read_grp_ids, data.read_groups )
+    
+    def iter_paired_read_blocks( self, chrm, strand, start, stop ):
+        """Find the aligned blocks of every read pair in a region.
+
+        Yields a single tuple of: the (inclusive) block starts and stops, 
+        the block offsets of every read (the reads of pair i are 2i and 
+        2i+1), the read length of every pair (-1 if the mates' lengths 
+        differ), the index of every pair's read group into the list of 
+        read group names (-1 if the mates' read groups differ), and the
+        read group names. The pairs are the same as iter_paired_reads 
+        (with streaming set) returns, but if the read index is loaded then 
+        the bam is never read.
+        """
+        if self.read_index is not None:
+            res = self._find_paired_read_blocks_in_index(
+                chrm, strand, start, stop)
+            if res is not None: yield res
+            return
+        
+        blk_starts, blk_stops = array('l'), array('l')
+        blk_offsets = array('l', [0,])
+        read_lens, read_grp_ids = array('l'), array('l')
+        read_grps = {}
+        for r1, r2 in self.iter_paired_reads(
+                chrm, strand, start, stop, streaming=True):
+            if r1.rlen == 0: 
+                rlen = sum( x[1] for x in r1.cigar if x[0] == 0 )
+            else: 
+                rlen = r1.rlen
+                if rlen != r2.rlen:
+                    if config.DEBUG_VERBOSE:
+                        config.log_statement(
+                            "WARNING: read lengths are not the same for %s and %s" % (
+                                r1.qname, r2.qname),
+                            log=True, display=False)
+                    rlen = -1
+            read_lens.append(rlen)
+            
+            rg = get_read_group( r1, r2 )
+            if rg is None: 
+                read_grp_ids.append(-1)
+            else:
+                read_grp_ids.append(read_grps.setdefault(rg, len(read_grps)))
+            
+            for rd in (r1, r2):
+                for blk_start, blk_stop in iter_coverage_intervals_for_read(rd):
+                    blk_starts.append(blk_start)
+                    blk_stops.append(blk_stop)
+                blk_offsets.append(len(blk_starts))
+        
+        read_grp_names = [None]*len(read_grps)
+        for rg, i in read_grps.iteritems(): read_grp_names[i] = rg
+        yield tuple( numpy.frombuffer(x, dtype=numpy.int64) 
+                     for x in (blk_starts, blk_stops, blk_offsets, 
+                               read_lens, read_grp_ids) 
+                     ) + (read_grp_names,)
+        return
+    
     def build_read_coverage_array( self, chrm, strand, 
                                    start, stop, read_pair=None ):
         assert stop >= start
         full_region_len = stop - start + 1
         cvg = numpy.zeros(full_region_len)
+        if self.read_index is not None:
+            data, indices, rd_strands = self.query_read_index(
+                chrm, start, stop)
+            if data is None: return cvg
+            if strand is not None:
+                indices = indices[(rd_strands == '.')|(rd_strands == strand)]
+            if read_pair == 1:
+                indices = indices[(data.flag[indices] & 0x40) > 0]
+            elif read_pair == 2:
+                indices = indices[(data.flag[indices] & 0x80) > 0]
+            blk_indices = data.block_indices(indices)
+            # note that the stop base of each block is not counted
+            return build_coverage_from_intervals(
+                data.blk_start[blk_indices], data.blk_stop[blk_indices], 
+                start, full_region_len)
+        
+        blk_starts, blk_stops = [], []
         for rd in self.iter_reads( chrm, strand, start, stop ):
             if read_pair is not None:
                 if read_pair==1 and not rd.is_read1: continue
                 if read_pair==2 and not rd.is_read2: continue
-            for region in iter_coverage_regions_for_read( 
-                    rd, self, self.RRR, self.PAOS):
-                cvg[max(0, region[2]-start):max(0, region[3]-start)] += 1
+            for blk_start, blk_stop in iter_coverage_intervals_for_read(rd):
+                blk_starts.append(blk_start)
+                blk_stops.append(blk_stop)
         
-        return cvg
+        return build_coverage_from_intervals(
+            blk_starts, blk_stops, start, full_region_len)
 
     def build_paired_reads_fragment_coverage_array( 
             self, chrm, strand, start, stop ):
         assert stop >= start
         full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
+        frag_starts, frag_stops = [], []
         for rd1, rd2 in self.iter_paired_reads( chrm, strand, start, stop ):
-            start = min(rd1.pos, rd2.pos)
-            stop = min(rd1.aend, rd2.aend)
-            cvg[max(0, region[2]-start):max(0, region[3]-start)] += 1
+            frag_starts.append(min(rd1.pos, rd2.pos))
+            frag_stops.append(max(rd1.aend, rd2.aend))
         
-        return cvg
+        return build_coverage_from_intervals(
+            frag_starts, frag_stops, start, full_region_len)
 
     def build_unpaired_reads_fragment_coverage_array( 
             self, chrm, strand, start, stop, frag_len ):
         assert stop >= start
         full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
+        frag_starts, frag_stops = [], []
         for rd, strand in self.iter_reads_and_strand(chrm, start, stop):
             if strand == '-': 
-                rd_start = rd.pos - frag_len
-                rd_stop = rd.pos
+                frag_starts.append(rd.pos - frag_len)
+                frag_stops.append(rd.pos)
             elif strand == '+': 
-                rd_start = rd.pos
-                rd_stop = rd.pos + frag_len
+                frag_starts.append(rd.pos)
+                frag_stops.append(rd.pos + frag_len)
             else:
                 assert False
-            cvg[max(0, rd_start-start):max(0, rd_stop-start)] += 1
         
-        return cvg
+        return build_coverage_from_intervals(
+            frag_starts, frag_stops, start, full_region_len)
 
 
     def reload( self ):
@@ -744,12 +1190,14 @@ class Reads( pysam.Samfile ):
         fl_dists = self.fl_dists
         num_reads = self.num_reads
         kw_args = self._init_kwargs
+        read_index = self.read_index
         #self.close()
         
         reads = type(self)(fname)
         reads.init(**kw_args)
         reads.fl_dists = fl_dists
         reads.num_reads = num_reads
+        reads.read_index = read_index
         return reads
 
 class RNAseqReads(Reads):    
@@ -1039,20 +1487,20 @@ class ChIPSeqReads(Reads):
             window_size = self.frag_len
         assert stop >= start
         full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
+        frag_starts, frag_stops = [], []
         for rd, strand in self.iter_reads_and_strand(chrm, start, stop):
             if strand == '+': 
-                rd_start = rd.pos
-                rd_stop = rd.pos + window_size
+                frag_starts.append(rd.pos)
+                frag_stops.append(rd.pos + window_size)
             elif strand == '-': 
-                rd_start = rd.aend - window_size
-                rd_stop = rd.aend
+                frag_starts.append(rd.aend - window_size)
+                frag_stops.append(rd.aend)
             else:
                 assert False
-            cvg[max(0, rd_start-start):max(0, rd_stop-start)] += (
-                1.0/(rd_stop-rd_start+1))
-
-        return cvg
+        
+        return build_coverage_from_intervals(
+            frag_starts, frag_stops, start, full_region_len, 
+            weights=numpy.repeat(1.0/(window_size+1), len(frag_starts)))
 
     def build_read_coverage_array(self, chrm, strand, start, stop, read_pair=None):
         assert read_pair is None
@@ -1145,3 +1593,97 @@ class DNASESeqReads(Reads):
         }
         
         return self
+
+class ReadsPool( object ):
+    """A per process pool of open reads objects.
+
+    Re-opening a bam (and re-running init) in every worker, or on every 
+    region, is expensive, so each process opens every bam once and then 
+    re-uses the handle, along with its bgzf state. Handles are keyed by the 
+    reads type, the file name and the init arguments (the read strand and 
+    pair flags), and by the reads' version, which changes whenever the fl 
+    dists or read counts are set, so that the same bam used in two samples
+    gets two handles. Handles are never shared across processes: the pool 
+    is emptied the first time that it is used after a fork.
+    """
+    def __init__(self):
+        self._pid = None
+        self._handles = {}
+        # the number of bams opened, and the number of handles requested,
+        # by each stage in this process
+        self.num_opens = defaultdict(int)
+        self.num_requests = defaultdict(int)
+        return
+    
+    @staticmethod
+    def _key( reads ):
+        # ref_genes is only used to detect the read strand, and that has 
+        # already been done
+        init_kwargs = tuple(sorted(
+            (key, val) for key, val in reads._init_kwargs.iteritems()
+            if key != 'ref_genes' ))
+        return ( type(reads), reads.filename, init_kwargs, reads.reads_version )
+    
+    def get( self, reads, stage=None ):
+        """Return an open handle, in this process, for reads.
+
+        reads can be a Reads or a MergedReads object, and stage is used to 
+        count the opens.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._handles = {}
+            self.num_opens = defaultdict(int)
+            self.num_requests = defaultdict(int)
+        
+        if isinstance(reads, MergedReads):
+            new_reads = MergedReads([ self.get(x, stage) for x in reads._reads ])
+            new_reads.fl_dists = reads.fl_dists
+            new_reads.num_reads = reads.num_reads
+            return new_reads
+        
+        self.num_requests[stage] += 1
+        key = self._key(reads)
+        try: 
+            handle = self._handles[key]
+        except KeyError:
+            handle = reads.reload()
+            self._handles[key] = handle
+            self.num_opens[stage] += 1
+            if config.DEBUG_VERBOSE:
+                config.log_statement( 
+                    "%i: Opened '%s' for %s (%i opens, %i requests)" % (
+                        os.getpid(), reads.filename, stage, 
+                        self.num_opens[stage], self.num_requests[stage]) )
+        else:
+            # the read index may have been loaded after the handle was opened
+            if handle.read_index is None:
+                handle.read_index = reads.read_index
+        return handle
+    
+    def log_stats( self ):
+        # only log the stats that were collected in this process
+        if self._pid != os.getpid(): return
+        for stage in sorted(self.num_requests):
+            config.log_statement(
+                "%i: Reads pool (%s): %i opens for %i requests" % (
+                    os.getpid(), stage, self.num_opens[stage], 
+                    self.num_requests[stage]), log=True )
+        return
+
+READS_POOL = ReadsPool()
+
+def get_reads_handle( reads, stage=None ):
+    """Return this process's open handle for reads (which may be None).
+
+    """
+    if reads is None: return None
+    return READS_POOL.get(reads, stage)
+
+def log_reads_pool_stats():
+    """Log the reads pool's opens and requests in this process.
+
+    Workers call this when they finish.
+    """
+    READS_POOL.log_stats()
+    return
@@ -45,7 +45,8 @@ from genes import (
 from files.reads import MergedReads, RNAseqReads, CAGEReads, \
     RAMPAGEReads, PolyAReads, \
     fix_chrm_name_for_ucsc, get_contigs_and_lens, \
-    iter_paired_reads, extract_jns_and_reads_in_region
+    iter_paired_reads, extract_jns_and_reads_in_region, get_reads_handle, \
+    log_reads_pool_stats
 import files.junctions
 from files.bed import create_bed_line
 from files.gtf import parse_gtf_line, load_gtf
@@ -196,24 +197,36 @@ def find_polya_peak_bins_in_gene( gene, polya_reads, rnaseq_reads ):
     return polya_sites
 
 def find_peaks( cov, window_len, min_score, max_score_frac, max_num_peaks ):    
-    def overlaps_prev_peak( new_loc ):
-        for start, stop in peaks:
-            if not( new_loc > stop or new_loc + window_len < start ):
-                return True
-        return False
+    cumsum_cvg_array = (
+        numpy.append(0, numpy.cumsum( cov )) )
+    
+    # sum cov[start:stop]. If the coverage is integral then the prefix sums
+    # are exact, otherwise they can round differently than the slice sums
+    # which would change the grow decisions, so we sum the slice
+    if ( numpy.all(cov == numpy.floor(cov)) 
+         and cumsum_cvg_array[-1] < 2**52 ):
+        def sum_cov( start, stop ):
+            start = min(start, len(cov))
+            stop = min(stop, len(cov))
+            if stop <= start: return 0.0
+            return cumsum_cvg_array[stop] - cumsum_cvg_array[start]
+    else:
+        def sum_cov( start, stop ):
+            return cov[start:stop].sum()
     
     # merge the peaks
     def grow_peak( start, stop, grow_size=
                    max(1, window_len/4), min_grow_ratio=config.MAX_CAGE_FRAC ):
         # grow a peak at most max_num_peaks times
-        max_mean_signal = cov[start:stop+1].mean()
+        max_mean_signal = ( 
+            sum_cov(start, stop+1)/float(min(stop+1, len(cov))-start) )
         for i in xrange(max_num_peaks):
-            curr_signal = cov[start:stop+1].sum()
+            curr_signal = sum_cov(start, stop+1)
             if curr_signal < min_score:
                 return ( start, stop )
             
-            downstream_sig = float(cov[max(0, start-grow_size):start].sum())/grow_size
-            upstream_sig = float(cov[stop+1:stop+1+grow_size].sum())/grow_size
+            downstream_sig = float(sum_cov(max(0, start-grow_size), start))/grow_size
+            upstream_sig = float(sum_cov(stop+1, stop+1+grow_size))/grow_size
             
             # if neither passes the threshold, then return the current peak
             if max(upstream_sig, downstream_sig) \
@@ -234,67 +247,57 @@ def find_peaks( cov, window_len, min_score, max_score_frac, max_num_peaks ):
         if config.VERBOSE:
             config.log_statement( 
                 "Warning: reached max peak iteration at %i-%i ( signal %.2f )"
-                    % (start, stop, cov[start:stop+1].sum() ) )
+                    % (start, stop, sum_cov(start, stop+1) ) )
         return (start, stop )
     
     peaks = []
     peak_scores = []
-    cumsum_cvg_array = (
-        numpy.append(0, numpy.cumsum( cov )) )
     scores = cumsum_cvg_array[window_len:] - cumsum_cvg_array[:-window_len]
     indices = numpy.argsort( scores )
     min_score = max( min_score, config.MAX_CAGE_FRAC*scores[ indices[-1] ] )
-    for index in reversed(indices):
-        if not overlaps_prev_peak( index ):
-            score = scores[ index ]
-            new_peak = grow_peak( index, index + window_len )
-            # if we are below the minimum score, then we are done
-            if score < min_score:
+    # we stop at the first window that doesn't overlap a peak and is below 
+    # the minimum score, so we only need to consider the windows with scores
+    # of at least min_score, in decreasing order
+    num_candidates = int((scores >= min_score).sum())
+    candidates = indices[len(indices)-num_candidates:][::-1]
+    # window locations that overlap a previously found peak - a window at 
+    # loc overlaps the peak (start, stop) if start-window_len <= loc <= stop
+    overlaps_prev_peak = numpy.zeros(len(scores), dtype=bool)
+    for index in candidates.tolist():
+        if overlaps_prev_peak[index]: continue
+        score = scores[ index ]
+        
+        # if we have observed peaks, and the ratio between the highest
+        # and the lowest is sufficeintly high, we are done
+        if len( peak_scores ) > 0:
+            if float(score)/peak_scores[0] < max_score_frac:
                 break
-            
-            # if we have observed peaks, and the ratio between the highest
-            # and the lowest is sufficeintly high, we are done
-            if len( peak_scores ) > 0:
-                if float(score)/peak_scores[0] < max_score_frac:
-                    break
-                        
-            peaks.append( new_peak ) 
-            peak_scores.append( score )
+        
+        new_peak = grow_peak( index, index + window_len )
+        peaks.append( new_peak ) 
+        peak_scores.append( score )
+        overlaps_prev_peak[max(0, new_peak[0]-window_len):new_peak[1]+1] = True
     
     if len( peaks ) == 0:
         return []
     
-    # merge cage peaks together
-    def merge_peaks( peaks_and_scores ):
-        peaks_and_scores = sorted( list(x) for x in peaks_and_scores )
-        peak, score = peaks_and_scores.pop()
-        new_peaks = [peak,]
-        new_scores = [score,]
-        while len(peaks_and_scores) >  0:
-            last_peak = new_peaks[-1]
-            peak, score = peaks_and_scores.pop()
-            new_peak = (min(peak[0], last_peak[0]), max(peak[1], last_peak[1]))
-            if (new_peak[1] - new_peak[0]) <= 1.5*( 
-                    last_peak[1] - last_peak[0] + peak[1] - peak[0] ):
-                new_peaks[-1] = new_peak
-                new_scores[-1] += score
-            else:
-                new_peaks.append( peak )
-                new_scores.append( score )
-        
-        return zip( new_peaks, new_scores )
-    
-    peaks_and_scores = sorted( zip(peaks, peak_scores) )
-    
-    for i in xrange( 99 ):
-        if i == 100: assert False
-        old_len = len( peaks_and_scores )
-        peaks_and_scores = merge_peaks( peaks_and_scores )
-        if len( peaks_and_scores ) == old_len: break
+    # merge cage peaks together. We sweep the peaks from right to left, and
+    # after every merge re-check the merged peak against the previous one, 
+    # so a single pass reaches the point where no neighbors can be merged
+    def can_merge( peak_1, peak_2 ):
+        new_peak = (min(peak_1[0], peak_2[0]), max(peak_1[1], peak_2[1]))
+        return (new_peak[1] - new_peak[0]) <= 1.5*( 
+            peak_1[1] - peak_1[0] + peak_2[1] - peak_2[0] )
     
+    merged_peaks = []
+    for peak in sorted( peaks, reverse=True ):
+        while len(merged_peaks) > 0 and can_merge(merged_peaks[-1], peak):
+            last_peak = merged_peaks.pop()
+            peak = (min(peak[0], last_peak[0]), max(peak[1], last_peak[1]))
+        merged_peaks.append( peak )
         
     new_peaks_and_scores = []
-    for peak, score in peaks_and_scores:
+    for peak in merged_peaks:
         peak_scores = cov[peak[0]:peak[1]+1]
         max_score = peak_scores.max()
         good_indices = (peak_scores >= max_score*config.MAX_CAGE_FRAC).nonzero()[0]
@@ -1083,9 +1086,9 @@ def find_exons_in_gene( gene, contig_lens, ofp,
 def find_exons_worker( (genes_queue, genes_queue_lock, n_threads_running), 
                        ofp, contig_lens, ref_elements, ref_elements_to_include,
                        rnaseq_reads, cage_reads, polya_reads ):
-    rnaseq_reads = rnaseq_reads.reload()
-    cage_reads = cage_reads.reload() if cage_reads is not None else None
-    polya_reads = polya_reads.reload() if polya_reads is not None else None
+    rnaseq_reads = get_reads_handle(rnaseq_reads, 'find_exons')
+    cage_reads = get_reads_handle(cage_reads, 'find_exons')
+    polya_reads = get_reads_handle(polya_reads, 'find_exons')
     
     while True:
         # try to get a gene
@@ -1105,6 +1108,7 @@ def find_exons_worker( (genes_queue, genes_queue_lock, n_threads_running),
         elif gene is None:
             with genes_queue_lock:
                 if len(genes_queue) == 0 and n_threads_running.value == 0:
+                    log_reads_pool_stats()
                     return
                 else: continue
 
@@ -94,6 +94,19 @@ class FlDist( object ):
             return False
         assert False
 
+    @property
+    def fl_density_cumsum_cumsum(self):
+        """The cumsum of the cumsum, used to sum cumsum entries in constant time.
+
+        This is built on first use, so that FlDists that were pickled before
+        it was added still work.
+        """
+        try: 
+            return self._fl_density_cumsum_cumsum
+        except AttributeError:
+            self._fl_density_cumsum_cumsum = self.fl_density_cumsum.cumsum()
+            return self._fl_density_cumsum_cumsum
+
     def mean_fragment_length(self):
         return float((self.fl_density*numpy.arange( 
                     self.fl_min, self.fl_max+1 )).sum())
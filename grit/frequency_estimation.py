@@ -26,7 +26,9 @@ from itertools import izip
 import numpy
 numpy.seterr(all='ignore')
 
-from scipy.linalg import svd, inv
+import scipy.sparse
+
+from scipy.linalg import svd, inv, pinv
 from scipy.stats import chi2
 from scipy.optimize import brentq, fminbound, nnls
 from scipy.io import savemat
@@ -48,8 +50,13 @@ DEBUG_OPTIMIZATION = False
 PROMOTER_SIZE = 50
 LHD_ABS_TOL = 1e-5
 PARAM_ABS_TOL = 1e-8
+# the weight of the MLE in the profile lhd warm starts
+WARM_START_MLE_WEIGHT = 1e-2
 
 MAX_NUM_ITERATIONS = 1000
+MAX_NUM_EM_ITERATIONS = 100000
+
+MLE_SOLVERS = ('linesearch', 'em', 'squarem')
 
 class TooFewReadsError( ValueError ):
     pass
@@ -74,9 +81,24 @@ except ImportError:
 
 import sparsify_support_fns
 
+def _csr_arrays( expected_array ):
+    """Return the data, indices and indptr arrays of a csr expected array.
+
+    """
+    if not scipy.sparse.isspmatrix_csr(expected_array):
+        expected_array = expected_array.tocsr()
+    return ( numpy.asarray(expected_array.data, dtype=numpy.double), 
+             numpy.asarray(expected_array.indices, dtype=numpy.int32), 
+             numpy.asarray(expected_array.indptr, dtype=numpy.int32) )
+
 def calc_lhd( freqs, observed_array, expected_array, 
               sparse_penalty=0, sparse_index=None ):
-    rv = sparsify_support_fns.calc_lhd(freqs, observed_array, expected_array)
+    if scipy.sparse.issparse(expected_array):
+        rv = sparsify_support_fns.calc_lhd_csr(
+            freqs, observed_array, *_csr_arrays(expected_array))
+    else:
+        rv = sparsify_support_fns.calc_lhd(
+            freqs, observed_array, expected_array)
 
     if sparse_penalty > 0:
         if sparse_index is not None:
@@ -90,8 +112,12 @@ def calc_lhd( freqs, observed_array, expected_array,
 
 def calc_gradient( freqs, observed_array, expected_array,
                    sparse_penalty=0, sparse_index=None):
-    rv = sparsify_support_fns.calc_gradient(
-        freqs, observed_array, expected_array)
+    if scipy.sparse.issparse(expected_array):
+        rv = sparsify_support_fns.calc_gradient_csr(
+            freqs, observed_array, *_csr_arrays(expected_array))
+    else:
+        rv = sparsify_support_fns.calc_gradient(
+            freqs, observed_array, expected_array)
     if sparse_penalty > 0:
         if sparse_index is not None:
             penalty = math.log(sparse_penalty) - 2*math.log(freqs[sparse_index])
@@ -102,6 +128,17 @@ def calc_gradient( freqs, observed_array, expected_array,
     
     return rv
 
+def calc_em_step( freqs, observed_array, expected_array ):
+    """Take an EM step from freqs.
+
+    Returns the new freqs, and the (unpenalized) lhd of freqs.
+    """
+    if scipy.sparse.issparse(expected_array):
+        return sparsify_support_fns.calc_em_step_csr(
+            freqs, observed_array, *_csr_arrays(expected_array))
+    return sparsify_support_fns.calc_em_step(
+        freqs, observed_array, expected_array)
+
 def is_row_identifiable(X, i_to_check):
     import scipy.optimize
     
@@ -443,15 +480,19 @@ def estimate_transcript_frequencies_with_cvxopt(
 
 def estimate_transcript_frequencies_sparse(  
         observed_array, full_expected_array,
-        min_sparse_penalty, sparse_index ):
+        min_sparse_penalty, sparse_index, return_num_iterations=False ):
     if observed_array.sum() == 0:
         raise TooFewReadsError, (
             "Too few reads (%i)" % observed_array.sum() )
     
     n = full_expected_array.shape[1]
     if n == 1:
+        if return_num_iterations:
+            return numpy.ones( 1, dtype=float ), 0
         return numpy.ones( 1, dtype=float )
     
+    num_iterations = 0
+    
     #x = project_onto_simplex(nnls(
     #        full_expected_array, observed_array)[0])
     x = numpy.ones(n, dtype=float)/n
@@ -471,6 +512,7 @@ def estimate_transcript_frequencies_sparse(
             observed_array, full_expected_array, x, 
             sparse_penalty, sparse_index,
             dont_zero=False, abs_tol=eps )
+        num_iterations += len(lhds)
         lhd = calc_lhd( x, observed_array, full_expected_array, 
                         sparse_penalty, sparse_index )
         prev_lhd = calc_lhd( prev_x, observed_array, full_expected_array,
@@ -496,6 +538,7 @@ def estimate_transcript_frequencies_sparse(
             observed_array, full_expected_array, x, 
             sparse_penalty, sparse_index,
             dont_zero=True, abs_tol=LHD_ABS_TOL )
+        num_iterations += len(lhds)
         lhd = calc_lhd( x, observed_array, full_expected_array, 
                         sparse_penalty, sparse_index)
         prev_lhd = calc_lhd( prev_x, observed_array, full_expected_array,
@@ -508,6 +551,8 @@ def estimate_transcript_frequencies_sparse(
         start_time = time.time()
         if len( lhds ) < 500: break
     
+    if return_num_iterations:
+        return x, num_iterations
     return x
 
 def estimate_sparse_transcript_frequencies(observed_array, full_expected_array):
@@ -533,13 +578,256 @@ def estimate_sparse_transcript_frequencies(observed_array, full_expected_array):
     
     return best_x
 
-def estimate_transcript_frequencies(observed_array, full_expected_array):
-    rv = estimate_transcript_frequencies_sparse(
-        observed_array, full_expected_array, 
-        None, None )
+def iterate_em( x, em_step, project, calc_x_lhd, use_squarem=True ):
+    """Iterate em_step from x until the lhd converges.
+
+    em_step(x) returns the next point and the lhd of x, project maps a point
+    back into the feasible region, and calc_x_lhd(x) returns the lhd of x.
+    If use_squarem is set, then the EM steps are accelerated with SQUAREM 
+    (Varadhan and Roland, 2008). Returns the final point, its lhd, and the 
+    number of EM steps that were taken.
+    """
+    prev_lhd = calc_x_lhd(x)
+    num_steps = 0
+    num_converged_iterations = 0
+    while num_steps < MAX_NUM_EM_ITERATIONS:
+        x1, lhd = em_step(x)
+        num_steps += 1
+        if not use_squarem:
+            new_x = x1
+        else:
+            x2, lhd1 = em_step(x1)
+            num_steps += 1
+            r = x1 - x
+            v = x2 - x1 - r
+            v_norm = numpy.sqrt((v**2).sum())
+            if v_norm == 0:
+                new_x = x2
+            else:
+                # the SqS3 step length, which is always at least a full step
+                alpha = min(-numpy.sqrt((r**2).sum())/v_norm, -1.)
+                new_x = project(x - 2*alpha*r + (alpha**2)*v)
+                # stabilize the extrapolated point with an EM step
+                new_x, extrap_lhd = em_step(new_x)
+                num_steps += 1
+                # if the extrapolation decreased the lhd, then fall back to
+                # the EM steps
+                if extrap_lhd < lhd1:
+                    new_x = x2
+        
+        curr_lhd = calc_x_lhd(new_x)
+        if DEBUG_OPTIMIZATION:
+            config.log_statement( "%i\t%.2f\t%.6e" % ( 
+                    num_steps, curr_lhd, curr_lhd - prev_lhd ) )
+        
+        if curr_lhd - prev_lhd < LHD_ABS_TOL:
+            num_converged_iterations += 1
+            if num_converged_iterations >= NUM_ITER_FOR_CONV:
+                break
+        else:
+            num_converged_iterations = 0
+        
+        if curr_lhd >= prev_lhd:
+            x = new_x
+            prev_lhd = curr_lhd
+    
+    return x, prev_lhd, num_steps
+
+def estimate_transcript_frequencies_em(  
+        observed_array, expected_array, use_squarem=True ):
+    """Estimate the transcript frequencies with EM.
+
+    If use_squarem is set, then the EM steps are accelerated with SQUAREM.
+    Returns the frequencies, and the number of EM steps that were taken.
+    """
+    if observed_array.sum() == 0:
+        raise TooFewReadsError, (
+            "Too few reads (%i)" % observed_array.sum() )
+    observed_array = numpy.asarray(observed_array, dtype=numpy.int)
+    if scipy.sparse.issparse(expected_array):
+        expected_array = expected_array.tocsr()
+    
+    n = expected_array.shape[1]
+    if n == 1:
+        return numpy.ones( 1, dtype=float ), 0
+    
+    def em_step(x):
+        new_x, lhd = calc_em_step(x, observed_array, expected_array)
+        return project_onto_simplex(new_x), lhd
+    
+    x, lhd, num_steps = iterate_em(
+        numpy.ones(n, dtype=float)/n, em_step, project_onto_simplex, 
+        lambda x: calc_lhd(x, observed_array, expected_array), 
+        use_squarem )
+    
+    x[x < MIN_TRANSCRIPT_FREQ] = MIN_TRANSCRIPT_FREQ
+    x = x/x.sum()
+    return x, num_steps
+
+def estimate_transcript_frequencies(observed_array, full_expected_array, 
+                                    solver=None, return_num_iterations=False):
+    """Estimate the transcript frequencies with solver.
+
+    solver is one of MLE_SOLVERS, and defaults to config.MLE_SOLVER. If 
+    return_num_iterations is set, then also return the number of iterations
+    (line searches for linesearch, and EM steps for em/squarem).
+    """
+    if solver is None:
+        solver = config.MLE_SOLVER
+    assert solver in MLE_SOLVERS, "Unrecognized MLE solver '%s'" % solver
+    
+    if solver == 'linesearch':
+        rv, num_iterations = estimate_transcript_frequencies_sparse(
+            observed_array, full_expected_array, 
+            None, None, return_num_iterations=True )
+    else:
+        rv, num_iterations = estimate_transcript_frequencies_em(
+            observed_array, full_expected_array, 
+            use_squarem=(solver == 'squarem') )
+    
+    if return_num_iterations:
+        return rv, num_iterations
     return rv
         
 
+def calc_em_step_batch( freqs, observed_arrays, expected_array ):
+    """Take an EM step from every column of freqs.
+
+    freqs is a (transcripts x samples) array, and observed_arrays is a
+    (bins x samples) array of counts. Returns the new freqs, and the 
+    (unpenalized) lhd of every column of freqs.
+    """
+    bin_freqs = expected_array.dot(freqs) + 1e-16
+    lhds = (observed_arrays*numpy.log(bin_freqs)).sum(0)
+    new_freqs = freqs*expected_array.T.dot(observed_arrays/bin_freqs)
+    return new_freqs/observed_arrays.sum(0), lhds
+
+def project_columns_onto_simplex( X ):
+    return numpy.column_stack([ 
+        project_onto_simplex(x) for x in X.T.copy() ])
+
+def iterate_em_batch( X, em_step, project, calc_X_lhds, use_squarem=True ):
+    """Iterate em_step from every column of X until their lhds converge.
+
+    This is iterate_em applied to each column of X, but every step is 
+    taken for all of the unconverged columns at once. em_step(X, cols) 
+    and calc_X_lhds(X, cols) take the points for the columns cols. Returns
+    the final points, their lhds, and the number of EM steps taken for 
+    each column.
+    """
+    X = X.copy()
+    prev_lhds = calc_X_lhds(X, numpy.arange(X.shape[1]))
+    num_steps = numpy.zeros(X.shape[1], dtype=int)
+    num_converged_iterations = numpy.zeros(X.shape[1], dtype=int)
+    cols = numpy.arange(X.shape[1])
+    while len(cols) > 0:
+        x = X[:,cols]
+        x1, lhds = em_step(x, cols)
+        num_steps[cols] += 1
+        if not use_squarem:
+            new_x = x1
+        else:
+            x2, lhds1 = em_step(x1, cols)
+            r = x1 - x
+            v = x2 - x1 - r
+            v_norms = numpy.sqrt((v**2).sum(0))
+            # the SqS3 step length, which is always at least a full step
+            alphas = -numpy.sqrt((r**2).sum(0))/numpy.where(
+                v_norms == 0, 1., v_norms)
+            alphas = numpy.minimum(alphas, -1.)
+            extrap_x = project(x - 2*alphas*r + (alphas**2)*v)
+            # stabilize the extrapolated points with an EM step
+            extrap_x, extrap_lhds = em_step(extrap_x, cols)
+            # if the extrapolation decreased the lhd, then fall back to
+            # the EM steps
+            use_em_steps = (v_norms == 0) | (extrap_lhds < lhds1)
+            new_x = numpy.where(use_em_steps, x2, extrap_x)
+            num_steps[cols] += numpy.where(v_norms == 0, 1, 2)
+        
+        curr_lhds = calc_X_lhds(new_x, cols)
+        converged = (curr_lhds - prev_lhds[cols] < LHD_ABS_TOL)
+        num_converged_iterations[cols] = numpy.where(
+            converged, num_converged_iterations[cols] + 1, 0)
+        
+        improved = (curr_lhds >= prev_lhds[cols])
+        X[:,cols[improved]] = new_x[:,improved]
+        prev_lhds[cols[improved]] = curr_lhds[improved]
+        
+        cols = cols[ (num_converged_iterations[cols] < NUM_ITER_FOR_CONV)
+                     & (num_steps[cols] < MAX_NUM_EM_ITERATIONS) ]
+    
+    return X, prev_lhds, num_steps
+
+def estimate_transcript_frequencies_em_batch(  
+        observed_arrays, expected_array, use_squarem=True ):
+    """Estimate the transcript frequencies of every column of 
+       observed_arrays with EM.
+
+    Returns a (transcripts x samples) array of frequencies, and the number 
+    of EM steps taken for each sample.
+    """
+    observed_arrays = numpy.asarray(observed_arrays, dtype=float)
+    if (observed_arrays.sum(0) == 0).any():
+        raise TooFewReadsError, "Too few reads (%i)" % (
+            observed_arrays.sum(0).min() )
+    expected_array = scipy.sparse.csr_matrix(expected_array)
+    
+    n, num_samples = expected_array.shape[1], observed_arrays.shape[1]
+    if n == 1:
+        return ( numpy.ones((1, num_samples), dtype=float), 
+                 numpy.zeros(num_samples, dtype=int) )
+    
+    def em_step(X, cols):
+        new_X, lhds = calc_em_step_batch(
+            X, observed_arrays[:,cols], expected_array)
+        return project_columns_onto_simplex(new_X), lhds
+
+    def calc_X_lhds(X, cols):
+        return ( observed_arrays[:,cols]*numpy.log(
+                expected_array.dot(X) + 1e-16) ).sum(0)
+    
+    X, lhds, num_steps = iterate_em_batch(
+        numpy.ones((n, num_samples), dtype=float)/n, em_step, 
+        project_columns_onto_simplex, calc_X_lhds, use_squarem )
+    
+    X[X < MIN_TRANSCRIPT_FREQ] = MIN_TRANSCRIPT_FREQ
+    X = X/X.sum(0)
+    return X, num_steps
+
+def estimate_transcript_frequencies_batch(
+        observed_arrays, full_expected_array, 
+        solver=None, return_num_iterations=False):
+    """Estimate the transcript frequencies of many samples that share an 
+       expected array.
+
+    observed_arrays is a (bins x samples) array of counts. The em and 
+    squarem solvers solve all of the samples at once, the linesearch solver
+    solves them one at a time. Returns a (transcripts x samples) array of 
+    frequencies, and (if return_num_iterations is set) the number of 
+    iterations for every sample.
+    """
+    if solver is None:
+        solver = config.MLE_SOLVER
+    assert solver in MLE_SOLVERS, "Unrecognized MLE solver '%s'" % solver
+    
+    if solver == 'linesearch':
+        rvs, num_iterations = [], []
+        for observed_array in numpy.asarray(observed_arrays).T:
+            rv, n_iter = estimate_transcript_frequencies_sparse(
+                observed_array, full_expected_array, 
+                None, None, return_num_iterations=True )
+            rvs.append(rv)
+            num_iterations.append(n_iter)
+        rv = numpy.column_stack(rvs)
+    else:
+        rv, num_iterations = estimate_transcript_frequencies_em_batch(
+            observed_arrays, full_expected_array, 
+            use_squarem=(solver == 'squarem') )
+    
+    if return_num_iterations:
+        return rv, num_iterations
+    return rv
+
 def estimate_confidence_bound( f_mat, 
                                num_reads_in_bams,
                                fixed_index,
@@ -704,6 +992,174 @@ def estimate_confidence_bound( f_mat,
     rv = chi2.sf( 2*(max_lhd-lhd), 1), value
     return rv    
 
+class ConfidenceBoundsEstimator(object):
+    """Estimate confidence bounds for the transcripts in a gene.
+
+    The work that is shared between the transcripts of a gene - building
+    the expected and observed arrays, the expected bin frequencies at the 
+    MLE, and the Fisher information - is done once. Each bound is then 
+    seeded from the quadratic approximation to the log likelihood at the 
+    MLE, and refined with a root find on the profile likelihood, which is 
+    maximized with (warm started) SQUAREM at every evaluation.
+    """
+    def __init__(self, f_mat, num_reads_in_bams, mle_estimate, alpha):
+        self.expected_array, self.observed_array = f_mat.expected_and_observed(
+            bam_cnts=num_reads_in_bams)
+        if scipy.sparse.issparse(self.expected_array):
+            self.expected_array = self.expected_array.tocsr()
+        self.observed_array = numpy.asarray(
+            self.observed_array, dtype=numpy.int)
+        self.n = self.expected_array.shape[1]
+        
+        self.mle = project_onto_simplex(numpy.array(mle_estimate, dtype=float))
+        self.max_lhd = self._calc_lhd(self.mle)
+        self.min_lhd = self.max_lhd - chi2.ppf( 1 - alpha, 1 )/2.
+        
+        self.variances = self._calc_variances()
+        self.num_profile_evaluations = 0
+        return
+    
+    def _calc_lhd(self, x):
+        return calc_lhd(x, self.observed_array, self.expected_array)
+    
+    def _calc_variances(self):
+        """Calculate the variance of every frequency from the Fisher info.
+
+        The frequencies are constrained to sum to one, so we invert the 
+        information restricted to the directions that sum to 0.
+        """
+        if self.n == 1: return numpy.zeros(1)
+        # the expected bin frequencies at the MLE
+        mu = self.expected_array.dot(self.mle) + 1e-16
+        weights = self.observed_array/(mu**2)
+        if scipy.sparse.issparse(self.expected_array):
+            info = self.expected_array.T.dot(
+                scipy.sparse.diags(weights).dot(self.expected_array))
+            info = info.toarray()
+        else:
+            info = numpy.dot(
+                self.expected_array.T, weights[:,None]*self.expected_array)
+        proj = numpy.eye(self.n) - 1./self.n
+        cov = numpy.dot(proj, numpy.dot(
+            pinv(numpy.dot(proj, numpy.dot(info, proj))), proj))
+        return numpy.diag(cov).clip(0)
+    
+    def _maximize_profile_lhd(self, fixed_index, value, x0):
+        """Maximize the lhd over frequencies with x[fixed_index] == value.
+
+        """
+        free_mass = 1. - value
+        def project(x):
+            x = x.copy()
+            x[fixed_index] = 0
+            x = free_mass*project_onto_simplex(x/(x.sum() + 1e-300))
+            x[fixed_index] = value
+            return x
+        
+        def em_step(x):
+            # the EM step for the free frequencies is the unconstrained step, 
+            # rescaled so that they sum to free_mass
+            new_x, lhd = calc_em_step(
+                x, self.observed_array, self.expected_array)
+            return project(new_x), lhd
+        
+        self.num_profile_evaluations += 1
+        x, lhd, num_steps = iterate_em(
+            project(x0), em_step, project, self._calc_lhd)
+        return x, lhd
+    
+    def _find_bound(self, fixed_index, bound_type):
+        mle_value = self.mle[fixed_index]
+        if bound_type == 'lb':
+            limit = MIN_TRANSCRIPT_FREQ
+        else:
+            limit = 1. - MIN_TRANSCRIPT_FREQ
+        if abs(limit - mle_value) < PARAM_ABS_TOL:
+            return self.max_lhd, limit
+        
+        # the profile lhd is maximized from the evaluated point that is 
+        # closest to value. We mix in some of the MLE because EM can't move
+        # frequencies away from 0, and a far away point can have zeroed out 
+        # frequencies that are non-zero at the bound
+        evaluated_points = [(mle_value, self.mle),]
+        def profile_lhd(value):
+            x0 = min(evaluated_points, key=lambda x: abs(x[0] - value))[1]
+            x, lhd = self._maximize_profile_lhd(
+                fixed_index, value, 
+                (1-WARM_START_MLE_WEIGHT)*x0 + WARM_START_MLE_WEIGHT*self.mle)
+            evaluated_points.append((value, x))
+            return lhd
+        
+        # seed the bound from the quadratic approximation of the log lhd
+        step = numpy.sqrt( 
+            2*(self.max_lhd - self.min_lhd)*self.variances[fixed_index] )
+        direction = -1. if bound_type == 'lb' else 1.
+        if not step > 0 or step > abs(limit - mle_value):
+            step = abs(limit - mle_value)/2.
+        
+        # bracket the root, expanding the step until we pass the bound
+        inside, inside_lhd = mle_value, self.max_lhd
+        outside = mle_value + direction*step
+        while True:
+            lhd = profile_lhd(outside)
+            if lhd < self.min_lhd:
+                break
+            inside, inside_lhd = outside, lhd
+            if outside == limit:
+                return lhd, limit
+            outside = mle_value + 2*(outside - mle_value)
+            if direction*(outside - limit) > 0:
+                outside = limit
+        outside_lhd = lhd
+        
+        # find the bound with the Illinois variant of regula falsi. The 
+        # bracket is only updated from values that we've already evaluated, 
+        # so it stays valid even though the profile lhd is only maximized 
+        # to within the EM tolerance (a root finder that re-evaluates the 
+        # end points can see them on the same side of the bound). f_in and 
+        # f_out are the (possibly halved) weights of the secant step, so we
+        # test convergence against the inside point's actual lhd margin
+        f_in, f_out = inside_lhd - self.min_lhd, outside_lhd - self.min_lhd
+        side = 0
+        for i in xrange(MAX_NUM_ITERATIONS):
+            if ( abs(outside - inside) < PARAM_ABS_TOL 
+                 or inside_lhd - self.min_lhd < LHD_ABS_TOL ):
+                break
+            value = outside - f_out*(outside - inside)/(f_out - f_in)
+            if not min(inside, outside) < value < max(inside, outside):
+                value = (inside + outside)/2.
+            lhd = profile_lhd(value)
+            if lhd >= self.min_lhd:
+                inside, inside_lhd, f_in = value, lhd, lhd - self.min_lhd
+                if side == 1: f_out /= 2.
+                side = 1
+            else:
+                outside, f_out = value, lhd - self.min_lhd
+                if side == -1: f_in /= 2.
+                side = -1
+        
+        # the bound is always inside of the confidence region
+        return inside_lhd, inside
+    
+    def estimate_bounds(self, fixed_index, bound_types=('lb', 'ub')):
+        """Estimate bounds for frequency fixed_index.
+
+        Returns a list of (bound_type, p_value, value) tuples.
+        """
+        rv = []
+        for bound_type in bound_types:
+            assert bound_type in ('lb', 'ub'), (
+                "Improper bound type '%s'" % bound_type )
+            if self.n == 1:
+                rv.append((bound_type, 1.0, 1.0))
+                continue
+            lhd, value = self._find_bound(fixed_index, bound_type)
+            if value < PARAM_ABS_TOL: value = 0.
+            if 1-value < PARAM_ABS_TOL: value = 1.
+            p_value = chi2.sf( 2*max(0, self.max_lhd-lhd), 1 )
+            rv.append((bound_type, p_value, value))
+        return rv
+
 def estimate_confidence_bound_with_cvx( f_mat, 
                                num_reads_in_bams,
                                fixed_i,
@@ -19,6 +19,9 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import time
+import shutil
+import tempfile
+import heapq
 import numpy
 import scipy
 import math
@@ -35,6 +38,8 @@ import networkx as nx
 
 from copy import copy
 
+import cPickle as pickle
+
 ReadCounts = namedtuple('ReadCounts', ['Promoters', 'RNASeq', 'Polya'])
 
 from frag_len import build_fl_dists_from_fls_dict
@@ -48,7 +53,9 @@ import config
 from files.reads import MergedReads, RNAseqReads, CAGEReads, \
     RAMPAGEReads, PolyAReads, \
     fix_chrm_name_for_ucsc, get_contigs_and_lens, calc_frag_len_from_read_data, \
-    iter_paired_reads, extract_jns_and_reads_in_region, TooManyReadsError
+    iter_paired_reads, extract_jns_and_reads_in_region, TooManyReadsError, \
+    BAI_LINEAR_INDEX_WINDOW_SIZE, get_reads_handle, \
+    log_reads_pool_stats
 import files.junctions
 
 from files.bed import create_bed_line
@@ -342,6 +349,10 @@ class GeneElements(object):
             except: fpkm = element.fpkm
             #score = min(1000, int(1000*fpkm/max_min_fpkm))
             score = 1000
+            # junction scores are their read counts, which build_transcripts
+            # uses to rank the candidate transcripts
+            if element_type == 'INTRON' and element.cnt is not None:
+                score = min(1000, int(element.cnt))
             grp_id = element_type + "_%s_%s_%i_%i" % region
 
             # also, add 1 to stop because beds are open-closed ( which means no net 
@@ -627,11 +638,67 @@ def find_transcribed_regions_and_jns_in_segment(
         transcribed_regions, jn_reads, 
         ReadCounts(*num_unique_reads), fragment_lengths )
 
+def split_contig_by_read_density(
+        contig, r_start, r_stop, density, window_size, 
+        target_num_reads, min_segment_length, max_segment_length, 
+        max_num_lookahead_windows=8):
+    """Split contig[r_start:r_stop] into segments with ~target_num_reads reads.
+    
+    density[i] is the (estimated) number of reads in window i. Once a segment
+    has target_num_reads reads, we cut it at the least covered window 
+    boundary in the next max_num_lookahead_windows windows, so that we 
+    tend to cut between rather than inside genes.
+
+    Returns (contig, start, stop, estimated number of reads) tuples, where
+    start and stop are closed-closed.
+    """
+    if r_start >= r_stop: return []
+    def window_density(i):
+        return density[i] if i < len(density) else 0.0
+    
+    segments = []
+    seg_start = r_start
+    seg_load = 0.0
+    window_i = r_start//window_size
+    while (window_i+1)*window_size < r_stop:
+        seg_load += window_density(window_i)
+        seg_len = (window_i+1)*window_size - seg_start
+        if ( (seg_load >= target_num_reads and seg_len >= min_segment_length)
+             or seg_len >= max_segment_length ):
+            # find the lowest coverage window in the look ahead, and cut
+            # before it
+            cut_i = window_i+1
+            for i in xrange(window_i+1, window_i+1+max_num_lookahead_windows):
+                if (i+1)*window_size >= r_stop: break
+                if (i+1)*window_size - seg_start > max_segment_length: break
+                if window_density(i) < window_density(cut_i): 
+                    cut_i = i
+            for i in xrange(window_i+1, cut_i):
+                seg_load += window_density(i)
+            segments.append(
+                (contig, seg_start, cut_i*window_size-1, seg_load))
+            seg_start = cut_i*window_size
+            seg_load = 0.0
+            window_i = cut_i
+        else:
+            window_i += 1
+    # add the final segment
+    while window_i*window_size < r_stop:
+        seg_load += window_density(window_i)
+        window_i += 1
+    segments.append((contig, seg_start, r_stop, seg_load))
+    return segments
+
 def split_genome_into_segments(contig_lens, region_to_use, 
-                               min_segment_length=5000):
+                               min_segment_length=5000, reads=None,
+                               max_num_reads_per_segment=5e5):
     """Return non-overlapping segments that cover the genome.
 
-    The segments are closed-closed, and strand specific.
+    The segments are closed-closed, and strand specific. If reads are
+    provided, then we use the read index or bam index to estimate the read 
+    density, and split the genome into segments with similar numbers of 
+    reads. The segments are returned in order of decreasing estimated 
+    load, so that the most expensive segments are started first.
     """
     if region_to_use is not None:
         r_chrm, (r_start, r_stop) = region_to_use
@@ -640,7 +707,46 @@ def split_genome_into_segments(contig_lens, region_to_use,
     total_length = sum(contig_lens.values())
     segment_length = max(min_segment_length, 
                          int(total_length/float(config.NTHREADS*1000)))
+    
+    # try to estimate the read density from the indices
+    densities = []
+    window_size = 4*BAI_LINEAR_INDEX_WINDOW_SIZE
+    for rds in ([] if reads is None else reads):
+        if rds is None: continue
+        try: 
+            densities.append(rds.estimate_read_density(window_size))
+        except (IOError, ValueError), inst:
+            config.log_statement(
+                "WARNING: could not estimate the read density (%s) - using fixed length gene segments" % inst, log=True)
+            densities = []
+            break
+    
     segments = []
+    if len(densities) > 0:
+        # sum the read densities over the reads types
+        contig_densities = defaultdict(lambda: numpy.zeros(0))
+        for density in densities:
+            for contig, cnts in density.iteritems():
+                prev = contig_densities[contig]
+                new = numpy.zeros(max(len(prev), len(cnts)))
+                new[:len(prev)] += prev
+                new[:len(cnts)] += cnts
+                contig_densities[contig] = new
+        total_num_reads = sum(
+            x.sum() for x in contig_densities.itervalues())
+        target_num_reads = max(1.0, min(
+            total_num_reads/(config.NTHREADS*100.), 
+            max_num_reads_per_segment))
+        for contig, contig_length in contig_lens.iteritems():
+            if region_to_use is not None and r_chrm != contig: 
+                continue
+            segments.extend(split_contig_by_read_density(
+                contig, r_start, min(r_stop, contig_length), 
+                contig_densities[contig], window_size, target_num_reads, 
+                min_segment_length, 10*segment_length))
+        segments.sort(key=lambda x: -x[3])
+        return [(contig, start, stop) for contig, start, stop, load in segments]
+    
     # sort by shorter contigs, so that the short contigs (e.g. mitochondrial)
     # whcih usually take longer to finish are started first
     for contig, contig_length in sorted(
@@ -654,45 +760,118 @@ def split_genome_into_segments(contig_lens, region_to_use,
     return segments
 
 class GlobalGeneSegmentData(object):
-    def __init__(self, contig_lens):
-        self.manager = multiprocessing.Manager()
-        self.num_unique_reads = ReadCounts(multiprocessing.Value('d', 0.0), 
-                                           multiprocessing.Value('d', 0.0), 
-                                           multiprocessing.Value('d', 0.0))
-        self.transcribed_regions = {}
-        self.jns = {}
-        for strand in "+-":
-            for contig in contig_lens.keys():
-                self.transcribed_regions[(contig, strand)] = self.manager.list()
-                self.jns[(contig, strand)] = self.manager.list()
-        self.frag_lens = self.manager.dict()
-        self.lock = multiprocessing.Lock()
+    """Aggregate the gene segment data found by the worker processes.
 
+    Each worker writes its data into its own shard files (sorted numpy
+    arrays of intervals and junctions, and fragment length histograms), so
+    there is no shared state or lock. After the workers finish, the shards
+    are combined with a k-way merge.
+    """
+    def __init__(self, contig_lens):
+        self.contig_lens = contig_lens
+        self.shard_dir = tempfile.mkdtemp(
+            prefix="gene_segments.", dir=config.tmp_dir)
+        self._num_shards = 0
+        self._pid = os.getpid()
+    
     def update_all_data(self, frag_lens, transcribed_regions, jns, rd_cnts):
-        with self.lock:
-            for key, cnt in frag_lens.iteritems():
-                if key not in self.frag_lens: self.frag_lens[key] = cnt
-                else: self.frag_lens[key] += cnt
-            for key, regions in transcribed_regions.iteritems():
-                self.transcribed_regions[key].extend(regions)
-            for key, vals in jns.iteritems():
-                self.jns[key].extend( vals )
-            for i, val in enumerate(rd_cnts):
-                self.num_unique_reads[i].value += val
+        """Write the data found by this process into a new shard.
+
+        """
+        shard = {
+            'frag_lens': dict(frag_lens),
+            'rd_cnts': numpy.array(rd_cnts, dtype=float),
+            'transcribed_regions': {},
+            'jns': {}
+        }
+        for key, regions in transcribed_regions.iteritems():
+            if len(regions) == 0: continue
+            regions = numpy.array(regions, dtype=int).reshape((-1, 2))
+            shard['transcribed_regions'][key] = regions[
+                numpy.lexsort((regions[:,1], regions[:,0]))]
+        for key, vals in jns.iteritems():
+            if len(vals) == 0: continue
+            # store jns as (start, stop, cnt) rows
+            vals = numpy.array(
+                [(start, stop, cnt) for (start, stop), cnt in vals], 
+                dtype=int).reshape((-1, 3))
+            shard['jns'][key] = vals[numpy.lexsort((vals[:,1], vals[:,0]))]
+        
+        # write to a temporary file and then move it, so that a partially
+        # written shard is never read
+        ofname = os.path.join(self.shard_dir, "%i.%i.shard" % (
+            os.getpid(), self._num_shards))
+        self._num_shards += 1
+        with open(ofname + ".tmp", "wb") as ofp:
+            pickle.dump(shard, ofp, pickle.HIGHEST_PROTOCOL)
+        os.rename(ofname + ".tmp", ofname)
         return
+    
+    def _load_shards(self):
+        shards = []
+        for fname in sorted(os.listdir(self.shard_dir)):
+            if not fname.endswith(".shard"): continue
+            with open(os.path.join(self.shard_dir, fname), "rb") as fp:
+                shards.append(pickle.load(fp))
+        return shards
+    
+    def load_merged_data(self):
+        """Merge the shards. 
+        
+        Returns the sorted transcribed regions and the summed junction counts
+        for each (contig, strand), the fragment length counts, and the read
+        counts.
+        """
+        shards = self._load_shards()
+        
+        num_unique_reads = ReadCounts(*sum(
+            (shard['rd_cnts'] for shard in shards), numpy.zeros(3)).tolist())
 
+        frag_lens = defaultdict(int)
+        for shard in shards:
+            for key, cnt in shard['frag_lens'].iteritems():
+                frag_lens[key] += cnt
+        
+        transcribed_regions = {}
+        jns = {}
+        for contig in self.contig_lens.keys():
+            for strand in "+-":
+                key = (contig, strand)
+                transcribed_regions[key] = list(heapq.merge(*[
+                    ( (int(start), int(stop)) for start, stop 
+                      in shard['transcribed_regions'][key] )
+                    for shard in shards 
+                    if key in shard['transcribed_regions'] ]))
+                
+                # merge the sorted junction arrays, summing the counts of
+                # junctions that were observed in multiple shards
+                merged_jns = []
+                for start, stop, cnt in heapq.merge(*[
+                        iter(shard['jns'][key].tolist())
+                        for shard in shards if key in shard['jns'] ]):
+                    jn = (int(start), int(stop))
+                    if len(merged_jns) > 0 and merged_jns[-1][0] == jn:
+                        merged_jns[-1][1] += cnt
+                    else:
+                        merged_jns.append([jn, cnt])
+                jns[key] = merged_jns
+        
+        return transcribed_regions, jns, dict(frag_lens), num_unique_reads
+    
     def shutdown(self):
-        self.manager.shutdown()
+        # only the process that created the shard directory removes it, so 
+        # that a worker that raises an exception doesn't remove it from 
+        # under the other workers
+        if os.getpid() != self._pid: return
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
         
 def find_segments_and_jns_worker(
         segments, global_gene_data,
         rnaseq_reads, promoter_reads, polya_reads,
         ref_elements, ref_elements_to_include ):
-    rnaseq_reads = rnaseq_reads.reload()
-    if promoter_reads is not None: 
-        promoter_reads = promoter_reads.reload()
-    if polya_reads is not None: 
-        polya_reads = polya_reads.reload()
+    rnaseq_reads = get_reads_handle(rnaseq_reads, 'find_segments')
+    promoter_reads = get_reads_handle(promoter_reads, 'find_segments')
+    polya_reads = get_reads_handle(polya_reads, 'find_segments')
 
     local_frag_lens = defaultdict(int)
     local_transcribed_regions = defaultdict(list)
@@ -758,6 +937,7 @@ def find_segments_and_jns_worker(
         local_jns,
         local_rd_cnts)
     
+    log_reads_pool_stats()
     return
 
 def load_gene_bndry_bins( genes, contig, strand, contig_len ):  
@@ -837,39 +1017,48 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
         ref_element_types_to_include.add('intron')
         ref_element_types_to_include.add('exon')
     
-    pids = []
-    for i in xrange(config.NTHREADS):
-        pid = os.fork()
-        if pid == 0:
-            find_segments_and_jns_worker(
-                segments_queue, 
-                global_gene_data,
-                rnaseq_reads, promoter_reads, polya_reads,
-                ref_genes, ref_element_types_to_include)
-            os._exit(0)
-        pids.append(pid)
-
-    config.log_statement("Populating gene segment queue")        
-    segments = split_genome_into_segments(contig_lens, region_to_use)
-    for segment in segments: 
-        segments_queue.put(segment)
-    for i in xrange(config.NTHREADS): segments_queue.put('FINISHED')
-    
-    while segments_queue.qsize() > 2*config.NTHREADS:
-        #config.log_statement(
-            #"Waiting on gene segment finding children (%i/%i segments remain)" 
-            #%(segments_queue.qsize(), len(segments)))        
-        time.sleep(0.5)
-    
-    for i, pid in enumerate(pids):
-        #config.log_statement(
-            #"Waiting on gene segment finding children (%i/%i children remain)" 
-            #%(len(pids)-i, len(pids)))
-        os.waitpid(pid, 0) 
+    # remove the shards even if a worker or the merge fails
+    try:
+        pids = []
+        for i in xrange(config.NTHREADS):
+            pid = os.fork()
+            if pid == 0:
+                find_segments_and_jns_worker(
+                    segments_queue, 
+                    global_gene_data,
+                    rnaseq_reads, promoter_reads, polya_reads,
+                    ref_genes, ref_element_types_to_include)
+                os._exit(0)
+            pids.append(pid)
+
+        config.log_statement("Populating gene segment queue")        
+        segments = split_genome_into_segments(
+            contig_lens, region_to_use, 
+            reads=(rnaseq_reads, promoter_reads, polya_reads))
+        for segment in segments: 
+            segments_queue.put(segment)
+        for i in xrange(config.NTHREADS): segments_queue.put('FINISHED')
+    
+        while segments_queue.qsize() > 2*config.NTHREADS:
+            #config.log_statement(
+                #"Waiting on gene segment finding children (%i/%i segments remain)" 
+                #%(segments_queue.qsize(), len(segments)))        
+            time.sleep(0.5)
+    
+        for i, pid in enumerate(pids):
+            #config.log_statement(
+                #"Waiting on gene segment finding children (%i/%i children remain)" 
+                #%(len(pids)-i, len(pids)))
+            os.waitpid(pid, 0) 
             
-    config.log_statement("Merging gene segments")
+        config.log_statement("Merging gene segments")
+        ( all_transcribed_regions, all_jns, all_frag_lens, num_unique_reads 
+          ) = global_gene_data.load_merged_data()
+    finally:
+        global_gene_data.shutdown()
+    
     merged_transcribed_regions = {}
-    for key, intervals in global_gene_data.transcribed_regions.iteritems():
+    for key, intervals in all_transcribed_regions.iteritems():
         merged_transcribed_regions[
             key] = merge_adjacent_intervals(
                 intervals, config.MAX_EMPTY_REGION_SIZE)
@@ -879,14 +1068,14 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
     filtered_jns = defaultdict(dict)
     for contig in contig_lens.keys():
         plus_jns = defaultdict(int)
-        for jn, cnt in global_gene_data.jns[(contig, '+')]: plus_jns[jn] += cnt
+        for jn, cnt in all_jns[(contig, '+')]: plus_jns[jn] += cnt
         minus_jns = defaultdict(int)
-        for jn, cnt in global_gene_data.jns[(contig, '-')]: minus_jns[jn] += cnt
+        for jn, cnt in all_jns[(contig, '-')]: minus_jns[jn] += cnt
         filtered_jns[(contig, '+')] = filter_jns(plus_jns, minus_jns)
         filtered_jns[(contig, '-')] = filter_jns(minus_jns, plus_jns)
 
     config.log_statement("Building FL dist")        
-    fl_dists = build_fl_dists_from_fls_dict(dict(global_gene_data.frag_lens))
+    fl_dists = build_fl_dists_from_fls_dict(all_frag_lens)
         
     if ref_elements_to_include.junctions:
         for gene in ref_genes:
@@ -921,12 +1110,4 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
                     continue
                 new_genes.append(new_gene)
 
-    try: 
-        num_unique_reads = ReadCounts(*[
-            float(x.value) for x in global_gene_data.num_unique_reads])
-    except AttributeError:
-        num_unique_reads = ReadCounts(*global_gene_data.num_unique_reads)
-
-    global_gene_data.shutdown()
-
     return new_genes, fl_dists, num_unique_reads 
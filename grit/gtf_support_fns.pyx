@@ -0,0 +1,58 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+cdef inline bint is_space(char c):
+    # the characters that str.split() treats as whitespace
+    return c == ' ' or c == '\t' or c == '\n' or c == '\r' \
+        or c == '\v' or c == '\f'
+
+def parse_gtf_meta_data(bytes group):
+    """Parse the key value pairs in a gtf group field.
+
+    This is equivalent to pairing the consecutive tokens of group.split(),
+    and then removing a leading quote, a trailing semi-colon and a trailing 
+    quote (in that order) from each value.
+    """
+    cdef char* data = group
+    cdef Py_ssize_t n = len(group)
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t key_start, key_stop, val_start, val_stop
+    meta_data = {}
+    while True:
+        # find the key
+        while i < n and is_space(data[i]): i += 1
+        if i == n: break
+        key_start = i
+        while i < n and not is_space(data[i]): i += 1
+        key_stop = i
+        
+        # find the value, ignoring a key without one
+        while i < n and is_space(data[i]): i += 1
+        if i == n: break
+        val_start = i
+        while i < n and not is_space(data[i]): i += 1
+        val_stop = i
+        
+        if data[val_start] == '"': val_start += 1
+        if val_stop > val_start and data[val_stop-1] == ';': val_stop -= 1
+        if val_stop > val_start and data[val_stop-1] == '"': val_stop -= 1
+        
+        meta_data[data[key_start:key_stop]] = data[val_start:val_stop]
+    
+    return meta_data
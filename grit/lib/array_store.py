@@ -0,0 +1,115 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Append only, memory mapped store of objects and numpy arrays.
+
+Every record is a list of numpy arrays, written as contiguous aligned
+blocks, followed by a header: the pickled object, and then the pickled
+(offset, dtype, shape) of each array. Appending a record returns the
+(offset, size) of its header, which is all that is needed to load it, so
+a record index can be kept in shared memory as two integers per record.
+
+Any process can append under the store's lock. Records are loaded by
+memory mapping the store file, so the arrays are views into the shared
+page cache rather than copies.
+"""
+
+import os
+import multiprocessing
+from cStringIO import StringIO
+
+import numpy
+
+import cPickle as pickle
+
+ARRAY_ALIGNMENT = 64
+
+class ArrayStore(object):
+    def __init__(self, fname, truncate=True):
+        self.fname = fname
+        # truncate any existing file, unless we are re-opening a saved store
+        if truncate or not os.path.exists(fname):
+            with open(fname, "wb"): pass
+        self._lock = multiprocessing.Lock()
+
+        # these are per process, and so are re-opened after a fork
+        self._ofp = None
+        self._ofp_pid = None
+        self._mmap = None
+
+    def _get_ofp(self):
+        if self._ofp is None or self._ofp_pid != os.getpid():
+            self._ofp = open(self.fname, "ab")
+            self._ofp_pid = os.getpid()
+        return self._ofp
+
+    def append(self, obj, arrays=(), is_pickled=False):
+        """Append obj and arrays, and return the (offset, size) of the record.
+
+        If is_pickled is True then obj is a string that contains an already
+        pickled object (eg the contents of a pickle file).
+        """
+        if not is_pickled:
+            obj = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        arrays = [numpy.ascontiguousarray(array) for array in arrays]
+        with self._lock:
+            ofp = self._get_ofp()
+            ofp.seek(0, os.SEEK_END)
+            offset = ofp.tell()
+            array_descs = []
+            for array in arrays:
+                padding = -offset%ARRAY_ALIGNMENT
+                ofp.write('\0'*padding)
+                offset += padding
+                array_descs.append((offset, array.dtype.str, array.shape))
+                ofp.write(array.data)
+                offset += array.nbytes
+            header = obj + pickle.dumps(array_descs, pickle.HIGHEST_PROTOCOL)
+            ofp.write(header)
+            ofp.flush()
+        return offset, len(header)
+
+    def _get_mmap(self, size):
+        # re-map the file if the record was written after the last mapping
+        if self._mmap is None or len(self._mmap) < size:
+            self._mmap = numpy.memmap(self.fname, dtype=numpy.uint8, mode='c')
+        return self._mmap
+
+    def load(self, offset, size):
+        """Load the record stored at (offset, size).
+
+        Returns the stored object and the list of arrays. The arrays are
+        copy on write views into the memory mapped store.
+        """
+        data = self._get_mmap(offset+size)
+        header = StringIO(data[offset:offset+size].tostring())
+        obj = pickle.load(header)
+        array_descs = pickle.load(header)
+        arrays = [ numpy.ndarray(shape, dtype=dtype, buffer=data, offset=a_offset)
+                   for a_offset, dtype, shape in array_descs ]
+        return obj, arrays
+
+    def delete(self):
+        if self._ofp is not None:
+            self._ofp.close()
+            self._ofp = None
+        self._mmap = None
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+        return
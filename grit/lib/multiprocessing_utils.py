@@ -23,6 +23,7 @@ import time
 import signal
 import multiprocessing
 import traceback
+from multiprocessing.sharedctypes import RawArray
 
 from grit import config
 
@@ -151,3 +152,177 @@ def run_in_parallel(n_proc, target, all_args):
         return
 
     fork_and_wait(n_proc, worker)
+
+class WorkStealingScheduler(object):
+    """Run a set of tasks in forked worker processes.
+
+    Every task has an estimated cost. Tasks that are made up of independent
+    items (eg the transcripts in a gene) can be split into sub-tasks, so that
+    no single task is much more expensive than the others. The tasks are 
+    divided between the workers' queues (largest first, onto the least
+    loaded queue) and, when a worker's queue is empty, it steals the last 
+    task from the queue with the most remaining work.
+
+    The workers call iter_tasks to get their tasks, which also records the
+    worker, start time and duration of every task.
+    """
+    # the number of sub-tasks per worker to split a phase's total cost into
+    SUBTASKS_PER_WORKER = 4
+    
+    def __init__(self, n_proc, name='tasks'):
+        self.n_proc = n_proc
+        self.name = name
+        self.tasks = []
+        self.costs = []
+        self._splittable_tasks = []
+        self.timings = None
+    
+    def add_task(self, args, cost=1.0, num_items=None):
+        """Add a task. 
+
+        If num_items is not None, the task consists of num_items independent
+        items with a total cost of cost. If it is large it's split into 
+        sub-tasks, and the item range (start, stop) is appended to args.
+        """
+        if num_items is None:
+            self.tasks.append(tuple(args))
+            self.costs.append(float(cost))
+        else:
+            self._splittable_tasks.append((tuple(args), float(cost), num_items))
+        return
+    
+    def _split_tasks(self):
+        total_cost = sum(self.costs) + sum(
+            cost for args, cost, num_items in self._splittable_tasks)
+        max_cost = total_cost/(self.n_proc*self.SUBTASKS_PER_WORKER)
+        for args, cost, num_items in self._splittable_tasks:
+            if num_items <= 0: continue
+            num_subtasks = min(num_items, max(1, int(cost/max(max_cost,1e-12))))
+            for i in xrange(num_subtasks):
+                start = i*num_items//num_subtasks
+                stop = (i+1)*num_items//num_subtasks
+                self.tasks.append(args + (start, stop))
+                self.costs.append(cost*(stop-start)/num_items)
+        self._splittable_tasks = []
+        return
+    
+    def _init_queues(self):
+        self._split_tasks()
+        n_tasks = len(self.tasks)
+        # assign the tasks, largest first, to the queue with the least 
+        # total cost. Each queue is a contiguous slice of _order, and 
+        # tasks are taken from the front by its owner, and from the back
+        # by thieves.
+        queues = [[] for i in xrange(self.n_proc)]
+        queue_costs = [0.0]*self.n_proc
+        for task_i in sorted(xrange(n_tasks), key=lambda i: -self.costs[i]):
+            queue_i = min(xrange(self.n_proc), key=lambda i: queue_costs[i])
+            queues[queue_i].append(task_i)
+            queue_costs[queue_i] += self.costs[task_i]
+        
+        self._order = RawArray('l', sum(queues, []))
+        self._heads = RawArray('l', self.n_proc)
+        self._tails = RawArray('l', self.n_proc)
+        self._queued_costs = RawArray('d', queue_costs)
+        offset = 0
+        for queue_i, queue in enumerate(queues):
+            self._heads[queue_i] = offset
+            offset += len(queue)
+            self._tails[queue_i] = offset
+        self._locks = [multiprocessing.Lock() for i in xrange(self.n_proc)]
+        
+        self._worker_ids = Counter()
+        self._num_steals = multiprocessing.Value('i', 0)
+        # the worker id, start time and duration of every task
+        self._timings = RawArray('d', [-1]*(3*n_tasks))
+        return
+    
+    def _pop_task(self, queue_i, from_back=False):
+        with self._locks[queue_i]:
+            if self._heads[queue_i] >= self._tails[queue_i]:
+                return None
+            if from_back:
+                self._tails[queue_i] -= 1
+                task_i = self._order[self._tails[queue_i]]
+            else:
+                task_i = self._order[self._heads[queue_i]]
+                self._heads[queue_i] += 1
+            self._queued_costs[queue_i] -= self.costs[task_i]
+        return task_i
+    
+    def _steal_task(self, worker_id):
+        while True:
+            # we don't lock the costs - this is just a heuristic
+            victims = [ i for i in xrange(self.n_proc) 
+                        if i != worker_id 
+                        and self._heads[i] < self._tails[i] ]
+            if len(victims) == 0:
+                return None
+            victim = max(victims, key=lambda i: self._queued_costs[i])
+            task_i = self._pop_task(victim, from_back=True)
+            if task_i is not None:
+                with self._num_steals.get_lock():
+                    self._num_steals.value += 1
+                return task_i
+    
+    def iter_tasks(self):
+        """Iterate over the args of the tasks that this worker should process.
+
+        """
+        worker_id = self._worker_ids.return_and_increment()%self.n_proc
+        while True:
+            task_i = self._pop_task(worker_id)
+            if task_i is None:
+                task_i = self._steal_task(worker_id)
+                if task_i is None:
+                    return
+            start_time = time.time()
+            yield self.tasks[task_i]
+            self._timings[3*task_i] = worker_id
+            self._timings[3*task_i+1] = start_time - self._start_time
+            self._timings[3*task_i+2] = time.time() - start_time
+        return
+
+    def run(self, target, args=()):
+        """Fork n_proc workers, and run target(*args) in each.
+
+        target should call iter_tasks to get the tasks to process.
+        """
+        self._init_queues()
+        self._start_time = time.time()
+        # we always fork, even for a single worker, because the workers 
+        # change global state (eg. the reads handle pool)
+        pids = []
+        for i in xrange(self.n_proc):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    target(*args)
+                except Exception, inst:
+                    config.log_statement( traceback.format_exc(), log=True )
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        
+        self.timings = [ 
+            (self.tasks[i], self.costs[i], int(self._timings[3*i]), 
+             self._timings[3*i+1], self._timings[3*i+2])
+            for i in xrange(len(self.tasks)) ]
+        self._log_summary(time.time() - self._start_time)
+        return self.timings
+    
+    def _log_summary(self, total_time):
+        worker_times = [0.0]*self.n_proc
+        for args, cost, worker_id, start, duration in self.timings:
+            if worker_id >= 0: worker_times[worker_id] += duration
+        msg = "%s: %i tasks on %i workers in %.1f sec (%i stolen, worker busy times %.1f-%.1f sec)" % (
+            self.name, len(self.tasks), self.n_proc, total_time, 
+            self._num_steals.value, min(worker_times), max(worker_times))
+        if len(self.timings) > 0:
+            longest = max(self.timings, key=lambda x: x[4])
+            msg += ", longest task %s %.1f sec" % (
+                "/".join(map(str, longest[0])), longest[4])
+        config.log_statement(msg, log=True)
+        return
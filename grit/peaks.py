@@ -24,10 +24,11 @@ import math
 import random
 
 import numpy
-from scipy.special import gammaln, gamma, cbrt
+from scipy.special import gammaln, gamma, cbrt, gammainccinv
 import scipy.stats
 
 from itertools import chain
+from collections import namedtuple, OrderedDict
 
 import config
 
@@ -35,7 +36,7 @@ import grit.files.junctions
 import grit.files.reads
 from grit.lib.multiprocessing_utils import ProcessSafeOPStream
 
-from grit.call_peaks_support_fns import calc_moments
+from grit.call_peaks_support_fns import calc_moments_array
 
 from scipy.optimize import fmin_l_bfgs_b as minimize
 
@@ -62,6 +63,14 @@ MAX_NUM_ITERATIONS = 25
 N_REPS = 1
 if SPLIT_TYPE == 'random': assert N_REPS > 1
 
+# genome wide peak calling chunks. The overlap must be larger than the 
+# largest peak, so that every peak is entirely within the chunk that owns it
+GENOME_CHUNK_SIZE = 1000000
+GENOME_CHUNK_OVERLAP = 10000
+
+GenomeChunk = namedtuple('GenomeChunk', ['chrm', 'strand', 'start', 'stop', 
+                                         'core_start', 'core_stop'])
+
 def write_bedgraph_from_array(array, region, ofprefix):
     """
     track name=CAGE.pan..plus type=bedGraph
@@ -131,7 +140,7 @@ def build_control(rnaseq_reads, region, control_type, smooth_win_len=SMOOTH_WIN_
     
     # get the region segment boundaries
     region_tuple = (region['chrm'], region['strand'], region['start'], region['stop'])
-    jns = files.junctions.load_junctions_in_bam(
+    jns = grit.files.junctions.load_junctions_in_bam(
         rnaseq_reads, [region_tuple,] )[(region['chrm'], region['strand'])]
     bndries = set((region['start']-region['start'], region['stop']-region['start']+1))
     for (start, stop), cnt, entropy in jns:
@@ -210,9 +219,9 @@ def build_control_in_gene(gene, paired_rnaseq_reads, bndries,
 
 class TestSignificance(object):
     def __init__(self, signal_cov, control_cov, noise_frac, min_peak_size):
-        self.noise_n = int(noise_frac*sum(signal_cov)) + 1
         self.signal_n = sum(signal_cov)
         self.min_peak_size = min_peak_size
+        self.control_cov = control_cov
         
         #### initialize the array that we will use to pick 
         #### the split base(s)
@@ -228,17 +237,20 @@ class TestSignificance(object):
             (start, stop) for start, stop in zip(starts, stops)
             if stop - start + 1 >= MIN_EMPTY_REGION_SIZE ]
         
+        # the optimal split bases only depend on the region, so they are 
+        # cached to avoid re-splitting the same regions in every iteration
+        self._split_bases = {}
+        
         #### initialize data to test for region significance
-        # initialize the null data
-        null_means = [0.,]
-        null_vars = [0.,]
-        for i, p in enumerate(control_cov):
-            mean, var = calc_moments(p, self.noise_n)
-            null_means.append(mean)
-            null_vars.append(var)
-
-        self.null_means_cumsum = numpy.array(null_means).cumsum()
-        self.null_variances_cumsum = numpy.array(null_vars).cumsum()
+        # the null moments only depend on the control through its distinct
+        # values. When there are several repetitions, the nulls from the 
+        # previous repetition's iterations are cached because the noise 
+        # fracs are usually repeated.
+        self._control_ps, self._control_ps_indices = numpy.unique(
+            control_cov, return_inverse=True)
+        self._null_cumsums = OrderedDict()
+        self._max_num_null_cumsums = 1 if N_REPS == 1 else MAX_NUM_ITERATIONS
+        self.set_noise_frac(noise_frac)
         
         # initialize the signal test statistic
         lhds = ( signal_cov*numpy.log(control_cov)
@@ -248,36 +260,74 @@ class TestSignificance(object):
         self.signal_cnts_cumsum = numpy.hstack((
             numpy.zeros(1), signal_cov.cumsum()))
     
-    def __call__(self, start, stop, alpha):
+    def set_noise_frac(self, noise_frac):
+        self.noise_n = int(noise_frac*self.signal_n) + 1
+        try:
+            self.null_means_cumsum, self.null_variances_cumsum = \
+                self._null_cumsums[self.noise_n]
+        except KeyError:
+            null_means, null_vars = calc_moments_array(
+                self._control_ps, self.noise_n)
+            self.null_means_cumsum = numpy.hstack((
+                numpy.zeros(1), null_means[self._control_ps_indices].cumsum()))
+            self.null_variances_cumsum = numpy.hstack((
+                numpy.zeros(1), null_vars[self._control_ps_indices].cumsum()))
+            self._null_cumsums[self.noise_n] = (
+                self.null_means_cumsum, self.null_variances_cumsum)
+            if len(self._null_cumsums) > self._max_num_null_cumsums:
+                self._null_cumsums.popitem(last=False)
+        return
+    
+    def test_regions(self, starts, stops, alpha):
+        """Test the regions [starts[i], stops[i]) for significance.
+
+        Returns a boolean array.
+        """
+        starts = numpy.asarray(starts, dtype=int)
+        stops = numpy.asarray(stops, dtype=int)
+        
         # if there are more reads in this region than noise reads, 
         # then this region must include some signal
-        sig_cnt = ( 
-            self.signal_cnts_cumsum[stop] 
-            - self.signal_cnts_cumsum[start] )
-        if sig_cnt > self.noise_n: return True
+        sig_cnts = ( 
+            self.signal_cnts_cumsum[stops] 
+            - self.signal_cnts_cumsum[starts] )
         
-        mean = -(self.null_means_cumsum[stop] 
-                 - self.null_means_cumsum[start] + 1)
-        variance = ( self.null_variances_cumsum[stop] 
-                     - self.null_variances_cumsum[start] + 1)
+        mean = -(self.null_means_cumsum[stops] 
+                 - self.null_means_cumsum[starts] + 1)
+        variance = ( self.null_variances_cumsum[stops] 
+                     - self.null_variances_cumsum[starts] + 1)
         
         scale = variance/mean
         shape = mean/scale
         
-        dist = scipy.stats.gamma(shape, scale=scale)
-        critical_value = -scipy.stats.gamma(
-            shape, scale=scale).isf(alpha)
-        
         # calculate the value of the observed likelihood
-        obs_lhd = ( self.signal_lhd_cumsum[stop] 
-                    - self.signal_lhd_cumsum[start] )
+        obs_lhds = ( self.signal_lhd_cumsum[stops] 
+                     - self.signal_lhd_cumsum[starts] )
         
-        return obs_lhd < critical_value
+        # this is -scipy.stats.gamma(shape, scale=scale).isf(alpha), which 
+        # is nan (and so the test fails) unless shape and scale are positive
+        with numpy.errstate(invalid='ignore'):
+            critical_values = numpy.where(
+                (shape > 0) & (scale > 0), -gammainccinv(shape, alpha)*scale, 
+                numpy.nan)
+            return (sig_cnts > self.noise_n) | (obs_lhds < critical_values)
+    
+    def __call__(self, start, stop, alpha):
+        return bool(self.test_regions([start,], [stop,], alpha)[0])
     
     def find_split_bases(self, r_start, r_stop):
         """Returns a closed,open interval of bases to split. 
 
         """
+        if SPLIT_TYPE == 'optimal':
+            try: return self._split_bases[(r_start, r_stop)]
+            except KeyError: pass
+            rv = self._find_split_bases(r_start, r_stop)
+            self._split_bases[(r_start, r_stop)] = rv
+            return rv
+        return self._find_split_bases(r_start, r_stop)
+    
+    def _find_split_bases(self, r_start, r_stop):
         r_start += self.min_peak_size
         r_stop -= self.min_peak_size
         assert r_stop >= r_start
@@ -316,10 +366,20 @@ class TestSignificance(object):
         return rv, rv
 
 def find_noise_regions(signal_cov, control_cov, 
-                       noise_frac, alpha, min_peak_size):
+                       noise_frac, alpha, min_peak_size, 
+                       is_significant=None):
+    """Recursively split the significant regions, and return the noise regions.
+
+    is_significant is an optional TestSignificance object for signal_cov 
+    and control_cov, which is updated to use noise_frac.
+    """
     alpha = alpha/(2*len(signal_cov))
-    is_significant = TestSignificance(
-        signal_cov, control_cov, noise_frac, min_peak_size)
+    if is_significant is None:
+        is_significant = TestSignificance(
+            signal_cov, control_cov, noise_frac, min_peak_size)
+    else:
+        assert is_significant.control_cov is control_cov
+        is_significant.set_noise_frac(noise_frac)
     noise_regions = []
     if signal_cov.sum() == 0:
         return [(0, len(signal_cov)),]
@@ -334,44 +394,52 @@ def find_noise_regions(signal_cov, control_cov,
         if signal_cov[i] > 0: break
         stop = i
     if stop < len(signal_cov): noise_regions.append((stop,len(signal_cov)))
-    regions_to_split = [((start, stop), 1)]
     
     # if the full region isn't significant, then we are done
-    if not is_significant(*regions_to_split[0][0], alpha=alpha):
-        return noise_regions + [regions_to_split[0][0],]
+    if not is_significant(start, stop, alpha=alpha):
+        return noise_regions + [(start, stop),]
+    
+    # split the regions one level at a time, so that all of the sub regions 
+    # in a level can be tested together. We know that every region in 
+    # regions_to_split is significant.
+    regions_to_split = [(start, stop),]
     while len(regions_to_split) > 0:
-        # get the region to split - we know that this is significant
-        # XXX use a better data structure
-        (start, stop), level = regions_to_split.pop(0)
-        # if this region is too small, then it's already significant
-        # and so there is nothing to do 
-        if stop - start < 2*min_peak_size: continue
-        
-        # build the sub regions, and test them for significance
-        left_bnd, right_bnd = is_significant.find_split_bases(start, stop)
+        sub_regions = []
+        for start, stop in regions_to_split:
+            # if this region is too small, then it's already significant
+            # and so there is nothing to do 
+            if stop - start < 2*min_peak_size: continue
+
+            # build the sub regions
+            left_bnd, right_bnd = is_significant.find_split_bases(start, stop)
+
+            # add the split bases to the noise set
+            if right_bnd > left_bnd:
+                noise_regions.append((left_bnd, right_bnd))
+            
+            sub_regions.append(((start, left_bnd), (right_bnd, stop)))
         
-        # add the split bases to the noise set
-        if right_bnd > left_bnd:
-            noise_regions.append((left_bnd, right_bnd))
+        if len(sub_regions) == 0: break
         
-        r1, r2 = [(start, left_bnd), (right_bnd, stop)]
-        r1_sig, r2_sig = [
-            is_significant(*r1, alpha=alpha), 
-            is_significant(*r2, alpha=alpha) ]
+        # test the sub regions for significance
+        regions = [r for r1_r2 in sub_regions for r in r1_r2]
+        are_sig = is_significant.test_regions(
+            [r[0] for r in regions], [r[1] for r in regions], alpha=alpha)
         
-        # if neither sub region is significant, (and we know the parent region 
-        # was significant) then we are done
-        if not r1_sig and not r2_sig:
-            continue
-                
-        # add the subregions to the appropriate locations
-        if r1_sig:
-            regions_to_split.append((r1, level+1))
-        else: noise_regions.append(r1)
-            
-        if r2_sig:
-            regions_to_split.append((r2, level+1))
-        else: noise_regions.append(r2)
+        regions_to_split = []
+        for i, (r1, r2) in enumerate(sub_regions):
+            r1_sig, r2_sig = are_sig[2*i], are_sig[2*i+1]
+            # if neither sub region is significant, (and we know the parent 
+            # region was significant) then we are done
+            if not r1_sig and not r2_sig:
+                continue
+
+            # add the subregions to the appropriate locations
+            if r1_sig: regions_to_split.append(r1)
+            else: noise_regions.append(r1)
+
+            if r2_sig: regions_to_split.append(r2)
+            else: noise_regions.append(r2)
     
     return sorted(noise_regions)
 
@@ -477,6 +545,10 @@ def call_peaks( signal_cov, original_control_cov, reads_type,
                 min_peak_size, max_peak_size,
                 max_exp_sum_fraction, max_exp_mean_cvg_fraction):
     signal = numpy.ones(len(signal_cov))
+    # the significance tables only depend on the signal and control, and 
+    # the null for every noise frac, so they are shared by every iteration 
+    # and repetition that uses the same control
+    is_significant = None
     for k in xrange(N_REPS):
         noise_frac = 1.0
         noise_regions = [(0, len(signal)),]
@@ -485,6 +557,10 @@ def call_peaks( signal_cov, original_control_cov, reads_type,
                 noise_regions, noise_frac, 
                 signal_cov, original_control_cov, reads_type)
         for i in xrange(MAX_NUM_ITERATIONS):
+            if ( is_significant is None 
+                 or is_significant.control_cov is not control_cov ):
+                is_significant = TestSignificance(
+                    signal_cov, control_cov, noise_frac, min_peak_size)
             if DEBUG_VERBOSE: 
                 region = {'chrm': gene.chrm, 'strand': gene.strand, 
                           'start': gene.start, 'stop': gene.stop}
@@ -497,7 +573,8 @@ def call_peaks( signal_cov, original_control_cov, reads_type,
                         i+1, noise_frac*100, reg_coef))
             noise_regions = find_noise_regions(
                 signal_cov, control_cov, 
-                noise_frac, alpha=alpha, min_peak_size=min_peak_size )
+                noise_frac, alpha=alpha, min_peak_size=min_peak_size,
+                is_significant=is_significant )
             new_noise_frac = estimate_noise_frac(
                 noise_regions, signal_cov, control_cov, min_noise_frac)
             new_reg_coef, control_cov = \
@@ -576,3 +653,85 @@ def call_peaks( signal_cov, original_control_cov, reads_type,
             exp_filtered_peaks.append((start, stop, cnt))
 
     return exp_filtered_peaks
+
+def iter_genome_chunks(contig_lens, region=None, 
+                       chunk_size=GENOME_CHUNK_SIZE, 
+                       overlap=GENOME_CHUNK_OVERLAP):
+    """Split the genome (or region) into overlapping chunks.
+
+    Yields GenomeChunk's. Every base is in the core of exactly one chunk
+    per strand, and chunks extend overlap bases past each side of their 
+    core. All coordinates are inclusive.
+    """
+    for contig, contig_len in sorted(contig_lens.iteritems()):
+        r_start, r_stop = 0, contig_len-1
+        if region is not None:
+            if region[0] != contig: continue
+            r_start = max(r_start, int(region[1][0]))
+            r_stop = min(r_stop, int(region[1][1]))
+        for strand in '+-':
+            for core_start in xrange(r_start, r_stop+1, chunk_size):
+                core_stop = min(core_start+chunk_size-1, r_stop)
+                yield GenomeChunk(
+                    contig, strand, 
+                    max(r_start, core_start-overlap), 
+                    min(r_stop, core_stop+overlap),
+                    core_start, core_stop)
+    return
+
+def call_peaks_in_chunk(chunk, signal_reads, reads_type, rnaseq_reads, 
+                        **call_peaks_tuning_params):
+    """Call peaks in a genome chunk, without gene boundaries.
+
+    Returns the peaks (relative to chunk.start) that start in the chunk's 
+    core, and the signal coverage. The chunk overlap must be larger than 
+    the largest peak, so that these peaks are never truncated by the chunk 
+    boundaries. The noise fraction and the expression filters are estimated 
+    in each chunk, so peaks from adjacent chunks can still overlap, and 
+    need to be merged with merge_chunk_peaks.
+    """
+    signal_cov = signal_reads.build_read_coverage_array(
+        chunk.chrm, chunk.strand, chunk.start, chunk.stop)
+    # skip chunks that can't contain a peak
+    if signal_cov.sum() < call_peaks_tuning_params['min_rd_cnt']:
+        return [], signal_cov
+    
+    assert reads_type in ('promoter', 'polya')
+    control_type = '5p' if reads_type == 'promoter' else '3p'
+    if chunk.strand == '-': 
+        control_type = {'3p':'5p', '5p':'3p'}[control_type]
+    region = {'chrm': chunk.chrm, 'strand': chunk.strand, 
+              'start': chunk.start, 'stop': chunk.stop}
+    control_cov = build_control(rnaseq_reads, region, control_type)
+    
+    chunk_peaks = call_peaks(
+        signal_cov, control_cov, reads_type, chunk, **call_peaks_tuning_params)
+    
+    core_start = chunk.core_start - chunk.start
+    core_stop = chunk.core_stop - chunk.start
+    return ( [ (start, stop, cnt) for start, stop, cnt in chunk_peaks 
+               if core_start <= start <= core_stop ], 
+             signal_cov )
+
+def merge_chunk_peaks(peaks):
+    """Merge the overlapping peaks that were called in adjacent chunks.
+
+    peaks is a list of (start, stop, cnt, peak_cov) tuples for a single 
+    contig and strand, where start and stop are inclusive contig coordinates
+    and peak_cov is the signal coverage from start to stop. peak_cov may be
+    None for peaks that can't overlap a peak from another chunk. Returns the
+    sorted list of merged (start, stop, cnt, peak_cov) tuples.
+    """
+    merged_peaks = []
+    for start, stop, cnt, peak_cov in sorted(peaks, key=lambda x: x[:2]):
+        if len(merged_peaks) > 0 and start <= merged_peaks[-1][1]:
+            prev_start, prev_stop, prev_cnt, prev_cov = merged_peaks[-1]
+            assert prev_cov is not None and peak_cov is not None
+            if stop > prev_stop:
+                merged_cov = numpy.hstack(
+                    (prev_cov, peak_cov[prev_stop+1-start:]))
+                merged_peaks[-1] = ( 
+                    prev_start, stop, float(merged_cov.sum()), merged_cov )
+        else:
+            merged_peaks.append((start, stop, cnt, peak_cov))
+    return merged_peaks
@@ -114,3 +114,226 @@ def calc_hessian( np.ndarray[np.double_t, ndim=1] freqs not None,
             hessian[i,j] = curr_hessian_value
     
     return hessian
+
+@cython.boundscheck(False)
+def calc_lhd_csr( np.ndarray[np.double_t, ndim=1] freqs not None, 
+                  np.ndarray[np.int_t, ndim=1] observed_array not None, 
+                  np.ndarray[np.double_t, ndim=1] data not None,
+                  np.ndarray[np.int32_t, ndim=1] indices not None,
+                  np.ndarray[np.int32_t, ndim=1] indptr not None ):
+    """calc_lhd for an expected array stored in csr format.
+
+    """
+    cdef int num_bins = indptr.shape[0] - 1
+    cdef double lhd = 0
+    cdef double freq = 0
+    cdef int i = 0
+    cdef int k = 0
+    for i in range(num_bins):
+        # calculate this bin's frequency, from the non-zero entries
+        freq = 1e-16
+        for k in range(indptr[i], indptr[i+1]):
+            freq += freqs[indices[k]]*data[k]
+        
+        lhd += observed_array[i]*log(freq)
+    
+    return lhd
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def calc_gradient_csr( np.ndarray[np.double_t, ndim=1] freqs not None, 
+                       np.ndarray[np.int_t, ndim=1] observed_array not None, 
+                       np.ndarray[np.double_t, ndim=1] data not None,
+                       np.ndarray[np.int32_t, ndim=1] indices not None,
+                       np.ndarray[np.int32_t, ndim=1] indptr not None ):
+    """calc_gradient for an expected array stored in csr format.
+
+    """
+    cdef int num_transcripts = freqs.shape[0]
+    cdef int num_bins = indptr.shape[0] - 1
+
+    cdef int i = 0
+    cdef int k = 0
+    cdef double freq
+    cdef double weight
+    cdef np.ndarray[np.double_t, ndim=1] gradient = np.zeros( 
+        num_transcripts, dtype=np.double )
+    for i in range(num_bins):
+        # calculate this bin's frequency
+        freq = 1e-16
+        for k in range(indptr[i], indptr[i+1]):
+            freq += freqs[indices[k]]*data[k]
+        weight = observed_array[i]/freq
+        # and add its weight into the gradient of every transcript with a
+        # non-zero entry in this bin
+        for k in range(indptr[i], indptr[i+1]):
+            gradient[indices[k]] += weight*data[k]
+    
+    return -gradient
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def calc_em_step( np.ndarray[np.double_t, ndim=1] freqs not None, 
+                  np.ndarray[np.int_t, ndim=1] observed_array not None, 
+                  np.ndarray[np.double_t, ndim=2] expected_array not None ):
+    """Take an EM step, and return the new freqs and the lhd of freqs.
+
+    The EM update is freqs[j]*sum_i(observed[i]*expected[i,j]/freq[i])/N,
+    where freq[i] is the expected frequency of bin i and N is the total
+    number of observed reads.
+    """
+    cdef int num_transcripts = freqs.shape[0]
+    cdef int num_bins = expected_array.shape[0]
+
+    cdef int i = 0
+    cdef int j = 0
+    cdef double freq
+    cdef double weight
+    cdef double lhd = 0
+    cdef double num_reads = 0
+    cdef np.ndarray[np.double_t, ndim=1] new_freqs = np.zeros( 
+        num_transcripts, dtype=np.double )
+    for i in range(num_bins):
+        if observed_array[i] == 0: continue
+        freq = 1e-16
+        for j in range(num_transcripts):
+            freq += freqs[j]*expected_array[i,j]
+        lhd += observed_array[i]*log(freq)
+        num_reads += observed_array[i]
+        weight = observed_array[i]/freq
+        for j in range(num_transcripts):
+            new_freqs[j] += weight*expected_array[i,j]
+    
+    for j in range(num_transcripts):
+        new_freqs[j] = freqs[j]*new_freqs[j]/num_reads
+    
+    return new_freqs, lhd
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def calc_em_step_csr( np.ndarray[np.double_t, ndim=1] freqs not None, 
+                      np.ndarray[np.int_t, ndim=1] observed_array not None, 
+                      np.ndarray[np.double_t, ndim=1] data not None,
+                      np.ndarray[np.int32_t, ndim=1] indices not None,
+                      np.ndarray[np.int32_t, ndim=1] indptr not None ):
+    """calc_em_step for an expected array stored in csr format.
+
+    """
+    cdef int num_transcripts = freqs.shape[0]
+    cdef int num_bins = indptr.shape[0] - 1
+
+    cdef int i = 0
+    cdef int j = 0
+    cdef int k = 0
+    cdef double freq
+    cdef double weight
+    cdef double lhd = 0
+    cdef double num_reads = 0
+    cdef np.ndarray[np.double_t, ndim=1] new_freqs = np.zeros( 
+        num_transcripts, dtype=np.double )
+    for i in range(num_bins):
+        if observed_array[i] == 0: continue
+        freq = 1e-16
+        for k in range(indptr[i], indptr[i+1]):
+            freq += freqs[indices[k]]*data[k]
+        lhd += observed_array[i]*log(freq)
+        num_reads += observed_array[i]
+        weight = observed_array[i]/freq
+        for k in range(indptr[i], indptr[i+1]):
+            new_freqs[indices[k]] += weight*data[k]
+    
+    for j in range(num_transcripts):
+        new_freqs[j] = freqs[j]*new_freqs[j]/num_reads
+    
+    return new_freqs, lhd
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bin_read_pairs( np.ndarray[np.int64_t, ndim=1] blk_first_bins not None, 
+                    np.ndarray[np.int64_t, ndim=1] blk_last_bins not None, 
+                    np.ndarray[np.int64_t, ndim=1] blk_offsets not None,
+                    int num_bins ):
+    """Find the non-overlapping exons (bins) that every read pair covers.
+
+    The blocks of read i are blk_offsets[i]:blk_offsets[i+1], and pair j 
+    is made up of reads 2j and 2j+1. Block k covers bins blk_first_bins[k]
+    through blk_last_bins[k], or no bins if blk_first_bins[k] is -1. 
+
+    Returns an array with a row for every pair, that contains the number of
+    bins that the first read covers, its sorted bins (padded with -1), and 
+    then the same for the second read, where the reads are ordered so that 
+    the first read's bins are the smaller tuple. The rows of pairs in the 
+    same bins are identical. Also returns a mask of the pairs in which both
+    reads cover at least one bin.
+    """
+    cdef int num_reads = blk_offsets.shape[0] - 1
+    cdef int num_pairs = num_reads//2
+    cdef int i, j, k, b, n, n1, n2, tmp, width, offset, cmp
+    
+    # the last read that covered each bin, so that every bin is only 
+    # counted once per read
+    cdef np.ndarray[np.int64_t, ndim=1] last_read = np.zeros(
+        num_bins, dtype=np.int64) - 1
+    cdef np.ndarray[np.int64_t, ndim=1] read_num_bins = np.zeros(
+        num_reads, dtype=np.int64)
+    cdef np.ndarray[np.int64_t, ndim=1] read_bins = np.zeros(
+        num_bins, dtype=np.int64)
+    
+    # find the number of bins that every read covers
+    width = 0
+    for i in range(num_reads):
+        n = 0
+        for k in range(blk_offsets[i], blk_offsets[i+1]):
+            if blk_first_bins[k] == -1: continue
+            for b in range(blk_first_bins[k], blk_last_bins[k]+1):
+                if last_read[b] == i: continue
+                last_read[b] = i
+                n += 1
+        read_num_bins[i] = n
+        if n > width: width = n
+    
+    cdef np.ndarray[np.int64_t, ndim=2] rows = np.zeros(
+        (num_pairs, 2*(width+1)), dtype=np.int64) - 1
+    cdef np.ndarray[np.uint8_t, ndim=1] covered = np.zeros(
+        num_pairs, dtype=np.uint8)
+    
+    last_read[:] = -1
+    for i in range(num_reads):
+        # collect the read's bins, and sort them with an insertion sort 
+        # (the blocks are almost always already sorted)
+        n = 0
+        for k in range(blk_offsets[i], blk_offsets[i+1]):
+            if blk_first_bins[k] == -1: continue
+            for b in range(blk_first_bins[k], blk_last_bins[k]+1):
+                if last_read[b] == i: continue
+                last_read[b] = i
+                j = n
+                while j > 0 and read_bins[j-1] > b:
+                    read_bins[j] = read_bins[j-1]
+                    j -= 1
+                read_bins[j] = b
+                n += 1
+        
+        offset = 0 if i%2 == 0 else width+1
+        rows[i//2, offset] = n
+        for j in range(n):
+            rows[i//2, offset+1+j] = read_bins[j]
+    
+    for j in range(num_pairs):
+        n1, n2 = rows[j, 0], rows[j, width+1]
+        if n1 == 0 or n2 == 0: continue
+        covered[j] = 1
+        # compare the reads' bin tuples
+        cmp = 0
+        for k in range(min(n1, n2)):
+            if rows[j, 1+k] != rows[j, width+2+k]:
+                cmp = 1 if rows[j, 1+k] > rows[j, width+2+k] else -1
+                break
+        if cmp == 0 and n1 > n2: cmp = 1
+        if cmp == 1:
+            for k in range(width+1):
+                tmp = rows[j, k]
+                rows[j, k] = rows[j, width+1+k]
+                rows[j, width+1+k] = tmp
+    
+    return rows, covered.view(dtype=bool)
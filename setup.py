@@ -27,14 +27,18 @@ try:
         Extension("grit.sparsify_support_fns", 
                   ["grit/sparsify_support_fns.pyx", ]),
         Extension("grit.call_peaks_support_fns", 
-                  ["grit/call_peaks_support_fns.pyx", ])
+                  ["grit/call_peaks_support_fns.pyx", ]),
+        Extension("grit.gtf_support_fns", 
+                  ["grit/gtf_support_fns.pyx", ])
     ])
 except ImportError:
     extensions = [
         Extension("grit.sparsify_support_fns", 
                   ["grit/sparsify_support_fns.c", ]),
         Extension("grit.call_peaks_support_fns", 
-                  ["grit/call_peaks_support_fns.c", ])
+                  ["grit/call_peaks_support_fns.c", ]),
+        Extension("grit.gtf_support_fns", 
+                  ["grit/gtf_support_fns.c", ])
     ]
 
 config = {
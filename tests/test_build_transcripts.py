@@ -0,0 +1,189 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Regression tests for the candidate transcript enumeration.
+
+"""
+
+import unittest
+import random
+
+import networkx as nx
+
+# gtf has to be imported first, to resolve the package's circular imports
+from grit.files.gtf import load_gtf
+from grit import config
+from grit.build_transcripts import (
+    count_transcripts, iter_transcripts, iter_transcripts_by_support,
+    build_transcripts_from_elements )
+
+def original_iter_transcripts(graph, tss_exons, tes_exons):
+    """The original enumeration, which copies every partial path.
+
+    """
+    paths = [[exon,] for exon in tss_exons]
+    while len(paths) > 0:
+        curr_path = paths.pop()
+        for child in graph.successors(curr_path[-1]):
+            if child in tes_exons:
+                yield curr_path + [child,]
+            else:
+                paths.append(curr_path + [child,])
+    return
+
+def simulate_splice_graph(seed):
+    """Build a random DAG of exons, with random tss and tes exons.
+
+    """
+    rng = random.Random(seed)
+    num_exons = rng.randint(1, 12)
+    exons = [(100*i, 100*i+50) for i in xrange(num_exons)]
+    graph = nx.DiGraph()
+    graph.add_nodes_from(exons)
+    for i in xrange(num_exons):
+        for j in xrange(i+1, num_exons):
+            if rng.random() < 0.3: graph.add_edge(exons[i], exons[j])
+    tss_exons = set(rng.sample(exons, rng.randint(0, num_exons)))
+    tes_exons = set(rng.sample(exons, rng.randint(0, num_exons)))
+    return graph, tss_exons, tes_exons
+
+class TestIterTranscripts(unittest.TestCase):
+    def test_matches_original_order(self):
+        for seed in xrange(200):
+            graph, tss_exons, tes_exons = simulate_splice_graph(seed)
+            expected = list(original_iter_transcripts(
+                graph, tss_exons, tes_exons))
+            self.assertEqual(
+                list(iter_transcripts(graph, tss_exons, tes_exons)), 
+                expected, msg="seed %i" % seed)
+    
+    def test_count_transcripts(self):
+        for seed in xrange(200):
+            graph, tss_exons, tes_exons = simulate_splice_graph(seed)
+            num_transcripts, num_paths_to_tes = count_transcripts(
+                graph, tss_exons, tes_exons)
+            self.assertEqual(num_transcripts, len(list(
+                original_iter_transcripts(graph, tss_exons, tes_exons))),
+                msg="seed %i" % seed)
+            # the precomputed path counts give the same transcripts
+            self.assertEqual(
+                list(iter_transcripts(
+                    graph, tss_exons, tes_exons, num_paths_to_tes)),
+                list(iter_transcripts(graph, tss_exons, tes_exons)))
+
+    def test_count_transcripts_in_ladder(self):
+        # a chain of 40 pairs of alternative exons has 2**40 transcripts, 
+        # which are counted without enumerating them
+        graph = nx.DiGraph()
+        prev_exons = [(0, 10),]
+        for i in xrange(1, 41):
+            exons = [(100*i, 100*i+10), (100*i, 100*i+20)]
+            graph.add_edges_from(
+                (prev, exon) for prev in prev_exons for exon in exons)
+            prev_exons = exons
+        graph.add_edges_from((prev, (4100, 4110)) for prev in prev_exons)
+        num_transcripts, num_paths_to_tes = count_transcripts(
+            graph, set([(0, 10),]), set([(4100, 4110),]))
+        self.assertEqual(num_transcripts, 2**40)
+
+def transcript_support(graph, transcript):
+    return min(graph[exon][child].get('score', 1) 
+               for exon, child in zip(transcript[:-1], transcript[1:]))
+
+class TestIterTranscriptsBySupport(unittest.TestCase):
+    def test_order(self):
+        for seed in xrange(200):
+            graph, tss_exons, tes_exons = simulate_splice_graph(seed)
+            rng = random.Random(seed)
+            for exon, child in graph.edges():
+                graph[exon][child]['score'] = rng.randint(0, 5)
+            transcripts = list(iter_transcripts_by_support(
+                graph, tss_exons, tes_exons))
+            # every transcript is yielded exactly once
+            self.assertEqual(
+                sorted(transcripts), 
+                sorted(original_iter_transcripts(graph, tss_exons, tes_exons)),
+                msg="seed %i" % seed)
+            # and is at least as well supported as the ones that follow it
+            supports = [transcript_support(graph, transcript) 
+                        for transcript in transcripts]
+            self.assertEqual(supports, sorted(supports, reverse=True), 
+                             msg="seed %i" % seed)
+    
+    def test_without_scores(self):
+        # without junction scores every transcript ties
+        for seed in xrange(50):
+            graph, tss_exons, tes_exons = simulate_splice_graph(seed)
+            self.assertEqual(
+                sorted(iter_transcripts_by_support(
+                    graph, tss_exons, tes_exons)), 
+                sorted(iter_transcripts(graph, tss_exons, tes_exons)))
+
+class TestBuildTranscriptsFromElements(unittest.TestCase):
+    def setUp(self):
+        self.max_num_candidate_transcripts = \
+            config.MAX_NUM_CANDIDATE_TRANSCRIPTS
+        self.log_statement = config.log_statement
+        config.log_statement = lambda *args, **kwargs: None
+    
+    def tearDown(self):
+        config.MAX_NUM_CANDIDATE_TRANSCRIPTS = \
+            self.max_num_candidate_transcripts
+        config.log_statement = self.log_statement
+    
+    def test_keeps_best_supported_transcripts(self):
+        # a chain of 8 pairs of alternative exons, with random junction 
+        # scores, has 256 candidate transcripts
+        rng = random.Random(0)
+        tss_exons = set([(0, 10),])
+        tes_exons = set([(900, 910),])
+        internal_exons = set()
+        jns = {}
+        prev_exons = [(0, 10),]
+        for i in xrange(1, 9):
+            exons = [(100*i, 100*i+10), (100*i+5, 100*i+10)]
+            internal_exons.update(exons)
+            for prev in prev_exons:
+                for exon in exons:
+                    jns[(prev[1]+1, exon[0]-1)] = rng.randint(0, 20)
+            prev_exons = exons
+        for prev in prev_exons:
+            jns[(prev[1]+1, 899)] = rng.randint(0, 20)
+        
+        def support(transcript):
+            return min(jns[(exon[1]+1, child[0]-1)] for exon, child 
+                       in zip(transcript[:-1], transcript[1:]))
+        
+        all_transcripts = build_transcripts_from_elements(
+            tss_exons, internal_exons, tes_exons, set(), jns, '+')
+        self.assertEqual(len(all_transcripts), 256)
+        
+        config.MAX_NUM_CANDIDATE_TRANSCRIPTS = 20
+        transcripts = build_transcripts_from_elements(
+            tss_exons, internal_exons, tes_exons, set(), jns, '+')
+        self.assertEqual(len(transcripts), 20)
+        self.assertEqual(len(set(map(tuple, transcripts))), 20)
+        dropped_transcripts = ( set(map(tuple, all_transcripts)) 
+                                - set(map(tuple, transcripts)) )
+        self.assertTrue(
+            min(support(t) for t in transcripts) 
+            >= max(support(t) for t in dropped_transcripts) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Regression tests for the read binning and bin clustering.
+
+The vectorized implementations are compared against the original 
+per-read and per-row implementations on simulated data.
+"""
+
+import unittest
+from collections import defaultdict
+
+import numpy
+import scipy.sparse
+
+# gtf has to be imported first, to resolve the package's circular imports
+from grit.files.gtf import load_gtf
+from grit.f_matrix import (
+    bin_read_pair_blocks, find_nonoverlapping_exons_covered_by_segment,
+    cluster_rows, cluster_bins )
+
+def original_bin_read_pair_blocks( 
+        exon_boundaries, blk_starts, blk_stops, blk_offsets,
+        read_lens, read_grp_ids, read_grp_names, include_read_type=True ):
+    """Bin the read pairs one read at a time, as bin_rnaseq_reads did.
+
+    """
+    def build_bin_for_read(i):
+        bin = set()
+        for blk in xrange(blk_offsets[i], blk_offsets[i+1]):
+            bin.update( find_nonoverlapping_exons_covered_by_segment( 
+                exon_boundaries, blk_starts[blk], blk_stops[blk] ) )
+        return tuple(sorted(bin))
+    
+    binned_reads = defaultdict(int)
+    for i, rlen in enumerate(read_lens):
+        if rlen == -1: continue
+        bin1 = build_bin_for_read(2*i)
+        bin2 = build_bin_for_read(2*i+1)
+        # skip any reads that don't overlap the gene
+        if bin1 == () or bin2 == (): continue
+        if include_read_type: 
+            rg = ( None if read_grp_ids[i] == -1 
+                   else read_grp_names[read_grp_ids[i]] )
+            key = ( rlen, rg, tuple(sorted((bin1,bin2))) )
+        else: 
+            key = tuple(sorted((bin1,bin2)))
+        binned_reads[key] += 1
+    return dict(binned_reads)
+
+def simulate_read_pair_blocks(seed):
+    """Simulate exon boundaries, and read pairs with 1-3 aligned blocks.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    exon_boundaries = numpy.unique(rng.randint(1000, 2000, rng.randint(2, 20)))
+    blk_starts, blk_stops, blk_offsets = [], [], [0,]
+    num_pairs = rng.randint(0, 300)
+    for i in xrange(2*num_pairs):
+        start = rng.randint(900, 2100)
+        for j in xrange(rng.randint(1, 4)):
+            stop = start + rng.randint(10, 60)
+            blk_starts.append(start)
+            blk_stops.append(stop)
+            start = stop + rng.randint(1, 200)
+        blk_offsets.append(len(blk_starts))
+    read_lens = rng.choice([50, 75, -1], num_pairs)
+    read_grp_ids = rng.choice([0, 1, -1], num_pairs)
+    return ( exon_boundaries, numpy.array(blk_starts, dtype=int), 
+             numpy.array(blk_stops, dtype=int), 
+             numpy.array(blk_offsets, dtype=int),
+             read_lens, read_grp_ids, ['rg1', 'rg2'] )
+
+def original_cluster_bins(expected_rnaseq_cnts):
+    clustered_bins = defaultdict(list)
+    for bin, transcripts_and_cnts in expected_rnaseq_cnts.items():
+        row = numpy.array([x[1] 
+                           for x in sorted(transcripts_and_cnts.iteritems())])
+        key = tuple((100000*row/row.sum()).round().tolist())
+        clustered_bins[key].append(bin)
+    return clustered_bins.values()
+
+def original_row_clusters(expected_rnaseq_array):
+    expected_rnaseq_array = scipy.sparse.csr_matrix(expected_rnaseq_array)
+    expected_rnaseq_array.sort_indices()
+    row_sums = numpy.asarray(expected_rnaseq_array.sum(1)).ravel()
+    indptr = expected_rnaseq_array.indptr
+    clustered_rows = defaultdict(list)
+    for i in xrange(expected_rnaseq_array.shape[0]):
+        indices = expected_rnaseq_array.indices[indptr[i]:indptr[i+1]]
+        row = expected_rnaseq_array.data[indptr[i]:indptr[i+1]]
+        row = (100000*row/row_sums[i]).round()
+        key = (tuple(indices[row != 0].tolist()), 
+               tuple(row[row != 0].tolist()))
+        clustered_rows[key].append(i)
+    return clustered_rows.values()
+
+def simulate_expected_array(seed):
+    """Simulate a design matrix whose rows are multiples of a few rows.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    num_bins, num_transcripts = rng.randint(1, 500), rng.randint(1, 20)
+    base_rows = scipy.sparse.random(
+        max(1, num_bins//20), num_transcripts, density=0.3, 
+        random_state=rng).toarray()
+    rows = base_rows[rng.randint(0, base_rows.shape[0], num_bins)]
+    rows *= rng.choice([1, 2, 3.7], num_bins)[:,None]
+    return rows, rng.randint(0, 50, num_bins)
+
+def normalize_clusters(clusters):
+    return sorted(sorted(cluster) for cluster in clusters)
+
+class TestBinReadPairBlocks(unittest.TestCase):
+    def test_matches_original_binning(self):
+        for seed in xrange(50):
+            args = simulate_read_pair_blocks(seed)
+            for include_read_type in (True, False):
+                self.assertEqual(
+                    bin_read_pair_blocks(
+                        *args, include_read_type=include_read_type),
+                    original_bin_read_pair_blocks(
+                        *args, include_read_type=include_read_type),
+                    msg="seed %i" % seed)
+
+class TestClusterRows(unittest.TestCase):
+    def test_matches_original_clusters(self):
+        for seed in xrange(30):
+            expected, observed = simulate_expected_array(seed)
+            new_expected, new_observed, cluster_mapping = cluster_rows(
+                scipy.sparse.csr_matrix(expected), observed)
+            self.assertEqual(
+                normalize_clusters(cluster_mapping.values()),
+                normalize_clusters(original_row_clusters(expected)),
+                msg="seed %i" % seed)
+            # the rows in every cluster are summed
+            for cluster_id, rows in cluster_mapping.iteritems():
+                self.assertTrue(numpy.allclose(
+                    new_expected[cluster_id].toarray().ravel(), 
+                    expected[rows].sum(0)))
+                self.assertEqual(
+                    new_observed[cluster_id], observed[rows].sum())
+            
+            # dense arrays are clustered in the same way
+            self.assertEqual(
+                normalize_clusters(cluster_rows(
+                    expected, observed)[2].values()),
+                normalize_clusters(cluster_mapping.values()))
+
+class TestClusterBins(unittest.TestCase):
+    def test_matches_original_clusters(self):
+        for seed in xrange(30):
+            expected, observed = simulate_expected_array(seed)
+            # every third transcript keeps its zero entries
+            expected_cnts = dict(
+                ((i,), dict((j, cnt) for j, cnt in enumerate(row) 
+                            if cnt > 0 or j%3 == 0)) 
+                for i, row in enumerate(expected) )
+            self.assertEqual(
+                normalize_clusters(cluster_bins(expected_cnts)),
+                normalize_clusters(original_cluster_bins(expected_cnts)),
+                msg="seed %i" % seed)
+    
+    def test_zero_rows(self):
+        # empty rows share a cluster, non-empty rows that sum to zero are 
+        # each put into their own cluster
+        expected_cnts = { 
+            (1,): {}, (2,): {}, 
+            (3,): {0: 0., 1: 0.}, (4,): {0: 0., 1: 0.}, 
+            (5,): {0: 1., 1: 2.}, (6,): {0: 2., 1: 4.} }
+        self.assertEqual(
+            normalize_clusters(cluster_bins(expected_cnts)),
+            [[(1,), (2,)], [(3,)], [(4,)], [(5,), (6,)]])
+
+if __name__ == '__main__':
+    unittest.main()
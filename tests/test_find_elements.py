@@ -0,0 +1,120 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Regression tests for the CAGE/polya peak caller.
+
+The expected peaks were produced by the original (quadratic) find_peaks on
+the same simulated coverage.
+"""
+
+import unittest
+
+import numpy
+
+# gtf has to be imported first, to resolve the package's circular imports
+from grit.files.gtf import load_gtf
+import grit.config as config
+from grit.find_elements import find_peaks
+
+# (seed, scale reads, window length) -> peaks
+EXPECTED_PEAKS = {
+    (0, False, 15): [(4, 14), (219, 238), (346, 369)],
+    (0, False, 30): [(4, 14), (219, 238), (346, 374)],
+    (0, True, 15): [(4, 9), (221, 238), (346, 369)],
+    (0, True, 30): [(4, 9), (221, 238), (346, 369)],
+    (1, False, 15): [(19, 399)],
+    (1, False, 30): [(19, 399)],
+    (1, True, 15): [(21, 399)],
+    (1, True, 30): [(21, 399)],
+    (2, False, 15): [(34, 399)],
+    (2, False, 30): [(15, 399)],
+    (2, True, 15): [(222, 243), (325, 368)],
+    (2, True, 30): [(34, 399)],
+    (3, False, 15): [(80, 129), (204, 240), (329, 366)],
+    (3, False, 30): [(80, 129), (204, 240), (329, 366)],
+    (3, True, 15): [(80, 129), (204, 240), (329, 366)],
+    (3, True, 30): [(80, 129), (204, 240), (329, 366)],
+    (4, False, 15): [(66, 87), (172, 191), (238, 253), (380, 399)],
+    (4, False, 30): [(66, 94), (164, 191), (232, 261), (367, 399)],
+    (4, True, 15): [(66, 87), (172, 191), (238, 252), (380, 399)],
+    (4, True, 30): [(66, 92), (164, 191), (236, 252), (369, 399)],
+    (5, False, 15): [(40, 45)],
+    (5, False, 30): [(40, 45)],
+    (5, True, 15): [(40, 45)],
+    (5, True, 30): [(40, 45)],
+    (6, False, 15): [(0, 17), (319, 354)],
+    (6, False, 30): [(0, 17), (319, 354)],
+    (6, True, 15): [(0, 17), (322, 354)],
+    (6, True, 30): [(0, 17), (322, 354)],
+    (7, False, 15): [(103, 171), (260, 328)],
+    (7, False, 30): [(103, 328)],
+    (7, True, 15): [(103, 120), (150, 171), (309, 328)],
+    (7, True, 30): [(103, 328)]
+}
+
+# the minimum peak score for each window length (CAGE and polya)
+MIN_SCORES = {15: 5, 30: 2}
+
+def simulate_coverage(seed, scale_reads):
+    """Simulate background coverage plus a few peaks.
+
+    If scale_reads is set, then the coverage is fractional (as it is for
+    reads with multiple mappings).
+    """
+    rng = numpy.random.RandomState(seed)
+    cov = rng.poisson(0.3, 400).astype(float)
+    for i in xrange(rng.randint(1, 6)):
+        center, width = rng.randint(0, 400), rng.randint(1, 20)
+        start, stop = max(0, center-width), center+width
+        cov[start:stop] += rng.poisson(
+            rng.gamma(1, 20), len(cov[start:stop]))
+    if scale_reads:
+        cov *= rng.choice([1., 0.5, 0.25], len(cov))
+    return cov
+
+class TestFindPeaks(unittest.TestCase):
+    def setUp(self):
+        self._max_cage_frac = getattr(config, 'MAX_CAGE_FRAC', None)
+        config.MAX_CAGE_FRAC = 0.05
+    
+    def tearDown(self):
+        if self._max_cage_frac is None: del config.MAX_CAGE_FRAC
+        else: config.MAX_CAGE_FRAC = self._max_cage_frac
+    
+    def test_matches_original_peaks(self):
+        for (seed, scale_reads, window_len), expected_peaks in sorted(
+                EXPECTED_PEAKS.iteritems()):
+            cov = simulate_coverage(seed, scale_reads)
+            peaks = find_peaks(
+                cov, window_len, MIN_SCORES[window_len], 0.05, 100)
+            self.assertEqual(
+                [tuple(peak) for peak in peaks], expected_peaks,
+                msg="seed %i, scale reads %s, window %i" % (
+                    seed, scale_reads, window_len))
+    
+    def test_does_not_modify_coverage(self):
+        cov = simulate_coverage(0, True)
+        find_peaks(cov, 15, 5, 0.05, 100)
+        self.assertTrue((cov == simulate_coverage(0, True)).all())
+
+    def test_no_coverage(self):
+        self.assertEqual(find_peaks(numpy.zeros(100), 15, 5, 0.05, 100), [])
+
+if __name__ == '__main__':
+    unittest.main()
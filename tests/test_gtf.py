@@ -0,0 +1,189 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Tests for the gtf loading and the annotation overlap indices.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import random
+
+import numpy
+
+from grit.files.gtf import (
+    load_gtf, Annotation, IntervalIndex, get_name_from_field )
+from grit.gtf_support_fns import parse_gtf_meta_data
+from grit.transcript import Gene
+from grit import config
+
+def simulate_gtf(ofname, num_genes, seed):
+    """Write a gtf with random, possibly nested and overlapping, genes.
+
+    """
+    rng = random.Random(seed)
+    with open(ofname, 'w') as ofp:
+        for gene_i in xrange(num_genes):
+            chrm = rng.choice(['1', '2'])
+            strand = rng.choice('+-')
+            gene_start = rng.randint(1, 200000)
+            for trans_i in xrange(rng.randint(1, 3)):
+                pos = gene_start
+                for exon_i in xrange(rng.randint(1, 5)):
+                    exon_len = rng.randint(50, 500)
+                    ofp.write("\t".join((
+                        chrm, 'test', 'exon', str(pos), str(pos+exon_len), 
+                        '.', strand, '.', 
+                        'gene_id "G%i"; transcript_id "T%i_%i";' % (
+                            gene_i, gene_i, trans_i))) + "\n")
+                    pos += exon_len + rng.randint(60, 20000)
+    return
+
+def split_gtf_meta_data(group):
+    """The original meta data parser.
+
+    """
+    meta_data_items = group.split()
+    return dict( zip( meta_data_items[::2], 
+                      ( get_name_from_field(x) 
+                        for x in meta_data_items[1::2] ) ) )
+
+class TestParseGtfMetaData(unittest.TestCase):
+    def test_matches_split(self):
+        groups = [
+            '', ' ', 'gene_id', 'gene_id "G1";', 
+            'gene_id "G1"; transcript_id "T1";',
+            'gene_id "G1";   transcript_id\t"T1" ;\r\n',
+            'exon_number 3; level 2; tag "basic";',
+            'gene_id ""; transcript_id "; name ";";',
+            'gene_id "G1" transcript_id "T1"; gene_id "G2";',
+            'key value extra',
+            ' \x0b\x0ckey\x0b"value"\x0c',
+        ]
+        rng = random.Random(0)
+        tokens = ['gene_id', 'transcript_id', '"G1"', '"T1";', 'G1;', '"', 
+                  ';', '";', '""', 'a"b', 'level', '2;']
+        whitespace = [' ', '  ', '\t', '\n', '\r', '\x0b', '\x0c']
+        for i in xrange(1000):
+            groups.append("".join(
+                rng.choice(tokens) + rng.choice(whitespace) 
+                for j in xrange(rng.randint(0, 8))))
+        for group in groups:
+            self.assertEqual(parse_gtf_meta_data(group), 
+                             split_gtf_meta_data(group), msg=repr(group))
+
+class TestIntervalIndex(unittest.TestCase):
+    def test_matches_brute_force(self):
+        rng = numpy.random.RandomState(0)
+        for i in xrange(300):
+            n = rng.randint(0, 60)
+            starts = rng.randint(0, 200, n)
+            stops = starts + rng.randint(0, rng.choice([5, 50, 300]), n)
+            index = IntervalIndex(starts, stops)
+            for j in xrange(30):
+                start = rng.randint(-10, 250)
+                stop = start + rng.randint(0, 40)
+                self.assertEqual(
+                    index.find_overlapping(start, stop).tolist(),
+                    numpy.nonzero((stops >= start) & (starts <= stop))[0
+                        ].tolist())
+    
+    def test_nested_intervals(self):
+        # one long interval containing many short ones, and identical 
+        # intervals
+        starts = numpy.array([0, 0] + range(0, 1000, 10) + [500, 500])
+        stops = numpy.array([1000, 1000] + range(5, 1005, 10) + [520, 520])
+        index = IntervalIndex(starts, stops)
+        for start in xrange(-10, 1010, 7):
+            self.assertEqual(
+                index.find_overlapping(start, start+3).tolist(),
+                numpy.nonzero((stops >= start) & (starts <= start+3))[0
+                    ].tolist())
+
+class TestAnnotation(unittest.TestCase):
+    def setUp(self):
+        self.log_statement = config.log_statement
+        config.log_statement = lambda *args, **kwargs: None
+        self.tmp_dir = tempfile.mkdtemp()
+        gtf_fname = os.path.join(self.tmp_dir, "test.gtf")
+        simulate_gtf(gtf_fname, 200, 0)
+        self.genes = list(load_gtf(gtf_fname))
+        self.annotation = Annotation()
+        for gene in self.genes: self.annotation.append(gene)
+    
+    def tearDown(self):
+        config.log_statement = self.log_statement
+        shutil.rmtree(self.tmp_dir)
+    
+    def iter_queries(self):
+        rng = random.Random(1)
+        for i in xrange(200):
+            start = rng.randint(-1000, 300000)
+            yield ( rng.choice(['1', '2', '3']), rng.choice('+-.'), 
+                    start, start + rng.randint(0, 20000) )
+    
+    def test_overlapping_genes(self):
+        for chrm, strand, start, stop in self.iter_queries():
+            expected = [ 
+                gene.id for gene_strand in (strand if strand != '.' else '+-')
+                for gene in self.genes
+                if gene.chrm == chrm and gene.strand == gene_strand
+                and gene.stop >= start and gene.start <= stop ]
+            self.assertEqual(
+                [gene.id for gene in self.annotation.iter_overlapping_genes(
+                    chrm, strand, start, stop)], 
+                expected)
+    
+    def test_elements(self):
+        for chrm, strand, start, stop in self.iter_queries():
+            expected = []
+            for gene in self.genes:
+                if ( gene.chrm != chrm 
+                     or gene.strand not in strand.replace('.', '+-')
+                     or gene.stop < start or gene.start > stop ):
+                    continue
+                for element_type, elements in \
+                        gene.extract_elements().iteritems():
+                    expected.extend(
+                        (element_type, element) for element in elements
+                        if element[1] >= start and element[0] <= stop)
+            self.assertEqual(
+                sorted(self.annotation.iter_elements(
+                    chrm, strand, start, stop)), 
+                sorted(expected))
+    
+    def test_lazy_indices(self):
+        # gene queries don't build any element index, and element queries 
+        # only build the index of the queried contig and strand
+        list(self.annotation.iter_overlapping_genes('1', '.', 0, 10000))
+        self.assertEqual(len(self.annotation._element_index), 0)
+        list(self.annotation.iter_elements('1', '+', 0, 10000))
+        self.assertEqual(self.annotation._element_index.keys(), 
+                         [('1', '+'),])
+        
+        # adding a gene resets the indices
+        self.annotation.append(
+            Gene('new_gene', 'new_gene', '1', '+', 10, 20, []))
+        self.assertEqual(len(self.annotation._element_index), 0)
+        self.assertEqual(len(self.annotation._gene_index), 0)
+
+if __name__ == '__main__':
+    unittest.main()
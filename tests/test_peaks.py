@@ -0,0 +1,202 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Regression tests for the peak calling helpers.
+
+"""
+
+import unittest
+
+import numpy
+import scipy.stats
+
+# gtf has to be imported first, to resolve the package's circular imports
+from grit.files.gtf import load_gtf
+from grit import peaks
+from grit.call_peaks_support_fns import calc_moments, calc_moments_array
+
+class TestMergeChunkPeaks(unittest.TestCase):
+    def setUp(self):
+        self.cov = numpy.random.RandomState(0).randint(0, 5, 1000)
+    
+    def chunk_peak(self, start, stop, keep_cov=True):
+        peak_cov = self.cov[start:stop+1]
+        return ( start, stop, float(peak_cov.sum()), 
+                 peak_cov if keep_cov else None )
+
+    def assertPeaksEqual(self, merged_peaks, expected_peaks):
+        self.assertEqual([x[:3] for x in merged_peaks], 
+                         [x[:3] for x in expected_peaks])
+        for peak, expected_peak in zip(merged_peaks, expected_peaks):
+            if expected_peak[3] is None:
+                self.assertTrue(peak[3] is None)
+            else:
+                self.assertTrue(numpy.array_equal(peak[3], expected_peak[3]))
+
+    def test_disjoint_peaks(self):
+        chunk_peaks = [ self.chunk_peak(500, 600, False), 
+                        self.chunk_peak(10, 50),
+                        self.chunk_peak(51, 60) ]
+        self.assertPeaksEqual(
+            peaks.merge_chunk_peaks(chunk_peaks), sorted(chunk_peaks))
+
+    def test_overlapping_peaks(self):
+        chunk_peaks = [ self.chunk_peak(10, 50),
+                        self.chunk_peak(40, 80),
+                        self.chunk_peak(80, 120),
+                        self.chunk_peak(90, 100),
+                        self.chunk_peak(200, 300, False) ]
+        self.assertPeaksEqual(
+            peaks.merge_chunk_peaks(chunk_peaks),
+            [ self.chunk_peak(10, 120), self.chunk_peak(200, 300, False) ])
+    
+    def test_matches_full_coverage(self):
+        # merging peaks called in random overlapping windows should give the
+        # same coverage and counts as slicing the full coverage 
+        state = numpy.random.RandomState(1)
+        for i in xrange(100):
+            chunk_peaks = []
+            for j in xrange(state.randint(1, 10)):
+                start = state.randint(0, 900)
+                chunk_peaks.append(
+                    self.chunk_peak(start, start + state.randint(0, 100)))
+            for start, stop, cnt, peak_cov in peaks.merge_chunk_peaks(
+                    chunk_peaks):
+                self.assertTrue(
+                    numpy.array_equal(peak_cov, self.cov[start:stop+1]))
+                self.assertEqual(cnt, self.cov[start:stop+1].sum())
+    
+    def test_empty(self):
+        self.assertEqual(peaks.merge_chunk_peaks([]), [])
+
+def simulate_cage_signal(length, depth, seed):
+    """Simulate a piecewise constant control density, and a noisy signal with
+    a few peaks.
+
+    """
+    state = numpy.random.RandomState(seed)
+    control_cov = numpy.repeat(
+        state.gamma(2, 1, length//200+1), 200)[:length] + 0.1
+    control_cov = control_cov/control_cov.sum()
+    signal_cov = state.poisson(control_cov*depth*0.1).astype(float)
+    for i in xrange(state.randint(1, 6)):
+        start = state.randint(0, length-100)
+        signal_cov[start:start+state.randint(5, 60)] += (
+            state.poisson(depth*0.1/5) + state.poisson(3))
+    return signal_cov, control_cov
+
+class TestCalcMomentsArray(unittest.TestCase):
+    def test_matches_calc_moments(self):
+        ps = numpy.logspace(-7, -0.5, 40)
+        for n in (1, 2, 10, 100, 1000, 10000, 100000):
+            means, variances = calc_moments_array(ps, n)
+            for p, mean, variance in zip(ps, means, variances):
+                expected_mean, expected_variance = calc_moments(p, n)
+                self.assertAlmostEqual(
+                    mean/expected_mean, 1, places=6, msg=(p, n))
+                # calc_moments' variance loses precision when n*p is large
+                if n*p < 1000:
+                    self.assertAlmostEqual(variance/expected_variance, 1, 
+                                           places=4, msg=(p, n))
+    
+    def test_large_expected_counts(self):
+        # compare with the moments from the full binomial distribution, 
+        # where the variance is calculated about the mean
+        for n, p in ((100000, 0.3), (1000000, 0.05), (50000, 0.9)):
+            xs = numpy.arange(n+1)
+            probs = scipy.stats.binom.pmf(xs, n, p)
+            values = xs*numpy.log(p) - scipy.special.gammaln(xs+1)
+            expected_mean = (probs*values).sum()
+            expected_variance = (probs*(values-expected_mean)**2).sum()
+            means, variances = calc_moments_array([p,], n)
+            self.assertAlmostEqual(means[0]/expected_mean, 1, places=6)
+            self.assertAlmostEqual(variances[0]/expected_variance, 1, 
+                                   places=4)
+    
+    def test_repeated_values(self):
+        ps = numpy.array([[1e-3, 1e-4], [1e-3, 0.2]])
+        means, variances = calc_moments_array(ps, 500)
+        self.assertEqual(means.shape, ps.shape)
+        self.assertEqual(means[0,0], means[1,0])
+        for p, mean, variance in zip(ps.ravel(), means.ravel(), 
+                                     variances.ravel()):
+            self.assertEqual((mean, variance), calc_moments_array([p,], 500))
+
+class PerBaseTestSignificance(peaks.TestSignificance):
+    """Calculate the null moments with a calc_moments call per base.
+
+    """
+    def set_noise_frac(self, noise_frac):
+        self.noise_n = int(noise_frac*self.signal_n) + 1
+        null_means, null_vars = [0.,], [0.,]
+        for p in self.control_cov:
+            mean, var = calc_moments(p, self.noise_n)
+            null_means.append(mean)
+            null_vars.append(var)
+        self.null_means_cumsum = numpy.array(null_means).cumsum()
+        self.null_variances_cumsum = numpy.array(null_vars).cumsum()
+        return
+
+class TestCallPeaks(unittest.TestCase):
+    call_peaks_args = dict(
+        alpha=0.01, min_noise_frac=0.01, min_merge_size=50, 
+        min_rel_merge_size=0.2, min_rd_cnt=5, trim_fraction=0.01, 
+        min_peak_size=5, max_peak_size=1000, max_exp_sum_fraction=0.01, 
+        max_exp_mean_cvg_fraction=0.001)
+    
+    def test_per_base_null_moments(self):
+        # the peaks are the same as when the null moments are calculated
+        # separately for every base
+        simulation_params = [
+            (2000, 200), (5000, 5000), (20000, 2000), (50000, 20000), 
+            (100000, 50000), (100000, 500), (30000, 200000)]*2
+        for seed, (length, depth) in enumerate(simulation_params):
+            signal_cov, control_cov = simulate_cage_signal(length, depth, seed)
+            expected_peaks = peaks.call_peaks(
+                signal_cov, control_cov, 'cage', None, **self.call_peaks_args)
+            test_significance = peaks.TestSignificance
+            peaks.TestSignificance = PerBaseTestSignificance
+            try:
+                per_base_peaks = peaks.call_peaks(
+                    signal_cov, control_cov, 'cage', None, 
+                    **self.call_peaks_args)
+            finally:
+                peaks.TestSignificance = test_significance
+            self.assertEqual(expected_peaks, per_base_peaks, 
+                             msg="seed %i" % seed)
+
+class TestFindNoiseRegions(unittest.TestCase):
+    def test_reused_significance_tables(self):
+        # updating a TestSignificance object's noise frac should give the 
+        # same noise regions as building it from scratch
+        for seed, (length, depth) in enumerate(
+                [(2000, 200), (20000, 2000), (30000, 200000)]):
+            signal_cov, control_cov = simulate_cage_signal(length, depth, seed)
+            is_significant = peaks.TestSignificance(
+                signal_cov, control_cov, 1.0, 5)
+            for noise_frac in (1.0, 0.5, 0.1, 0.5, 0.01):
+                self.assertEqual(
+                    peaks.find_noise_regions(
+                        signal_cov, control_cov, noise_frac, 0.01, 5, 
+                        is_significant=is_significant),
+                    peaks.find_noise_regions(
+                        signal_cov, control_cov, noise_frac, 0.01, 5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Regression tests for the read coverage builders and the read index.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import random
+
+import numpy
+import pysam
+
+# gtf has to be imported first, to resolve the package's circular imports
+from grit.files.gtf import load_gtf
+from grit.files import read_index
+from grit.files.reads import (
+    RNAseqReads, iter_coverage_regions_for_read, build_coverage_from_intervals,
+    extract_jns_and_reads_in_region )
+import grit.config as config
+
+def simulate_bam(ofname, num_pairs, seed):
+    """Write a sorted, indexed bam of random paired, spliced reads.
+
+    """
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'LN': 20000, 'SN': 'chr2L'}, {'LN': 5000, 'SN': 'chr3R'}],
+              'RG': [{'ID': 'rg1'}, {'ID': 'rg2'}]}
+    reads = []
+    for i in xrange(num_pairs):
+        contig_id = 0 if rng.random() < 0.8 else 1
+        pos1 = rng.randint(0, header['SQ'][contig_id]['LN'] - 2000)
+        pos2 = pos1 + rng.randint(150, 400) - 50
+        is_rev = rng.random() < 0.5
+        read_grp = rng.choice(['rg1', 'rg2'])
+        for mate, pos, mate_pos, is_mate_rev in (
+                (1, pos1, pos2, is_rev), (2, pos2, pos1, not is_rev)):
+            read = pysam.AlignedSegment()
+            read.query_name = "q%i" % i
+            read.reference_id = contig_id
+            read.reference_start = pos
+            read.next_reference_id = contig_id
+            read.next_reference_start = mate_pos
+            if rng.random() < 0.2:
+                read.cigartuples = [(0, 20), (3, rng.randint(100, 600)), (0, 30)]
+            elif rng.random() < 0.05:
+                read.cigartuples = [(4, 3), (0, 20), (2, 2), (0, 27)]
+            else:
+                read.cigartuples = [(0, 50),]
+            read.query_sequence = "A"*sum(
+                length for op, length in read.cigartuples if op in (0, 1, 4))
+            read.query_qualities = pysam.qualitystring_to_array(
+                "I"*len(read.query_sequence))
+            flag = 0x1 | 0x2 | (0x40 if mate == 1 else 0x80)
+            flag |= 0x10 if is_mate_rev else 0x20
+            read.flag = flag
+            read.mapping_quality = 50
+            read.set_tags([('RG', read_grp), ('NH', rng.choice([1, 1, 2]))])
+            reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    ofp = pysam.AlignmentFile(ofname, "wb", header=header)
+    for read in reads: ofp.write(read)
+    ofp.close()
+    pysam.index(ofname)
+    return
+
+def build_read_coverage_array_per_read(
+        reads, chrm, strand, start, stop, read_pair=None ):
+    """The original, per read, coverage builder.
+
+    """
+    full_region_len = stop - start + 1
+    cvg = numpy.zeros(full_region_len)
+    for rd in reads.iter_reads( chrm, strand, start, stop ):
+        if read_pair is not None:
+            if read_pair==1 and not rd.is_read1: continue
+            if read_pair==2 and not rd.is_read2: continue
+        for region in iter_coverage_regions_for_read(
+                rd, reads, reads.RRR, reads.PAOS):
+            cvg[max(0, region[2]-start):max(0, region[3]-start)] += 1
+
+    return cvg
+
+class TestBuildCoverageFromIntervals(unittest.TestCase):
+    def test_matches_slices(self):
+        rng = numpy.random.RandomState(0)
+        for i in xrange(200):
+            region_start = rng.randint(0, 100)
+            region_len = rng.randint(1, 200)
+            n = rng.randint(0, 50)
+            starts = rng.randint(-50, 350, n)
+            stops = starts + rng.randint(-5, 100, n)
+            weights = rng.rand(n)
+            expected = numpy.zeros(region_len)
+            for start, stop, weight in zip(starts, stops, weights):
+                expected[max(0, start-region_start):
+                         max(0, stop-region_start)] += weight
+            self.assertTrue(numpy.allclose(
+                build_coverage_from_intervals(
+                    starts, stops, region_start, region_len, weights), 
+                expected))
+
+class TestReadCoverage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bam_fname = os.path.join(self.tmp_dir, "test.bam")
+        simulate_bam(self.bam_fname, 1000, 0)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    def load_reads(self):
+        return RNAseqReads(self.bam_fname).init(
+            reverse_read_strand=False, reads_are_stranded=True, 
+            reads_are_paired=True)
+    
+    def test_matches_per_read_coverage(self):
+        reads = self.load_reads()
+        for strand in '+-':
+            for read_pair in (None, 1, 2):
+                for chrm, start, stop in (
+                        ('2L', 1000, 15000), ('2L', 0, 19999), 
+                        ('2L', 5, 7), ('3R', 100, 4999)):
+                    self.assertTrue(numpy.array_equal(
+                        reads.build_read_coverage_array(
+                            chrm, strand, start, stop, read_pair),
+                        build_read_coverage_array_per_read(
+                            reads, chrm, strand, start, stop, read_pair)),
+                        msg=(chrm, strand, start, stop, read_pair))
+
+class TestReadIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bam_fname = os.path.join(self.tmp_dir, "test.bam")
+        simulate_bam(self.bam_fname, 1000, 0)
+        # use a small chunk size, so that the arrays are flushed several 
+        # times, and mates are matched across flushes
+        self._chunk_size = read_index.READ_INDEX_CHUNK_SIZE
+        read_index.READ_INDEX_CHUNK_SIZE = 37
+        self._log_statement = config.log_statement
+        config.log_statement = lambda *args, **kwargs: None
+    
+    def tearDown(self):
+        read_index.READ_INDEX_CHUNK_SIZE = self._chunk_size
+        config.log_statement = self._log_statement
+        os.chmod(self.tmp_dir, 0755)
+        shutil.rmtree(self.tmp_dir)
+    
+    def load_reads(self):
+        return RNAseqReads(self.bam_fname).init(
+            reverse_read_strand=False, reads_are_stranded=True, 
+            reads_are_paired=True)
+    
+    def test_matches_bam(self):
+        reads = self.load_reads().load_read_index()
+        self.assertTrue(reads.has_read_index)
+        for contig in reads.references:
+            bam_reads = list(reads.fetch(contig))
+            data = reads.read_index.contig(contig)
+            self.assertEqual(len(data), len(bam_reads))
+            self.assertEqual(
+                [data.qname(i) for i in xrange(len(data))],
+                [read.qname for read in bam_reads])
+            self.assertEqual(list(data.start), [rd.pos for rd in bam_reads])
+            for i, read in enumerate(bam_reads):
+                mate = bam_reads[data.mate[i]]
+                self.assertEqual(mate.qname, read.qname)
+                self.assertEqual(mate.pos, read.mpos)
+                self.assertNotEqual(mate.is_read1, read.is_read1)
+    
+    def test_matches_bam_reads_in_region(self):
+        reads = self.load_reads()
+        for region in (('2L', '+', 1000, 15000), ('3R', '-', 0, 4999)):
+            reads.read_index = None
+            bam_res = extract_jns_and_reads_in_region(region, reads)
+            reads.load_read_index()
+            index_res = extract_jns_and_reads_in_region(region, reads)
+            for bam_val, index_val in zip(bam_res[:2], index_res[:2]):
+                self.assertEqual(sorted(bam_val), sorted(index_val))
+            for rd_strand in '+-':
+                self.assertTrue(numpy.allclose(
+                    bam_res[4][rd_strand], index_res[4][rd_strand]))
+    
+    def test_read_only_dir(self):
+        os.chmod(self.tmp_dir, 0555)
+        if os.access(self.tmp_dir, os.W_OK):
+            self.skipTest("the directory is writable (running as root)")
+        reads = self.load_reads().load_read_index()
+        self.assertFalse(reads.has_read_index)
+
+if __name__ == '__main__':
+    unittest.main()